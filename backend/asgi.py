@@ -0,0 +1,338 @@
+# ASGI serving mode for cellXplore:
+#
+#   cd backend && uvicorn asgi:app --host 0.0.0.0 --port 5000
+#
+# The Flask app is unchanged, this module only decides where each request
+# runs. Zarr chunk requests, heavy table requests and everything else get
+# their own bounded thread pools, so a slow DataFrame serialization never
+# queues in front of the chunks the Vitessce spatial view loads while
+# panning. A pool that already has `queue` requests waiting answers 503 with
+# Retry-After instead of piling up more work.
+#
+# Small zarr chunks skip Flask: the event loop answers them from the chunk
+# cache, only the stat and the read run on the "chunks" pool. There is no
+# portable async file API, so the reads stay on threads (as aiofiles does),
+# but a chunk no longer waits for a WSGI worker thread. Table endpoints that
+# hold the GIL while serializing still slow every thread of the process down,
+# run several processes (uvicorn --workers) to serve tables and chunks in
+# parallel.
+import asyncio
+import io
+import os
+import stat as stat_module
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from werkzeug.http import http_date, is_resource_modified
+from werkzeug.utils import safe_join
+
+import main
+from main import create_app
+
+# name -> worker threads, requests allowed to wait for a worker
+POOL_LIMITS = {
+    "chunks": {"workers": int(os.environ.get("CELLXPLORE_CHUNK_WORKERS", 32)), "queue": 512},
+    "tables": {"workers": int(os.environ.get("CELLXPLORE_TABLE_WORKERS", 2)), "queue": 16},
+    "default": {"workers": int(os.environ.get("CELLXPLORE_WORKERS", 8)), "queue": 64},
+}
+# Endpoints that filter, aggregate or serialize the LIANA table
+TABLE_PATHS = (
+    "/data-table",
+    "/prop-freq",
+    "/sankey",
+    "/circos",
+    "/get_cellchat_data",
+    "/get_cellchat_bubble",
+    "/filter-table",
+    "/aggregate/",
+    "/expression",
+    "/query",
+    "/bubble",
+    "/search",
+    "/spatial/neighborhood",
+)
+RETRY_AFTER_SECONDS = 1
+CHUNK_PREFIX = "/datasets/"
+# Endpoint label of the chunks answered on the event loop in /metrics
+CHUNK_ENDPOINT = "/datasets/<path:filename>"
+
+
+def pool_for_path(path):
+    if path.startswith(CHUNK_PREFIX):
+        return "chunks"
+    if path.startswith(TABLE_PATHS):
+        return "tables"
+    return "default"
+
+
+class RequestPool:
+    # Thread pool with a bound on the number of requests it accepts
+    def __init__(self, name, workers, queue):
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix=f"cellxplore-{name}"
+        )
+        self.limit = workers + queue
+        self.active = 0
+
+    def try_acquire(self):
+        # Only called from the event loop thread, no lock needed
+        if self.active >= self.limit:
+            return False
+        self.active += 1
+        return True
+
+    def release(self):
+        self.active -= 1
+
+
+def build_environ(scope, body):
+    script_name = scope.get("root_path", "")
+    path_info = request_path(scope)
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": script_name.encode("utf8").decode("latin1"),
+        "PATH_INFO": path_info.encode("utf8").decode("latin1"),
+        "QUERY_STRING": scope["query_string"].decode("latin1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin1")
+        value = value.decode("latin1")
+        if name == "content-length":
+            key = "CONTENT_LENGTH"
+        elif name == "content-type":
+            key = "CONTENT_TYPE"
+        else:
+            key = "HTTP_" + name.upper().replace("-", "_")
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def request_path(scope):
+    # Path below the root path the app is mounted at
+    script_name = scope.get("root_path", "")
+    path = scope["path"]
+    if script_name and path.startswith(script_name):
+        path = path[len(script_name) :]
+    return path
+
+
+def chunk_path(scope):
+    # Full path and store version (None for unversioned URLs) of a zarr chunk
+    # the event loop may answer, None for metadata, Range requests and
+    # anything that is not a dataset file
+    if scope["method"] not in ("GET", "HEAD"):
+        return None
+    path = request_path(scope)
+    if not path.startswith(CHUNK_PREFIX):
+        return None
+    if any(name == b"range" for name, _ in scope.get("headers", [])):
+        return None
+    filename, version = path[len(CHUNK_PREFIX) :], None
+    if filename.startswith("@"):
+        version, _, filename = filename[1:].partition("/")
+    full_path = safe_join(main.BASE_DIR, filename)
+    if full_path is None or os.path.basename(full_path) in main.ZARR_METADATA_FILES:
+        return None
+    return full_path, version
+
+
+def cors_headers(scope):
+    # Access-Control-Allow-Origin as flask_cors sends it for main.CORS_ORIGINS
+    origins = main.CORS_ORIGINS
+    if "*" in origins:
+        return [(b"access-control-allow-origin", b"*")]
+    if len(origins) == 1:
+        return [(b"access-control-allow-origin", origins[0].encode("latin1"))]
+    origin = dict(scope.get("headers", [])).get(b"origin")
+    if origin is not None and origin.decode("latin1") in origins:
+        return [(b"access-control-allow-origin", origin), (b"vary", b"Origin")]
+    return []
+
+
+def read_small_chunk(full_path, version):
+    # Cached chunk, stat and Cache-Control of a regular file small enough for
+    # the chunk cache, None when Flask should answer (missing, directory,
+    # large file)
+    try:
+        stat = os.stat(full_path)
+    except OSError:
+        return None
+    if not stat_module.S_ISREG(stat.st_mode):
+        return None
+    if stat.st_size > main.CHUNK_CACHE_MAX_FILE_BYTES:
+        return None
+    return (
+        main.read_cached_chunk(full_path, stat),
+        stat,
+        main.chunk_cache_control(full_path, version),
+    )
+
+
+class PooledWsgiApp:
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.pools = {
+            name: RequestPool(name, **limits) for name, limits in POOL_LIMITS.items()
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        pool = self.pools[pool_for_path(scope["path"])]
+        if not pool.try_acquire():
+            await send_busy(send)
+            return
+        try:
+            chunk = chunk_path(scope)
+            if chunk is not None and await self.serve_chunk(
+                scope, pool.executor, chunk, send
+            ):
+                return
+            body = b""
+            while True:
+                message = await receive()
+                body += message.get("body", b"")
+                if not message.get("more_body"):
+                    break
+            await self.run_wsgi(pool.executor, build_environ(scope, body), send)
+        finally:
+            pool.release()
+
+    async def serve_chunk(self, scope, executor, chunk, send):
+        # Answers a small chunk with the headers Flask would send, returns
+        # False when Flask has to handle the request
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(executor, read_small_chunk, *chunk)
+        if result is None:
+            return False
+        entry, stat, cache_control = result
+        last_modified = datetime.fromtimestamp(stat.st_mtime, timezone.utc)
+        headers = [
+            (b"etag", ('"%s"' % entry["etag"]).encode("latin1")),
+            (b"last-modified", http_date(last_modified).encode("latin1")),
+            (b"cache-control", cache_control.encode("latin1")),
+            (b"accept-ranges", b"bytes"),
+        ] + cors_headers(scope)
+        modified = is_resource_modified(
+            build_environ(scope, b""), etag=entry["etag"], last_modified=last_modified
+        )
+        if modified:
+            status, body = 200, entry["body"]
+            headers += [
+                (b"content-type", b"application/octet-stream"),
+                (b"content-length", str(len(body)).encode("latin1")),
+            ]
+        else:
+            status, body = 304, b""
+        await send(
+            {"type": "http.response.start", "status": status, "headers": headers}
+        )
+        await send(
+            {
+                "type": "http.response.body",
+                "body": body if scope["method"] == "GET" else b"",
+            }
+        )
+        main.count_metric(
+            "cellxplore_requests_total", endpoint=CHUNK_ENDPOINT, status=str(status)
+        )
+        main.observe_metric(
+            "cellxplore_request_seconds",
+            time.perf_counter() - started,
+            main.LATENCY_BUCKETS,
+            endpoint=CHUNK_ENDPOINT,
+        )
+        main.observe_metric(
+            "cellxplore_response_bytes",
+            len(body),
+            main.SIZE_BUCKETS,
+            endpoint=CHUNK_ENDPOINT,
+        )
+        return True
+
+    async def run_wsgi(self, executor, environ, send):
+        # The WSGI call and every read of its body iterator run on the pool,
+        # the event loop only forwards the bytes
+        loop = asyncio.get_running_loop()
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started["status"] = int(status.split(" ", 1)[0])
+            started["headers"] = [
+                (name.lower().encode("latin1"), value.encode("latin1"))
+                for name, value in headers
+            ]
+
+        iterable = await loop.run_in_executor(
+            executor, self.wsgi_app, environ, start_response
+        )
+        iterator = iter(iterable)
+        try:
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": started["status"],
+                    "headers": started["headers"],
+                }
+            )
+            while True:
+                chunk = await loop.run_in_executor(executor, next, iterator, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send(
+                        {"type": "http.response.body", "body": chunk, "more_body": True}
+                    )
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            close = getattr(iterable, "close", None)
+            if close is not None:
+                await loop.run_in_executor(executor, close)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                for pool in self.pools.values():
+                    pool.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+async def send_busy(send):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 503,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"retry-after", str(RETRY_AFTER_SECONDS).encode()),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": b'{"error": "Server busy"}'})
+
+
+app = PooledWsgiApp(create_app())
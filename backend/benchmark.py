@@ -0,0 +1,515 @@
+# Benchmarks of the backend on synthetic datasets:
+#
+#   cd backend && python benchmark.py --scale small --save-baseline baseline.json
+#   cd backend && python benchmark.py --scale small --baseline baseline.json
+#
+# Generates an AnnData zarr store with a liana_annotated table and a
+# SpatialData store with cell circles, points the app at them, then times every
+# endpoint through the Flask test client, one request at a time and under
+# concurrent load. Reports latency percentiles, throughput and peak RSS
+# (sampled during every scenario, and the kernel's ru_maxrss for the whole
+# run), and compares them with a saved baseline.
+import argparse
+import itertools
+import json
+import os
+import random
+import secrets
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import anndata as ad
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+import main
+
+# Peak RSS of the whole run as the kernel tracks it, not available on Windows
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# name -> sizes of the synthetic study
+SCALES = {
+    "small": {"interactions": 1_000, "cells": 10_000, "genes": 200, "cell_types": 10},
+    "medium": {
+        "interactions": 100_000,
+        "cells": 500_000,
+        "genes": 500,
+        "cell_types": 25,
+    },
+    "large": {
+        "interactions": 10_000_000,
+        "cells": 5_000_000,
+        "genes": 500,
+        "cell_types": 50,
+    },
+}
+# Fraction of non-zero expression values
+EXPRESSION_DENSITY = 0.05
+N_PATHWAYS = 50
+# Side of the square the Xenium cells are spread over
+SPATIAL_EXTENT = 10000.0
+DATASET_ID = "benchmark"
+# A p95 latency or throughput this much worse than the baseline is a regression
+REGRESSION_TOLERANCE = 0.2
+# Seconds between resident memory samples while a scenario runs
+RSS_SAMPLE_INTERVAL = 0.01
+
+
+def synthetic_liana(n_interactions, cell_types, genes, rng):
+    # Columns of a LIANA result, ligands/receptors are single genes or two
+    # subunit complexes
+    def complexes(n):
+        first = rng.choice(genes, n)
+        second = rng.choice(genes, n)
+        return np.where(rng.random(n) < 0.2, first + "_" + second, first)
+
+    pathways = np.array([f"P{i}" for i in range(N_PATHWAYS)] + ["Unknown"])
+    lr_probs = rng.beta(0.5, 5, n_interactions)
+    lr_probs[rng.random(n_interactions) < 0.3] = 0
+    return pd.DataFrame(
+        {
+            "source": rng.choice(cell_types, n_interactions),
+            "target": rng.choice(cell_types, n_interactions),
+            "ligand_complex": complexes(n_interactions),
+            "receptor_complex": complexes(n_interactions),
+            "pathway_name": rng.choice(pathways, n_interactions),
+            "lr_probs": lr_probs,
+            "cellchat_pvals": rng.uniform(0, 0.2, n_interactions),
+        }
+    )
+
+
+def write_single_cell(path, sizes, rng):
+    cell_types = np.array([f"CT{i}" for i in range(sizes["cell_types"])])
+    genes = np.array([f"G{i}" for i in range(sizes["genes"])])
+    obs = pd.DataFrame(
+        {
+            "Cell_Type": pd.Categorical(rng.choice(cell_types, sizes["cells"])),
+            "clusters": pd.Categorical(
+                rng.integers(0, 20, sizes["cells"]).astype(str)
+            ),
+        },
+        index=[f"cell{i}" for i in range(sizes["cells"])],
+    )
+    X = sp.random(
+        sizes["cells"],
+        sizes["genes"],
+        density=EXPRESSION_DENSITY,
+        format="csc",
+        dtype=np.float32,
+        random_state=np.random.RandomState(0),
+    )
+    adata = ad.AnnData(
+        X=X,
+        obs=obs,
+        var=pd.DataFrame(index=genes),
+        obsm={"X_umap": rng.normal(size=(sizes["cells"], 2)).astype(np.float32)},
+        uns={
+            "liana_annotated": synthetic_liana(
+                sizes["interactions"], cell_types, genes, rng
+            )
+        },
+    )
+    adata.write_zarr(path)
+    return adata.obs_names, genes, cell_types
+
+
+def write_spatial(path, sizes, rng):
+    from spatialdata import SpatialData
+    from spatialdata.models import ShapesModel, TableModel
+
+    n_cells = sizes["cells"]
+    shapes = ShapesModel.parse(
+        rng.uniform(0, SPATIAL_EXTENT, (n_cells, 2)),
+        geometry=0,
+        radius=np.full(n_cells, 5.0),
+    )
+    table = ad.AnnData(
+        X=sp.random(n_cells, sizes["genes"], density=EXPRESSION_DENSITY, format="csr"),
+        obs=pd.DataFrame(
+            {
+                "clusters": pd.Categorical(
+                    rng.choice(
+                        [f"CT{i}" for i in range(sizes["cell_types"])], n_cells
+                    )
+                ),
+                "region": pd.Categorical([main.SPATIAL_SHAPES] * n_cells),
+                "cell_id": shapes.index.to_numpy(),
+            }
+        ),
+    )
+    table = TableModel.parse(
+        table,
+        region=main.SPATIAL_SHAPES,
+        region_key="region",
+        instance_key="cell_id",
+    )
+    SpatialData(
+        shapes={main.SPATIAL_SHAPES: shapes}, tables={"table": table}
+    ).write(path)
+
+
+def build_study(directory, sizes, spatial, seed=0):
+    # Writes the synthetic study and registers it with the app
+    rng = np.random.default_rng(seed)
+    barcodes, genes, cell_types = write_single_cell(
+        os.path.join(directory, f"{DATASET_ID}_sc.zarr"), sizes, rng
+    )
+    if spatial:
+        write_spatial(os.path.join(directory, f"{DATASET_ID}_xenium.zarr"), sizes, rng)
+    with open(os.path.join(directory, "datasets.json"), "w") as f:
+        json.dump(
+            {
+                DATASET_ID: {
+                    "merged_zarr_file": f"{DATASET_ID}_sc.zarr",
+                    "xenium_zarr_file": f"{DATASET_ID}_xenium.zarr",
+                    "name": "Benchmark",
+                }
+            },
+            f,
+        )
+    main.BASE_DIR = directory
+    main.CONFIG_DIR = directory
+    main.DATASETS_FILE = os.path.join(directory, "datasets.json")
+    main.DEFAULT_DATASET = DATASET_ID
+    return {"barcodes": barcodes, "genes": genes, "cell_types": cell_types}
+
+
+def build_scenarios(client, study, spatial):
+    # name -> function issuing one request with a test client
+    query = f"dataset={DATASET_ID}"
+    rng = random.Random(0)
+    genes = list(study["genes"])
+    cell_types = list(study["cell_types"])
+
+    selection = list(
+        study["barcodes"][:: max(1, len(study["barcodes"]) // 1000)].astype(str)
+    )
+    response = client.post(
+        f"/process_selections?{query}",
+        json={"selections": {"benchmark": selection}},
+    )
+    session_id = response.get_json()["session_id"]
+    session = {main.SESSION_HEADER: session_id}
+
+    # Selection-update loop: a second session re-posts a lasso selection that
+    # changes on every request and refreshes the table for it, cycling over
+    # more selections than the results LRU holds like a user dragging a lasso
+    update_rng = np.random.default_rng(1)
+    barcodes = study["barcodes"].astype(str)
+    sizes = update_rng.integers(100, 2000, 2 * main.SELECTION_RESULTS_CACHE_SIZE)
+    updates = itertools.cycle(
+        [list(update_rng.choice(barcodes, size, replace=False)) for size in sizes]
+    )
+    # Its own session id, the client's cookie holds the first one
+    update_session = {main.SESSION_HEADER: secrets.token_urlsafe(24)}
+
+    def update_selection(c):
+        response = c.post(
+            f"/process_selections?{query}",
+            json={"selections": {"lasso": next(updates)}},
+            headers=update_session,
+        )
+        if response.status_code >= 400:
+            return response
+        return c.post(
+            f"/filter-table?{query}",
+            json={"selection_name": "lasso"},
+            headers=update_session,
+        )
+
+    zarr_root = os.path.join(main.BASE_DIR, f"{DATASET_ID}_sc.zarr")
+    chunks = [
+        os.path.relpath(os.path.join(root, name), main.BASE_DIR)
+        for group in ("X", "obs")
+        for root, _, files in os.walk(os.path.join(zarr_root, group))
+        for name in files
+        if not name.startswith(".")
+    ]
+
+    scenarios = {
+        "data-table": lambda c: c.get(f"/data-table?{query}"),
+        "data-table-page": lambda c: c.get(
+            f"/data-table?{query}&limit=100&offset={rng.randrange(1000)}"
+            "&sort_by=lr_probs&sort_dir=desc&filter=cellchat_pvals<=0.05"
+        ),
+        "prop-freq": lambda c: c.get(f"/prop-freq?{query}"),
+        "sankey": lambda c: c.get(f"/sankey?{query}"),
+        "circos": lambda c: c.get(f"/circos?{query}"),
+        "cellchat-data": lambda c: c.get(f"/get_cellchat_data?{query}"),
+        "cellchat-bubble": lambda c: c.get(f"/get_cellchat_bubble?{query}"),
+        "heatmap": lambda c: c.get(f"/aggregate/heatmap?{query}"),
+        "pathway-proportion": lambda c: c.get(
+            f"/aggregate/pathway-proportion?{query}"
+        ),
+        "circos-aggregate": lambda c: c.get(f"/aggregate/circos?{query}&top_pairs=10"),
+        "query-filter": lambda c: c.get(
+            f"/query?{query}&where=lr_probs>={rng.randrange(100) / 100}"
+            "&where=cellchat_pvals<=0.05&select=source,target,lr_probs"
+        ),
+        "query-group": lambda c: c.get(
+            f"/query?{query}&where=cellchat_pvals<=0.05&group_by=source,target"
+            "&agg=count&agg=mean:lr_probs"
+        ),
+        "bubble": lambda c: c.get(
+            f"/bubble?{query}&source={rng.choice(cell_types)}&top_k=10"
+        ),
+        "search": lambda c: c.get(f"/search?{query}&q=G{rng.randrange(10)}"),
+        "expression": lambda c: c.get(
+            f"/expression?{query}&gene={rng.choice(genes)}&gene={rng.choice(genes)}"
+        ),
+        "filter-table": lambda c: c.post(
+            f"/filter-table?{query}",
+            json={"selection_name": "benchmark"},
+            headers=session,
+        ),
+        "process-selections": lambda c: c.post(
+            f"/process_selections?{query}",
+            json={"selections": {"lasso": next(updates)}},
+            headers=update_session,
+        ),
+        "selection-update": update_selection,
+        "zarr-chunk": lambda c: c.get(f"/datasets/{rng.choice(chunks)}"),
+        "zarr-metadata": lambda c: c.get(f"/datasets/{DATASET_ID}_sc.zarr/.zmetadata"),
+        "config": lambda c: c.get(f"/get_config?{query}"),
+        "dual-config": lambda c: c.get(f"/get_dual_config?{query}"),
+        "dataset-registry": lambda c: c.get("/dataset-registry"),
+        "ready": lambda c: c.get("/ready"),
+        "metrics": lambda c: c.get("/metrics"),
+    }
+    if spatial:
+        # Precomputed as ingest.py does, otherwise requests answer 202 until
+        # the background job is done
+        main.write_neighborhood_enrichment(
+            DATASET_ID,
+            main.SPATIAL_CELL_TYPE_KEY,
+            main.NEIGHBORHOOD_RADIUS,
+            main.NEIGHBORHOOD_PERMUTATIONS,
+        )
+        scenarios["spatial-neighborhood"] = lambda c: c.get(
+            f"/spatial/neighborhood?{query}"
+        )
+        scenarios["spatial-overview"] = lambda c: c.get(
+            f"/spatial/cells?{query}&x0=0&y0=0&x1={SPATIAL_EXTENT}&y1={SPATIAL_EXTENT}"
+        )
+        scenarios["spatial-viewport"] = lambda c: c.get(
+            f"/spatial/cells?{query}&x0=1000&y0=1000&x1=1200&y1=1200"
+        )
+    return scenarios
+
+
+def latency_summary(latencies, elapsed):
+    latencies = np.asarray(latencies)
+    return {
+        "requests": len(latencies),
+        "mean_ms": float(latencies.mean() * 1000),
+        "p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "p95_ms": float(np.percentile(latencies, 95) * 1000),
+        "p99_ms": float(np.percentile(latencies, 99) * 1000),
+        "throughput": len(latencies) / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+@contextmanager
+def sampled_peak_rss():
+    # Highest resident memory seen by a thread sampling it every
+    # RSS_SAMPLE_INTERVAL seconds while the block runs, so allocations freed
+    # before the request returns are counted too
+    peak = {"bytes": main.process_rss() or 0}
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(RSS_SAMPLE_INTERVAL):
+            peak["bytes"] = max(peak["bytes"], main.process_rss() or 0)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        yield peak
+    finally:
+        done.set()
+        sampler.join()
+        peak["bytes"] = max(peak["bytes"], main.process_rss() or 0)
+
+
+def kernel_peak_rss():
+    # Peak RSS of the whole run, study generation included, None where the
+    # resource module is missing
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_scenario(client, issue, iterations, warmup):
+    # Sequential requests, the first `warmup` ones fill the caches untimed.
+    # The peak RSS covers the warmup, which is where the caches are built.
+    latencies = []
+    with sampled_peak_rss() as peak_rss:
+        for _ in range(warmup):
+            issue(client).get_data()
+        started = time.perf_counter()
+        for _ in range(iterations):
+            request_started = time.perf_counter()
+            response = issue(client)
+            # Streamed bodies are read to the end like a client would
+            response.get_data()
+            latencies.append(time.perf_counter() - request_started)
+            if response.status_code >= 400:
+                raise RuntimeError(
+                    f"HTTP {response.status_code}: {response.get_data()[:200]}"
+                )
+        elapsed = time.perf_counter() - started
+    summary = latency_summary(latencies, elapsed)
+    summary["peak_rss_bytes"] = peak_rss["bytes"]
+    return summary
+
+
+def run_load(app, scenarios, threads, duration):
+    # Every thread issues random scenarios with its own client until the
+    # duration is over
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(seed):
+        rng = random.Random(seed)
+        client = app.test_client()
+        names = list(scenarios)
+        while time.perf_counter() < deadline:
+            request_started = time.perf_counter()
+            response = scenarios[rng.choice(names)](client)
+            response.get_data()
+            elapsed = time.perf_counter() - request_started
+            with lock:
+                latencies.append(elapsed)
+                if response.status_code >= 400:
+                    errors.append(response.status_code)
+
+    started = time.perf_counter()
+    with sampled_peak_rss() as peak_rss:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(worker, range(threads)))
+    summary = latency_summary(latencies, time.perf_counter() - started)
+    summary["peak_rss_bytes"] = peak_rss["bytes"]
+    summary["threads"] = threads
+    summary["errors"] = len(errors)
+    return summary
+
+
+def compare(results, baseline):
+    # Regressions against the baseline: p95 latency or throughput worse by
+    # more than REGRESSION_TOLERANCE
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        if result["p95_ms"] > previous["p95_ms"] * (1 + REGRESSION_TOLERANCE):
+            regressions.append(
+                f"{name}: p95 {previous['p95_ms']:.2f} -> {result['p95_ms']:.2f} ms"
+            )
+        if result["throughput"] < previous["throughput"] * (1 - REGRESSION_TOLERANCE):
+            regressions.append(
+                f"{name}: throughput {previous['throughput']:.1f} -> "
+                f"{result['throughput']:.1f} req/s"
+            )
+    return regressions
+
+
+def print_results(results, baseline):
+    print(
+        f"{'scenario':<20} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+        f"{'req/s':>9} {'vs p95':>8}"
+    )
+    for name, result in results.items():
+        change = ""
+        previous = baseline.get(name)
+        if previous is not None and previous["p95_ms"] > 0:
+            change = f"{(result['p95_ms'] / previous['p95_ms'] - 1) * 100:+.0f}%"
+        print(
+            f"{name:<20} {result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f} "
+            f"{result['p99_ms']:>9.2f} {result['throughput']:>9.1f} {change:>8}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the cellXplore backend")
+    parser.add_argument("--scale", choices=list(SCALES), default="small")
+    for size in SCALES["small"]:
+        parser.add_argument(f"--{size.replace('_', '-')}", type=int, dest=size)
+    parser.add_argument("--no-spatial", action="store_true")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--only", action="append", help="scenario to run, repeatable")
+    parser.add_argument("--directory", help="keep the synthetic study here")
+    parser.add_argument("--baseline", help="compare with this results file")
+    parser.add_argument("--save-baseline", help="write the results to this file")
+    args = parser.parse_args()
+
+    sizes = dict(SCALES[args.scale])
+    for size in sizes:
+        if getattr(args, size) is not None:
+            sizes[size] = getattr(args, size)
+    spatial = not args.no_spatial
+    directory = args.directory or tempfile.mkdtemp(prefix="cellxplore-benchmark-")
+    os.makedirs(directory, exist_ok=True)
+
+    started = time.perf_counter()
+    study = build_study(directory, sizes, spatial)
+    print(
+        f"Synthetic study {sizes} written to {directory} "
+        f"in {time.perf_counter() - started:.1f}s"
+    )
+    app = main.create_app(background=False)
+    client = app.test_client()
+    scenarios = build_scenarios(client, study, spatial)
+    if args.only:
+        scenarios = {name: scenarios[name] for name in args.only}
+
+    results = {
+        name: run_scenario(client, issue, args.iterations, args.warmup)
+        for name, issue in scenarios.items()
+    }
+    if args.threads > 0 and args.duration > 0:
+        results["concurrent-mix"] = run_load(app, scenarios, args.threads, args.duration)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)["results"]
+    print_results(results, baseline)
+    peak_rss = max(result.get("peak_rss_bytes", 0) for result in results.values())
+    print(f"Peak RSS while serving (sampled): {peak_rss / 1024**2:.0f} MiB")
+    max_rss = kernel_peak_rss()
+    if max_rss is not None:
+        print(f"Peak RSS of the run (ru_maxrss): {max_rss / 1024**2:.0f} MiB")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(
+                {
+                    "scale": args.scale,
+                    "sizes": sizes,
+                    "max_rss_bytes": max_rss,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+    regressions = compare(results, baseline)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,309 @@
+# Converts a single-cell AnnData (h5ad or zarr) and a SpatialData zarr into the
+# layout cellXplore serves best, registers them and writes their Vitessce
+# configs:
+#
+#   cd backend && python ingest.py my_study --single-cell my_study.h5ad \
+#       --spatial my_study_xenium.zarr --name "My Study"
+#
+# - X is rewritten in column chunks, Vitessce and /expression read it by gene
+# - single-scale images get a multiscale pyramid
+# - uns["liana_annotated"] is also written as a parquet side file
+# - per-Cell_Type expression summaries are precomputed for /expression
+# - source x target, source x pathway and target x pathway cubes of
+#   liana_annotated are precomputed for the heatmap and pathway proportion
+#   thresholds
+# - zarr metadata is consolidated, Vitessce reads one .zmetadata per store
+# - the default Xenium neighborhood enrichment is computed for registered
+#   datasets
+#
+# Every array is written by its own job on a process pool.
+import argparse
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import anndata as ad
+import h5py
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import spatialdata as sd
+import zarr
+from spatialdata.models import Image2DModel, Image3DModel
+from spatialdata.transformations import get_transformation
+from xarray import DataArray
+
+import main
+from main import read_elem, CELL_TYPE_SUMMARY_KEY, LIANA_CUBE_KEY, expression_summaries
+
+try:
+    from anndata.io import write_elem
+except ImportError:
+    from anndata.experimental import write_elem
+
+# Genes per X chunk, one chunk holds every cell of VAR_CHUNK_SIZE genes
+VAR_CHUNK_SIZE = 10
+# Non-zero values per chunk of a CSC X
+NNZ_CHUNK_SIZE = 1024**2
+# Downscale factors of the image pyramid levels
+PYRAMID_SCALE_FACTORS = [2, 2, 2, 2]
+IMAGE_CHUNK_SIZE = 1024
+# Elements of the single-cell AnnData copied as they are. layers, raw, obsp,
+# varm and varp are not read by the app or by Vitessce and are left out.
+SINGLE_CELL_ELEMENTS = ["obs", "var", "obsm", "uns"]
+LIANA_KEY = "liana_annotated"
+
+
+def open_input(path, mode="r"):
+    # Root group of an h5ad file or of an AnnData zarr store
+    if path.endswith(".h5ad"):
+        return h5py.File(path, mode)
+    return zarr.open(path, mode=mode)
+
+
+def read_expression(path, group="X"):
+    # X of an AnnData as a CSC matrix
+    root = open_input(path)
+    X = read_elem(root[group])
+    return sp.csc_matrix(X)
+
+
+def write_expression(group, X, var_chunk=VAR_CHUNK_SIZE, sparse=False):
+    # X as a dense array chunked by columns, filled one chunk at a time, or
+    # as a CSC matrix when sparse
+    if "X" in group:
+        del group["X"]
+    if sparse:
+        write_elem(group, "X", X, dataset_kwargs={"chunks": (NNZ_CHUNK_SIZE,)})
+        return
+    n_obs, n_vars = X.shape
+    array = group.create_dataset(
+        "X",
+        shape=(n_obs, n_vars),
+        chunks=(n_obs, var_chunk),
+        dtype=np.float32,
+    )
+    for start in range(0, n_vars, var_chunk):
+        stop = min(start + var_chunk, n_vars)
+        array[:, start:stop] = X[:, start:stop].toarray().astype(np.float32)
+    array.attrs.update({"encoding-type": "array", "encoding-version": "0.2.0"})
+
+
+def expression_job(input_path, output_path, var_chunk, sparse):
+    write_expression(
+        zarr.open_group(output_path, mode="a"),
+        read_expression(input_path),
+        var_chunk=var_chunk,
+        sparse=sparse,
+    )
+
+
+def liana_table_job(input_path, output_path):
+    # uns["liana_annotated"] as parquet next to its zarr copy, LazyUns reads it
+    # instead when pyarrow is installed
+    if main.pq is None:
+        print("pyarrow is not installed, liana_annotated is only kept in the zarr store")
+        return
+    root = open_input(input_path)
+    if "uns" not in root or LIANA_KEY not in root["uns"]:
+        return
+    df = read_elem(root["uns"][LIANA_KEY])
+    main.pq.write_table(
+        main.pa.Table.from_pandas(df, preserve_index=False),
+        os.path.join(output_path, "uns", main.UNS_SIDE_FILES[LIANA_KEY]),
+    )
+
+
+def liana_cube_job(input_path, output_path):
+    # Threshold cubes of liana_annotated in uns[LIANA_CUBE_KEY], built from
+    # the table as the app normalizes it
+    root = open_input(input_path)
+    if "uns" not in root or LIANA_KEY not in root["uns"]:
+        return
+    df = main.normalize_liana(read_elem(root["uns"][LIANA_KEY]))
+    write_elem(
+        zarr.open_group(os.path.join(output_path, "uns"), mode="a"),
+        LIANA_CUBE_KEY,
+        main.cube_to_uns(main.build_liana_cube(df)),
+    )
+
+
+def cell_type_summaries_job(input_path, output_path, var_chunk):
+    # Mean expression and fraction of expressing cells of every gene per
+    # Cell_Type, in uns[CELL_TYPE_SUMMARY_KEY]
+    root = open_input(input_path)
+    obs = read_elem(root["obs"])
+    if "Cell_Type" not in obs:
+        return
+    var_names = pd.Index(read_elem(root["var"]).index.astype(str))
+    cell_types = pd.Categorical(obs["Cell_Type"])
+    groups = np.asarray(cell_types.codes)
+    X = read_expression(input_path)
+    means, fractions = [], []
+    for start in range(0, X.shape[1], var_chunk):
+        mean, fraction, _ = expression_summaries(
+            X[:, start : start + var_chunk], groups, len(cell_types.categories)
+        )
+        means.append(mean.T)
+        fractions.append(fraction.T)
+    columns = list(cell_types.categories.astype(str))
+    write_elem(
+        zarr.open_group(os.path.join(output_path, "uns"), mode="a"),
+        CELL_TYPE_SUMMARY_KEY,
+        {
+            "mean": pd.DataFrame(np.vstack(means), index=var_names, columns=columns),
+            "fraction": pd.DataFrame(
+                np.vstack(fractions), index=var_names, columns=columns
+            ),
+        },
+    )
+
+
+def with_pyramid(image):
+    # Multiscale copy of a single-scale image, multiscale images are kept
+    if not isinstance(image, DataArray):
+        return image
+    model = Image3DModel if "z" in image.dims else Image2DModel
+    chunks = {dim: IMAGE_CHUNK_SIZE for dim in image.dims if dim != "c"}
+    return model.parse(
+        image.data,
+        dims=image.dims,
+        c_coords=image.coords["c"].values if "c" in image.coords else None,
+        transformations=get_transformation(image, get_all=True),
+        scale_factors=PYRAMID_SCALE_FACTORS,
+        chunks=chunks,
+    )
+
+
+def spatial_job(input_path, output_path, var_chunk, sparse):
+    sdata = sd.read_zarr(input_path)
+    for name in list(sdata.images.keys()):
+        sdata.images[name] = with_pyramid(sdata.images[name])
+    sdata.write(output_path, overwrite=True)
+    for name, table in sdata.tables.items():
+        write_expression(
+            zarr.open_group(os.path.join(output_path, "tables", name), mode="a"),
+            sp.csc_matrix(table.X),
+            var_chunk=var_chunk,
+            sparse=sparse,
+        )
+    zarr.consolidate_metadata(output_path)
+
+
+def write_single_cell_skeleton(input_path, output_path):
+    # Everything but X, which expression_job adds in column chunks
+    root = open_input(input_path)
+    elements = {
+        key: read_elem(root[key]) for key in SINGLE_CELL_ELEMENTS if key in root
+    }
+    if os.path.exists(output_path):
+        shutil.rmtree(output_path)
+    ad.AnnData(**elements).write_zarr(output_path)
+    # Consolidated again once every job has written its arrays
+    metadata_path = os.path.join(output_path, ".zmetadata")
+    if os.path.exists(metadata_path):
+        os.remove(metadata_path)
+
+
+def register_dataset(dataset_id, spec):
+    registry = {}
+    if os.path.exists(main.DATASETS_FILE):
+        with open(main.DATASETS_FILE, "r") as f:
+            registry = json.load(f)
+    registry[dataset_id] = spec
+    with open(main.DATASETS_FILE, "w") as f:
+        json.dump(registry, f, indent=4)
+
+
+def ingest(
+    dataset_id,
+    single_cell_path,
+    spatial_path,
+    output_dir=None,
+    name=None,
+    description="",
+    var_chunk=VAR_CHUNK_SIZE,
+    sparse=False,
+    workers=None,
+):
+    output_dir = output_dir or main.BASE_DIR
+    merged_zarr_file = f"{dataset_id}_sc.zarr"
+    xenium_zarr_file = f"{dataset_id}_xenium.zarr"
+    merged_path = os.path.join(output_dir, merged_zarr_file)
+    xenium_path = os.path.join(output_dir, xenium_zarr_file)
+
+    write_single_cell_skeleton(single_cell_path, merged_path)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        jobs = {
+            "X": pool.submit(
+                expression_job, single_cell_path, merged_path, var_chunk, sparse
+            ),
+            LIANA_KEY: pool.submit(liana_table_job, single_cell_path, merged_path),
+            LIANA_CUBE_KEY: pool.submit(liana_cube_job, single_cell_path, merged_path),
+            CELL_TYPE_SUMMARY_KEY: pool.submit(
+                cell_type_summaries_job, single_cell_path, merged_path, var_chunk
+            ),
+        }
+        jobs["spatial"] = pool.submit(
+            spatial_job, spatial_path, xenium_path, var_chunk, sparse
+        )
+        for job_name, job in jobs.items():
+            job.result()
+            print(f"{dataset_id}: {job_name} written")
+    zarr.consolidate_metadata(merged_path)
+
+    if output_dir == main.BASE_DIR:
+        register_dataset(
+            dataset_id,
+            {
+                "merged_zarr_file": merged_zarr_file,
+                "xenium_zarr_file": xenium_zarr_file,
+                "name": name or dataset_id,
+                "description": description,
+            },
+        )
+        for kind in main.CONFIG_KINDS:
+            main.get_dataset_config(dataset_id, kind)
+        try:
+            main.write_neighborhood_enrichment(
+                dataset_id,
+                main.SPATIAL_CELL_TYPE_KEY,
+                main.NEIGHBORHOOD_RADIUS,
+                main.NEIGHBORHOOD_PERMUTATIONS,
+            )
+        except KeyError as e:
+            print(f"{dataset_id}: no neighborhood enrichment, column {e} not found")
+        print(f"{dataset_id}: registered in {main.DATASETS_FILE}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert a study into the zarr layout served by cellXplore"
+    )
+    parser.add_argument("dataset_id")
+    parser.add_argument("--single-cell", required=True, help="h5ad or AnnData zarr")
+    parser.add_argument("--spatial", required=True, help="SpatialData zarr")
+    parser.add_argument(
+        "--output-dir",
+        help="defaults to BASE_DIR, datasets written there are also registered",
+    )
+    parser.add_argument("--name")
+    parser.add_argument("--description", default="")
+    parser.add_argument("--var-chunk", type=int, default=VAR_CHUNK_SIZE)
+    parser.add_argument(
+        "--sparse", action="store_true", help="keep X sparse (CSC) instead of dense"
+    )
+    parser.add_argument("--workers", type=int)
+    args = parser.parse_args()
+    ingest(
+        args.dataset_id,
+        args.single_cell,
+        args.spatial,
+        output_dir=args.output_dir,
+        name=args.name,
+        description=args.description,
+        var_chunk=args.var_chunk,
+        sparse=args.sparse,
+        workers=args.workers,
+    )
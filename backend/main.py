@@ -1,12 +1,32 @@
 from flask import Flask, Response
 from flask import request, jsonify, send_from_directory, abort, send_file
+from flask import g, has_request_context
 from flask_cors import CORS
-import traceback
-from pprint import pprint
+from werkzeug.exceptions import HTTPException
+from werkzeug.utils import safe_join
+import logging
 import spatialdata as sd
-import anndata as ad
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+from scipy.spatial import cKDTree
+import zarr
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import gzip
+import hashlib
 import json
+import operator
+from collections import OrderedDict
+from contextlib import contextmanager
 import os
+import re
+import secrets
+import stat as stat_module
+import sys
+import threading
+import time
+import zlib
 from vitessce import (
     VitessceConfig,
     SpatialDataWrapper,
@@ -18,37 +38,2731 @@ from vitessce import (
     get_initial_coordination_scope_prefix,
 )
 
+# read_elem/sparse_dataset moved from anndata.experimental to anndata.io in
+# anndata 0.11
+try:
+    from anndata.io import read_elem, sparse_dataset
+except ImportError:
+    from anndata.experimental import read_elem, sparse_dataset
+
+# pyarrow is only needed for the binary table formats
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# Only used for the peak RSS where /proc is not available
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# brotli and zstandard add the br/zstd response encodings, gzip is always
+# available
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 app = Flask(__name__, static_folder="./dist", static_url_path="/dist")
 #app = Flask(__name__)
-CORS(app, origins=["http://localhost:5174"])
-# CORS(app, origins=["*"])
+# Also used by asgi.py for the chunks it answers without Flask
+CORS_ORIGINS = ["http://localhost:5174"]
+# CORS_ORIGINS = ["*"]
+CORS(app, origins=CORS_ORIGINS)
+
+# DEBUG also logs per-request details (selections, served files), which are
+# skipped on the hot paths otherwise
+logging.basicConfig(
+    level=os.environ.get("CELLXPLORE_LOG_LEVEL", "INFO"),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+)
+logger = logging.getLogger("cellxplore")
+
+# Prometheus metrics of this process, rendered by /metrics
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1024, 10 * 1024, 100 * 1024, 1024**2, 10 * 1024**2, 100 * 1024**2)
+METRICS = {
+    "cellxplore_requests_total": ("counter", "Requests by endpoint and status"),
+    "cellxplore_request_seconds": (
+        "histogram",
+        "Time to build the response, streamed bodies excluded",
+    ),
+    "cellxplore_response_bytes": ("histogram", "Response body sizes"),
+    "cellxplore_phase_seconds": (
+        "histogram",
+        "Time spent filtering, serializing, compressing or reading data",
+    ),
+    "cellxplore_cache_requests_total": ("counter", "Cache lookups by result"),
+}
+metrics_lock = threading.Lock()
+# (name, labels) -> value, or [bucket counts..., sum, count] for histograms
+metric_values = {}
+
+
+def count_metric(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        metric_values[key] = metric_values.get(key, 0) + value
+
+
+def observe_metric(name, value, buckets, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        state = metric_values.get(key)
+        if state is None:
+            state = metric_values[key] = [0] * (len(buckets) + 2)
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                state[i] += 1
+        state[-2] += value
+        state[-1] += 1
+
+
+def count_cache(cache, hit):
+    count_metric(
+        "cellxplore_cache_requests_total", cache=cache, result="hit" if hit else "miss"
+    )
+
+
+def current_endpoint():
+    if has_request_context() and request.url_rule is not None:
+        return request.url_rule.rule
+    return "background"
+
+
+@contextmanager
+def timed(phase):
+    # Adds the duration of the block to the phase histogram of the endpoint
+    # being served
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_metric(
+            "cellxplore_phase_seconds",
+            time.perf_counter() - started,
+            LATENCY_BUCKETS,
+            endpoint=current_endpoint(),
+            phase=phase,
+        )
+
+
+def process_rss():
+    # Resident memory in bytes, the peak RSS where /proc is not available
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        if resource is None:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak if sys.platform == "darwin" else peak * 1024
+
+# Constants /Users/olympia/cellXplore_App/datasets/Xenium_proper_data.zarr
+# /Users/olympia/cellXplore_App/datasets/sc_FPPE_breast_cancer.zarr
+# Paths
+MERGED_ZARR_FILE = "sc_FPPE_breast_cancer.zarr"
+XENIUM_ZARR_FILE = "Xenium_proper_data.zarr"  # Xenium dataset
+CONFIG_DIR = "/home/olympia/cellXplore_App/configs/"
+BASE_DIR = "/home/olympia/cellXplore_App/datasets/"
+# Public URL of the /datasets route, the base_url of the Vitessce configs
+DATASETS_URL = "http://oh-cxg-dev.mvls.gla.ac.uk/datasets"
+SAMPLE_NAME = "Breast_Cancer"  # Sample name
+DESCRIPTION = "High resolution mapping of the tumor microenvironment using integrated single-cell, spatial and in situ analysis. Janesick, A., Shelansky, R., Gottscho, A.D. et al. Nat Commun 14, 8353 (2023). https://doi.org/10.1038/s41467-023-43458-x"
+
+# The sample above is the default dataset. More studies are registered in
+# DATASETS_FILE as {id: {merged_zarr_file, xenium_zarr_file, name, description}}
+# and selected with ?dataset=<id> on every endpoint.
+DEFAULT_DATASET = SAMPLE_NAME
+DATASETS_FILE = os.path.join(CONFIG_DIR, "datasets.json")
+# Memory budget of the loaded datasets and their cached views, the least
+# recently used datasets are closed once it is exceeded
+DATASET_CACHE_MAX_BYTES = 4 * 1024**3
+
+# Minimum number of seconds between two fingerprint checks of the zarr store
+FINGERPRINT_TTL = 2.0
+# Only the groups the API reads are stat-ed, the expression matrix is skipped
+FINGERPRINT_GROUPS = ["obs", "uns"]
+
+
+def dataset_fingerprint(zarr_path):
+    # Hash of the mtimes and sizes of the zarr metadata and of the obs/uns
+    # groups, changes whenever the dataset is rewritten on disk
+    digest = hashlib.sha1()
+    if not os.path.exists(zarr_path):
+        return None
+    paths = [zarr_path]
+    for group in FINGERPRINT_GROUPS:
+        group_path = os.path.join(zarr_path, group)
+        for root, dirs, files in os.walk(group_path):
+            dirs.sort()
+            paths.extend(os.path.join(root, name) for name in sorted(files))
+    for name in (".zattrs", ".zgroup", ".zmetadata", "zarr.json"):
+        paths.append(os.path.join(zarr_path, name))
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        digest.update(f"{path}:{stat.st_mtime_ns}:{stat.st_size};".encode())
+    return digest.hexdigest()
+
+
+def object_nbytes(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, (pd.Series, pd.Index)):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    return sys.getsizeof(value)
+
+
+# uns["liana_annotated"] is normalized when it is loaded: string columns become
+# categoricals (the columns of each group below sharing one vocabulary, so
+# their codes compare directly) and integers the smallest integer type.
+# Floats keep their precision, the API sends lr_probs and cellchat_pvals as
+# they were computed. Filters and lookups then work on integer codes.
+LIANA_SHARED_CATEGORIES = [
+    ["source", "target"],
+    ["ligand_complex", "receptor_complex"],
+]
+# Other string columns become categoricals when at most this fraction of their
+# values are distinct
+CATEGORICAL_MAX_UNIQUE_RATIO = 0.5
+# Only these columns are kept when set, None keeps them all. Columns with no
+# values are always dropped.
+LIANA_COLUMNS = None
+
+
+def categorical_values(series, categories=None):
+    # Categorical of a column, recoding its codes when it already is one
+    # instead of hashing every string again
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        values = series.array
+        if categories is not None:
+            values = values.set_categories(categories)
+        return values
+    return pd.Categorical(series.astype(str), categories=categories)
+
+
+def joined_categorical(left, sep, right):
+    # left + sep + right labels as a categorical, built from the codes of the
+    # two columns so each distinct pair is formatted once instead of once per
+    # row. Missing values read "nan" like astype(str) writes them.
+    left, right = categorical_values(left), categorical_values(right)
+    left_labels = np.append(left.categories.astype(str), "nan")
+    right_labels = np.append(right.categories.astype(str), "nan")
+    left_codes = np.where(left.codes < 0, len(left.categories), left.codes)
+    right_codes = np.where(right.codes < 0, len(right.categories), right.codes)
+    pairs, codes = np.unique(
+        left_codes.astype(np.int64) * len(right_labels) + right_codes,
+        return_inverse=True,
+    )
+    labels = [
+        f"{left_labels[pair // len(right_labels)]}{sep}"
+        f"{right_labels[pair % len(right_labels)]}"
+        for pair in pairs
+    ]
+    # Distinct pairs may still format to the same label, they share a code
+    categories, label_codes = np.unique(labels, return_inverse=True)
+    return pd.Categorical.from_codes(label_codes[codes], categories)
+
+
+def normalize_liana(df):
+    before = object_nbytes(df)
+    if LIANA_COLUMNS is not None:
+        df = df[[column for column in LIANA_COLUMNS if column in df.columns]]
+    df = df.dropna(axis=1, how="all")
+
+    columns = {}
+    for group in LIANA_SHARED_CATEGORIES:
+        group = [column for column in group if column in df.columns]
+        if not group:
+            continue
+        uniques = [pd.Series(df[column].dropna().unique()).astype(str) for column in group]
+        categories = pd.Index(pd.concat(uniques).unique()).sort_values()
+        for column in group:
+            values = df[column]
+            if not isinstance(values.dtype, pd.CategoricalDtype):
+                values = values.where(values.isna(), values.astype(str))
+            columns[column] = pd.Categorical(values, categories=categories)
+    for column in df.columns:
+        if column in columns:
+            continue
+        values = df[column]
+        if values.dtype == object:
+            if values.nunique() <= len(values) * CATEGORICAL_MAX_UNIQUE_RATIO:
+                columns[column] = values.astype("category")
+        elif pd.api.types.is_integer_dtype(values.dtype):
+            columns[column] = pd.to_numeric(values, downcast="integer")
+    df = df.assign(**columns)
+
+    after = object_nbytes(df)
+    logger.info(
+        "Normalized liana_annotated: %.1f MB -> %.1f MB", before / 1e6, after / 1e6
+    )
+    return df
+
+
+# uns key -> function applied to the value when it is loaded
+UNS_NORMALIZERS = {"liana_annotated": normalize_liana}
+
+
+class LazyDataFrame:
+    # obs/var columns of an AnnData zarr store, each read on first access as a
+    # Series indexed by the cell barcodes or gene names
+    def __init__(self, group):
+        self._group = group
+        self._index = None
+        self._columns = {}
+        self._lock = threading.Lock()
+        self.nbytes = 0
+
+    @property
+    def index(self):
+        if self._index is None:
+            index_key = self._group.attrs.get("_index", "_index")
+            with timed("io"):
+                self._index = pd.Index(read_elem(self._group[index_key]))
+            self.nbytes += object_nbytes(self._index)
+        return self._index
+
+    @property
+    def columns(self):
+        return list(self._group.attrs.get("column-order", []))
+
+    def __contains__(self, column):
+        return column in self.columns
+
+    def __getitem__(self, column):
+        series = self._columns.get(column)
+        if series is None:
+            with self._lock:
+                series = self._columns.get(column)
+                if series is None:
+                    if column not in self:
+                        raise KeyError(column)
+                    with timed("io"):
+                        values = read_elem(self._group[column])
+                    series = pd.Series(values, index=self.index, name=column)
+                    self._columns[column] = series
+                    self.nbytes += object_nbytes(series)
+        return series
+
+
+# uns entries that ingest.py also writes as parquet files in the uns directory,
+# read from there when pyarrow is installed
+UNS_SIDE_FILES = {"liana_annotated": "liana_annotated.parquet"}
+
+
+class LazyUns:
+    # uns entries of an AnnData zarr store, each read on first access
+    def __init__(self, group, path=None):
+        self._group = group
+        self._path = path
+        self._values = {}
+        self._lock = threading.Lock()
+        self.nbytes = 0
+
+    def keys(self):
+        return list(self._group.keys()) if self._group is not None else []
+
+    def __contains__(self, key):
+        return self._group is not None and key in self._group
+
+    def side_file(self, key):
+        if pq is None or self._path is None or key not in UNS_SIDE_FILES:
+            return None
+        path = os.path.join(self._path, UNS_SIDE_FILES[key])
+        return path if os.path.exists(path) else None
+
+    def __getitem__(self, key):
+        if key not in self._values:
+            with self._lock:
+                if key not in self._values:
+                    side_file = self.side_file(key)
+                    if side_file is None and key not in self:
+                        raise KeyError(key)
+                    with timed("io"):
+                        if side_file is not None:
+                            value = pq.read_table(side_file).to_pandas()
+                        else:
+                            value = read_elem(self._group[key])
+                    if key in UNS_NORMALIZERS:
+                        value = UNS_NORMALIZERS[key](value)
+                    self._values[key] = value
+                    self.nbytes += object_nbytes(self._values[key])
+        return self._values[key]
+
+
+class LazyAnnData:
+    # Read-only view of an AnnData zarr store that only loads the obs columns
+    # and uns keys the API asks for. X, obsm and layers stay on disk.
+    def __init__(self, zarr_path, fingerprint=None):
+        self.path = zarr_path
+        # Version of the store this view was opened on
+        self.fingerprint = fingerprint
+        self._root = zarr.open(zarr_path, mode="r")
+        self.obs = LazyDataFrame(self._root["obs"])
+        self.var = LazyDataFrame(self._root["var"])
+        self.uns = LazyUns(
+            self._root["uns"] if "uns" in self._root else None,
+            os.path.join(zarr_path, "uns"),
+        )
+
+    @property
+    def nbytes(self):
+        # Memory held by the obs/var columns and uns entries read so far
+        return self.obs.nbytes + self.var.nbytes + self.uns.nbytes
+
+    @property
+    def obs_names(self):
+        return self.obs.index
+
+    @property
+    def n_obs(self):
+        return len(self.obs.index)
+
+    @property
+    def var_names(self):
+        return self.var.index
+
+    def read_var_columns(self, positions):
+        # Columns of X for some genes, as an (n_obs, len(positions)) CSC matrix.
+        # Only the column slices are read when X is stored CSC or dense.
+        X = self._root["X"]
+        positions = np.asarray(positions)
+        order = np.argsort(positions)
+        with timed("io"):
+            if X.attrs.get("encoding-type") in ("csc_matrix", "csr_matrix"):
+                columns = sparse_dataset(X)[:, positions[order]]
+            else:
+                columns = np.stack(
+                    [X[:, position] for position in positions[order]], axis=1
+                )
+        # Back to the requested order
+        return sp.csc_matrix(columns)[:, np.argsort(order)]
+
+    def __repr__(self):
+        return (
+            f"LazyAnnData object backed by '{self.path}'\n"
+            f"    obs: {', '.join(repr(c) for c in self.obs.columns)}\n"
+            f"    uns: {', '.join(repr(k) for k in self.uns.keys())}\n"
+            f"    on disk: {', '.join(k for k in self._root.keys() if k not in ('obs', 'uns'))}"
+        )
+
+
+dataset_registry = {}
+dataset_registry_mtime = None
+
+
+def get_dataset_registry():
+    # Registered datasets, DATASETS_FILE is re-read whenever it changes
+    global dataset_registry, dataset_registry_mtime
+    try:
+        mtime = os.stat(DATASETS_FILE).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    if dataset_registry and mtime == dataset_registry_mtime:
+        return dataset_registry
+
+    registry = {
+        DEFAULT_DATASET: {
+            "merged_zarr_file": MERGED_ZARR_FILE,
+            "xenium_zarr_file": XENIUM_ZARR_FILE,
+            "name": "Breast Cancer Multi-Modal",
+            "description": DESCRIPTION,
+        }
+    }
+    if mtime is not None:
+        try:
+            with open(DATASETS_FILE, "r") as f:
+                registry.update(json.load(f))
+        except Exception as e:
+            logger.exception("Error reading dataset registry %s: %s", DATASETS_FILE, e)
+    dataset_registry = registry
+    dataset_registry_mtime = mtime
+    return dataset_registry
+
+
+def request_dataset():
+    return request.args.get("dataset", DEFAULT_DATASET)
+
+
+def int_arg(args, name, default=None):
+    # Integer query parameter, ValueError instead of the default when the
+    # client sent something else
+    value = args.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"'{name}' must be an integer") from None
+
+
+def float_arg(args, name, default=None):
+    value = args.get(name)
+    if value is None:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError(f"'{name}' must be a number") from None
+
+
+def error_message(e):
+    # Message of a KeyError/ValueError without the quotes str(KeyError) adds
+    return str(e.args[0]) if e.args else str(e)
+
+
+# dataset id -> {"adata", "fingerprint", "checked"}, least recently used first
+dataset_cache = OrderedDict()
+dataset_cache_stats = {"hits": 0, "misses": 0, "reloads": 0, "evictions": 0}
+# Guards dataset_cache and view_cache
+cache_lock = threading.RLock()
+
+
+def get_dataset(dataset_id=None):
+    # Lazily opened dataset for a registry id, reopened (dropping its cached
+    # views) when its zarr file changed on disk. None if the file is missing.
+    dataset_id = dataset_id or DEFAULT_DATASET
+    now = time.monotonic()
+    with cache_lock:
+        entry = dataset_cache.get(dataset_id)
+        if entry is not None:
+            dataset_cache.move_to_end(dataset_id)
+            if now - entry["checked"] < FINGERPRINT_TTL:
+                dataset_cache_stats["hits"] += 1
+                return entry["adata"]
+
+        spec = get_dataset_registry().get(dataset_id)
+        if spec is None:
+            raise KeyError(f"Unknown dataset '{dataset_id}'")
+    zarr_path = os.path.join(BASE_DIR, spec["merged_zarr_file"])
+    # Stat-ing the store can take a while, other datasets are served meanwhile
+    fingerprint = dataset_fingerprint(zarr_path)
+
+    with cache_lock:
+        entry = dataset_cache.get(dataset_id)
+        if entry is not None:
+            if fingerprint in (entry["fingerprint"], None) or entry["checked"] > now:
+                # Unchanged, or already reopened by a request checked later
+                entry["checked"] = max(entry["checked"], now)
+                dataset_cache_stats["hits"] += 1
+                return entry["adata"]
+            logger.info("Zarr file %s changed on disk, reloading", spec["merged_zarr_file"])
+            dataset_cache_stats["reloads"] += 1
+            drop_dataset(dataset_id)
+        else:
+            dataset_cache_stats["misses"] += 1
+
+        if fingerprint is None:
+            logger.warning("Zarr file %s not found", zarr_path)
+            return None
+        adata = LazyAnnData(zarr_path, fingerprint)
+        logger.debug("Opened %r", adata)
+        dataset_cache[dataset_id] = {
+            "adata": adata,
+            "fingerprint": fingerprint,
+            "checked": now,
+        }
+        enforce_dataset_budget(keep=dataset_id)
+        return adata
+
+
+def drop_dataset(dataset_id):
+    # Forget a dataset, its cached views and the compute locks keyed by them.
+    # Locks of other datasets are kept, threads may be holding them.
+    with cache_lock:
+        dataset_cache.pop(dataset_id, None)
+        owners = {dataset_id}
+        for key in [key for key in view_cache if key[0] == dataset_id]:
+            owners.add(id(view_cache.pop(key)))
+        for key in [key for key in compute_locks if key[0] in owners]:
+            del compute_locks[key]
+
+
+def dataset_nbytes(dataset_id):
+    # Loaded obs/uns data plus the cached views and their encoded bodies
+    entry = dataset_cache.get(dataset_id)
+    nbytes = entry["adata"].nbytes if entry is not None else 0
+    for key, view in view_cache.items():
+        if key[0] == dataset_id:
+            nbytes += view.get("nbytes", 0)
+    return nbytes
+
+
+def trim_dataset_results(dataset_id, excess):
+    # Drop the least recently used cached results of a dataset, from its
+    # largest result cache first, until excess bytes are freed. Called with
+    # cache_lock held.
+    caches = [
+        view
+        for key, view in view_cache.items()
+        if key[0] == dataset_id and isinstance(view, dict) and view.get("results")
+    ]
+    while excess > 0 and caches:
+        cache = max(caches, key=results_nbytes)
+        _, evicted = cache["results"].popitem(last=False)
+        excess -= evicted.get("nbytes", 0)
+        cache["nbytes"] = cache.get("base_nbytes", 0) + results_nbytes(cache)
+        if not cache["results"]:
+            caches.remove(cache)
+
+
+def enforce_dataset_budget(keep=None):
+    # Close least recently used datasets until the cache fits its budget,
+    # the dataset currently in use is never evicted. When it alone is over
+    # the budget, its cached results are dropped instead.
+    with cache_lock:
+        sizes = {dataset_id: dataset_nbytes(dataset_id) for dataset_id in dataset_cache}
+        total = sum(sizes.values())
+        for dataset_id in list(dataset_cache):
+            if total <= DATASET_CACHE_MAX_BYTES:
+                break
+            if dataset_id == keep:
+                continue
+            logger.info("Evicting dataset %s (%d bytes)", dataset_id, sizes[dataset_id])
+            drop_dataset(dataset_id)
+            dataset_cache_stats["evictions"] += 1
+            total -= sizes[dataset_id]
+        if keep in sizes and total > DATASET_CACHE_MAX_BYTES:
+            trim_dataset_results(keep, total - DATASET_CACHE_MAX_BYTES)
+
+
+# Filtered views over uns["liana_annotated"] shared by the table endpoints.
+# Each view is a list of (column, operator, value) masks applied in order, an
+# optional column projection and optional categorical columns derived by
+# joining two columns with a separator.
+FILTER_OPS = {
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+
+LIANA_VIEWS = {
+    "data-table": {"filters": [("lr_probs", ">", 0)]},
+    "prop-freq": {
+        "filters": [
+            ("pathway_name", "!=", "Unknown"),
+            ("lr_probs", ">", 0),
+            ("cellchat_pvals", "<=", 0.05),
+        ]
+    },
+    "sankey": {"filters": []},
+    "circos": {"filters": [("lr_probs", ">", 0), ("cellchat_pvals", "<=", 0.05)]},
+    "cellchat-data": {
+        "filters": [("lr_probs", ">", 0)],
+        "columns": ["source", "target"],
+    },
+    "bubble": {
+        "filters": [("lr_probs", ">", 0)],
+        "derived": {
+            "Interacting_Pair": ("source", " -> ", "target"),
+            "Interaction": ("ligand_complex", " - ", "receptor_complex"),
+        },
+    },
+}
+# Separators of the JSON bodies serialized here, without the spaces
+# json.dumps puts after "," and ":" by default
+JSON_SEPARATORS = (",", ":")
+# Aggregates kept per dataset, and the largest top_n/top_pairs accepted
+AGGREGATE_CACHE_SIZE = 64
+AGGREGATE_MAX_TOP = 100
+# Views with more rows than this are streamed in STREAM_CHUNK_ROWS slices
+# instead of being serialized and cached as a single JSON body
+STREAM_MIN_ROWS = 50000
+STREAM_CHUNK_ROWS = 10000
+
+# (dataset id, view name) -> {"frame", "body", "etag", "nbytes"}
+view_cache = {}
+# One lock per cache key, so a slow view is computed once without holding
+# cache_lock and blocking requests for other keys
+compute_locks = {}
+
+
+def compute_lock(key):
+    with cache_lock:
+        return compute_locks.setdefault(key, threading.Lock())
+
+
+def filter_mask(values, op, value):
+    if isinstance(values.dtype, pd.CategoricalDtype) and op not in ("==", "!="):
+        # Unordered categoricals only compare for equality, ordering compares
+        # the labels
+        values = values.astype(str)
+    return FILTER_OPS[op](values, value)
+
+
+def apply_view_filters(df, filters):
+    for column, op, value in filters:
+        df = df[filter_mask(df[column], op, value)]
+    return df
+
+
+def get_liana_view(view_name, dataset_id=None):
+    # Filtered DataFrame and serialized JSON for a view, computed once per
+    # version of the zarr file. Returns None when the LIANA results are missing.
+    dataset_id = dataset_id or DEFAULT_DATASET
+    adata = get_dataset(dataset_id)
+    key = (dataset_id, view_name)
+    entry = view_cache.get(key)
+    count_cache("views", entry is not None)
+    if entry is not None:
+        return entry
+
+    with compute_lock(key):
+        entry = view_cache.get(key)
+        if entry is not None:
+            return entry
+        if adata is None or "liana_annotated" not in adata.uns:
+            return None
+
+        spec = LIANA_VIEWS[view_name]
+        liana = adata.uns["liana_annotated"]
+        with timed("filter"):
+            df = apply_view_filters(liana, spec["filters"])
+        if spec.get("columns"):
+            df = df[spec["columns"]]
+        if spec.get("derived"):
+            df = df.assign(
+                **{
+                    name: joined_categorical(df[left], sep, df[right])
+                    for name, (left, sep, right) in spec["derived"].items()
+                }
+            )
+        if len(df) > STREAM_MIN_ROWS:
+            # Streamed on request, tagged by the dataset version instead of
+            # a hash of a body that is never built
+            body = None
+            etag = hashlib.sha1(
+                f"{adata.fingerprint}:{view_name}".encode()
+            ).hexdigest()
+        else:
+            with timed("serialize"):
+                body = df.to_json(orient="records").encode("utf-8")
+            etag = hashlib.sha1(body).hexdigest()
+        entry = {
+            "frame": df,
+            "body": body,
+            "etag": etag,
+            "nbytes": object_nbytes(df) + len(body or b""),
+        }
+        with cache_lock:
+            view_cache[key] = entry
+            enforce_dataset_budget(keep=dataset_id)
+        return entry
+
+
+def get_liana_aggregate(view_name, aggregate, dataset_id=None, **params):
+    # Aggregated structure computed from a cached view, stored next to the
+    # views so it is dropped together with them when the zarr file changes.
+    # The AGGREGATE_CACHE_SIZE most recently used parameter sets are kept.
+    dataset_id = dataset_id or DEFAULT_DATASET
+    view = get_liana_view(view_name, dataset_id)
+    if view is None:
+        return None
+    key = (view_name, aggregate.__name__, tuple(sorted(params.items())))
+    with cache_lock:
+        cache = view_cache.setdefault(
+            (dataset_id, "aggregates"), {"results": OrderedDict(), "nbytes": 0}
+        )
+        entry = cache["results"].get(key)
+        if entry is not None:
+            cache["results"].move_to_end(key)
+    count_cache("aggregates", entry is not None)
+    if entry is not None:
+        return entry
+
+    with compute_lock((dataset_id,) + key):
+        entry = cache["results"].get(key)
+        if entry is not None:
+            return entry
+        with timed("filter"):
+            result = aggregate(view["frame"], **params)
+        with timed("serialize"):
+            body = json.dumps(result, separators=JSON_SEPARATORS).encode("utf-8")
+        entry = {
+            "body": body,
+            "etag": hashlib.sha1(body).hexdigest(),
+            "nbytes": len(body),
+        }
+        with cache_lock:
+            store_cached_result(cache, key, entry, AGGREGATE_CACHE_SIZE)
+            enforce_dataset_budget(keep=dataset_id)
+        return entry
+
+
+def results_nbytes(cache):
+    return sum(result.get("nbytes", 0) for result in cache["results"].values())
+
+
+def store_cached_result(cache, key, entry, size, max_bytes=None):
+    # Insert into a {"results": OrderedDict, "nbytes"} cache entry, dropping
+    # the least recently used results beyond size entries or max_bytes. An
+    # optional "base_nbytes" counts what the entry holds besides its results.
+    # Called with cache_lock held.
+    results = cache["results"]
+    results[key] = entry
+    results.move_to_end(key)
+    nbytes = results_nbytes(cache)
+    while results and (
+        len(results) > size or (max_bytes is not None and nbytes > max_bytes)
+    ):
+        _, evicted = results.popitem(last=False)
+        nbytes -= evicted.get("nbytes", 0)
+    cache["nbytes"] = cache.get("base_nbytes", 0) + nbytes
+
+
+def heatmap_payload(counts):
+    # Source x target matrix made square over the union of source and target
+    # cell types
+    labels = sorted(set(counts.index) | set(counts.columns))
+    counts = counts.reindex(index=labels, columns=labels, fill_value=0)
+    return {
+        "labels": labels,
+        "matrix": counts.to_numpy().tolist(),
+        "totals": counts.sum(axis=1).tolist(),
+    }
+
+
+def pathway_proportion_payload(counts, top_n):
+    # Proportion of each of the top_n most frequent pathways within each group,
+    # normalised over the top_n pathways only, from a group x pathway count
+    # matrix. Pathways with the same count are ranked by name.
+    pathway_counts = counts.sum(axis=0).sort_index()
+    pathway_counts = pathway_counts.sort_values(ascending=False, kind="stable")
+    top_pathways = list(pathway_counts.index[:top_n])
+
+    counts = counts.reindex(columns=top_pathways, fill_value=0).sort_index()
+    totals = counts.sum(axis=1)
+    proportions = counts.div(totals.where(totals > 0, 1), axis=0)
+
+    # Pathways ordered by their summed proportion across groups, as plotted
+    order = proportions.sum(axis=0).sort_values(ascending=False, kind="stable")
+    proportions = proportions[order.index]
+    counts = counts[order.index]
+    return {
+        "groups": list(proportions.index),
+        "pathways": list(proportions.columns),
+        "proportions": proportions.to_numpy().tolist(),
+        "counts": counts.to_numpy().tolist(),
+        "pathway_totals": pathway_counts[list(order.index)].tolist(),
+    }
+
+
+def aggregate_pathway_proportion(df, group_by, pathway, top_n):
+    if group_by not in df.columns or pathway not in df.columns:
+        raise KeyError(f"Column '{group_by}' or '{pathway}' not found")
+    counts = pd.crosstab(df[group_by].astype(str), df[pathway].astype(str))
+    return pathway_proportion_payload(counts, top_n)
+
+
+# Threshold cubes of uns["liana_annotated"]: one 2-D cube per pair of
+# dimensions the plots group by. Every interaction is keyed by its cell in
+# the cube and the rank of its lr_probs among the distinct lr_probs values.
+# For each cellchat_pvals level the keys are sorted (the source x target cube
+# also carries a running sum of lr_probs), so the number and summed lr_probs
+# of the interactions above any lr_probs threshold, in every cell at once,
+# take two binary searches. A level is identified by the number of distinct
+# p-values it keeps (None keeps every interaction), so every pvalue_max
+# between two distinct p-values maps to the same level.
+LIANA_CUBE_KEY = "liana_cube"
+# Cube name -> (first, second) dimension, pathways include an extra last
+# pathway holding the interactions without one
+CUBE_DIMENSIONS = {
+    "pair": ("source", "target"),
+    "source_pathway": ("source", "pathway"),
+    "target_pathway": ("target", "pathway"),
+}
+# Cubes carrying the running sum of lr_probs
+CUBE_SUMS = ["pair"]
+# cellchat_pvals levels precomputed at ingest or when the cube is built, they
+# are never evicted
+CUBE_PVALUE_LEVELS = [None, 0.01, 0.05]
+# Levels kept per dataset, the least recently used other levels are evicted
+CUBE_MAX_LEVELS = 16
+# Pathway left out of the pathway proportions, as in the "prop-freq" view
+UNKNOWN_PATHWAY = "Unknown"
+
+
+def column_labels(series):
+    return pd.Index(pd.Series(series.dropna().unique()).astype(str).unique())
+
+
+def cube_level_key(cube, pvalue_max):
+    if pvalue_max is None:
+        return None
+    pvalue_values = cube["pvalue_values"]
+    return int(
+        np.searchsorted(pvalue_values, pvalue_values.dtype.type(pvalue_max), side="right")
+    )
+
+
+def cube_prob_rank(cube, prob_min):
+    # Number of distinct lr_probs values at or below prob_min
+    prob_values = cube["prob_values"]
+    return int(
+        np.searchsorted(prob_values, prob_values.dtype.type(prob_min), side="right")
+    )
+
+
+def cube_shape(cube, name):
+    sizes = {
+        "source": len(cube["cell_types"]),
+        "target": len(cube["cell_types"]),
+        "pathway": len(cube["pathways"]) + 1,
+    }
+    first, second = CUBE_DIMENSIONS[name]
+    return sizes[first], sizes[second]
+
+
+def liana_cube_rows(df, cube):
+    # Keys, cellchat_pvals ranks and lr_probs of every interaction with a
+    # source, target and lr_probs, sorted by key once per cube so that any
+    # level is a masked copy. Missing p-values rank after every level.
+    codes = {
+        column: np.asarray(categorical_values(df[column], cube["cell_types"]).codes)
+        for column in ("source", "target")
+    }
+    pathway = np.asarray(categorical_values(df["pathway_name"], cube["pathways"]).codes)
+    codes["pathway"] = np.where(pathway >= 0, pathway, len(cube["pathways"]))
+    probs = df["lr_probs"].to_numpy()
+    pvalues = df["cellchat_pvals"].to_numpy()
+    keep = (codes["source"] >= 0) & (codes["target"] >= 0) & ~np.isnan(probs)
+    probs = probs[keep]
+    prob_ranks = np.searchsorted(cube["prob_values"], probs)
+    pvalue_ranks = np.where(
+        np.isnan(pvalues[keep]),
+        len(cube["pvalue_values"]),
+        np.searchsorted(cube["pvalue_values"], pvalues[keep]),
+    ).astype(np.int32)
+    n_probs = len(cube["prob_values"])
+    rows = {}
+    for name, (first, second) in CUBE_DIMENSIONS.items():
+        _, n_second = cube_shape(cube, name)
+        cells = codes[first][keep].astype(np.int64) * n_second + codes[second][keep]
+        keys = cells * (n_probs + 1) + prob_ranks
+        order = np.argsort(keys, kind="stable")
+        rows[name] = {"keys": keys[order], "pvalue_ranks": pvalue_ranks[order]}
+        if name in CUBE_SUMS:
+            rows[name]["probs"] = probs[order]
+    return rows
+
+
+def build_cube_level(rows, level):
+    # Keys (and running sums) of the interactions of a level, in linear time
+    # since the rows are already sorted
+    cubes = {}
+    for name, sorted_rows in rows.items():
+        keep = None if level is None else sorted_rows["pvalue_ranks"] < level
+        keys = sorted_rows["keys"]
+        cubes[name] = {"keys": keys if keep is None else keys[keep]}
+        if "probs" in sorted_rows:
+            probs = sorted_rows["probs"] if keep is None else sorted_rows["probs"][keep]
+            cubes[name]["cumsum"] = np.concatenate(
+                [[0.0], np.cumsum(probs, dtype=np.float64)]
+            )
+    return cubes
+
+
+def build_liana_cube(df, levels=CUBE_PVALUE_LEVELS):
+    probs = df["lr_probs"].to_numpy()
+    pvalues = df["cellchat_pvals"].to_numpy()
+    cube = {
+        "cell_types": column_labels(df["source"])
+        .union(column_labels(df["target"]))
+        .sort_values(),
+        "pathways": column_labels(df["pathway_name"]).sort_values(),
+        "prob_values": np.unique(probs[~np.isnan(probs)]),
+        "pvalue_values": np.unique(pvalues[~np.isnan(pvalues)]),
+        "levels": OrderedDict(),
+    }
+    cube["rows"] = liana_cube_rows(df, cube)
+    for pvalue_max in levels:
+        level = cube_level_key(cube, pvalue_max)
+        cube["levels"][level] = build_cube_level(cube["rows"], level)
+    return cube
+
+
+def cube_to_uns(cube):
+    # Mapping written to uns[LIANA_CUBE_KEY], without the per-row arrays
+    return {
+        "cell_types": np.asarray(cube["cell_types"], dtype=str),
+        "pathways": np.asarray(cube["pathways"], dtype=str),
+        "prob_values": cube["prob_values"],
+        "pvalue_values": cube["pvalue_values"],
+        "levels": {
+            "all" if level is None else str(level): cubes
+            for level, cubes in cube["levels"].items()
+        },
+    }
+
+
+def cube_from_uns(value):
+    return {
+        "cell_types": pd.Index([str(label) for label in value["cell_types"]]),
+        "pathways": pd.Index([str(label) for label in value["pathways"]]),
+        "prob_values": np.asarray(value["prob_values"]),
+        "pvalue_values": np.asarray(value["pvalue_values"]),
+        "levels": OrderedDict(
+            (
+                None if name == "all" else int(name),
+                {
+                    cube_name: {
+                        array_name: np.asarray(array)
+                        for array_name, array in arrays.items()
+                    }
+                    for cube_name, arrays in cubes.items()
+                },
+            )
+            for name, cubes in value["levels"].items()
+        ),
+    }
+
+
+def cube_nbytes(cube):
+    # Levels without a p-value threshold share their arrays with the rows
+    arrays = {id(a): a for a in [cube["prob_values"], cube["pvalue_values"]]}
+    for cubes in list(cube["levels"].values()) + [cube.get("rows", {})]:
+        for values in cubes.values():
+            arrays.update((id(a), a) for a in values.values())
+    return sum(a.nbytes for a in arrays.values())
+
+
+def get_liana_cube(dataset_id):
+    # Cube of a dataset, read from the ingest output when present, otherwise
+    # built from the table once per dataset version. Returns None when the
+    # LIANA results are missing.
+    adata = get_dataset(dataset_id)
+    key = (dataset_id, "liana-cube")
+    cube = view_cache.get(key)
+    if cube is None:
+        with compute_lock(key):
+            cube = view_cache.get(key)
+            if cube is None:
+                if adata is None:
+                    return None
+                if LIANA_CUBE_KEY in adata.uns:
+                    cube = cube_from_uns(adata.uns[LIANA_CUBE_KEY])
+                elif "liana_annotated" in adata.uns:
+                    with timed("filter"):
+                        cube = build_liana_cube(adata.uns["liana_annotated"])
+                else:
+                    return None
+                cube["pinned"] = {
+                    cube_level_key(cube, pvalue_max)
+                    for pvalue_max in CUBE_PVALUE_LEVELS
+                }
+                cube["nbytes"] = cube_nbytes(cube)
+                with cache_lock:
+                    view_cache[key] = cube
+                    enforce_dataset_budget(keep=dataset_id)
+    return cube
+
+
+def get_cube_level(dataset_id, cube, level_key):
+    # Level of a cube, built from the sorted rows on first use. Beyond
+    # CUBE_MAX_LEVELS the least recently used unpinned level is evicted.
+    with cache_lock:
+        level = cube["levels"].get(level_key)
+        if level is not None:
+            cube["levels"].move_to_end(level_key)
+    count_cache("cube-levels", level is not None)
+    if level is not None:
+        return level
+    with compute_lock((dataset_id, "liana-cube", level_key)):
+        level = cube["levels"].get(level_key)
+        if level is not None:
+            return level
+        if "rows" not in cube:
+            df = get_dataset(dataset_id).uns["liana_annotated"]
+            with timed("filter"):
+                rows = liana_cube_rows(df, cube)
+            with cache_lock:
+                cube.setdefault("rows", rows)
+        with timed("filter"):
+            level = build_cube_level(cube["rows"], level_key)
+        with cache_lock:
+            levels = cube["levels"]
+            levels[level_key] = level
+            evictable = [key for key in levels if key not in cube["pinned"]]
+            while len(levels) > CUBE_MAX_LEVELS and evictable:
+                del levels[evictable.pop(0)]
+            cube["nbytes"] = cube_nbytes(cube)
+            enforce_dataset_budget(keep=dataset_id)
+    return level
+
+
+def cube_counts(cube, level, name, prob_rank):
+    # Number and summed lr_probs (None for cubes without sums) of the
+    # interactions of a level above the lr_probs rank, as 2-D arrays
+    shape = cube_shape(cube, name)
+    n_probs = len(cube["prob_values"])
+    keys = level[name]["keys"]
+    base = np.arange(shape[0] * shape[1], dtype=np.int64) * (n_probs + 1)
+    start = np.searchsorted(keys, base + prob_rank)
+    end = np.searchsorted(keys, base + n_probs + 1)
+    counts = (end - start).reshape(shape)
+    if "cumsum" not in level[name]:
+        return counts, None
+    cumsum = level[name]["cumsum"]
+    return counts, (cumsum[end] - cumsum[start]).reshape(shape)
+
+
+def cube_heatmap(cube, level, prob_rank, value="count"):
+    # Interactions (or their summed lr_probs) for every source x target pair
+    counts, sums = cube_counts(cube, level, "pair", prob_rank)
+    matrix = pd.DataFrame(
+        counts if value == "count" else sums,
+        index=cube["cell_types"],
+        columns=cube["cell_types"],
+    )
+    return heatmap_payload(matrix.loc[counts.sum(axis=1) > 0, counts.sum(axis=0) > 0])
+
+
+def cube_pathway_proportion(cube, level, prob_rank, group_by, top_n):
+    counts, _ = cube_counts(cube, level, f"{group_by}_pathway", prob_rank)
+    counts = pd.DataFrame(
+        counts[:, :-1], index=cube["cell_types"], columns=cube["pathways"]
+    ).drop(columns=[UNKNOWN_PATHWAY], errors="ignore")
+    return pathway_proportion_payload(
+        counts.loc[counts.sum(axis=1) > 0, counts.sum(axis=0) > 0], top_n
+    )
+
+
+def aggregate_circos(df, top_pairs):
+    # Chord matrix of summed lr_probs between "<cell> (source)" and
+    # "<cell> (target)" nodes, with interaction counts and the strongest
+    # ligand-receptor pairs of every chord for the tooltips
+    source = df["source"].astype(str) + " (source)"
+    target = df["target"].astype(str) + " (target)"
+    nodes = list(dict.fromkeys(list(source.unique()) + list(target.unique())))
+    index = {node: i for i, node in enumerate(nodes)}
+
+    frame = pd.DataFrame(
+        {
+            "i": source.map(index).to_numpy(),
+            "j": target.map(index).to_numpy(),
+            "prob": pd.to_numeric(df["lr_probs"], errors="coerce").fillna(0).to_numpy(),
+            "ligand": df["ligand_complex"].astype(str).to_numpy(),
+            "receptor": df["receptor_complex"].astype(str).to_numpy(),
+        }
+    )
+    grouped = frame.groupby(["i", "j"], sort=False)["prob"].agg(["sum", "count"])
+
+    matrix = np.zeros((len(nodes), len(nodes)))
+    matrix[grouped.index.get_level_values(0), grouped.index.get_level_values(1)] = grouped[
+        "sum"
+    ].to_numpy()
+
+    strongest = (
+        frame.sort_values("prob", ascending=False, kind="stable")
+        .groupby(["i", "j"], sort=False)
+        .head(top_pairs)
+    )
+    details = {}
+    for (i, j), count in grouped["count"].items():
+        details[f"{i}-{j}"] = {"count": int(count), "ligrecPairs": []}
+    for row in strongest.itertuples(index=False):
+        details[f"{row.i}-{row.j}"]["ligrecPairs"].append(
+            {"ligand": row.ligand, "receptor": row.receptor, "prob": float(row.prob)}
+        )
+    return {"cell_types": nodes, "matrix": matrix.tolist(), "details": details}
+
+
+# Query parameters that switch /data-table from the full table to one page
+PAGE_PARAMS = ["offset", "limit", "sort_by", "sort_dir", "columns", "filter"]
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 10000
+# Longest operators first so ">=" is not read as ">"
+FILTER_PATTERN = re.compile(
+    r"^(?P<column>[^<>=!]+)(?P<op>"
+    + "|".join(re.escape(op) for op in sorted(FILTER_OPS, key=len, reverse=True))
+    + r")(?P<value>.*)$"
+)
+
+
+def parse_filter_value(frame, column, op, value):
+    # Numbers for numeric columns, labels compared with == or != for the
+    # others, as /query's parse_query_filter
+    if pd.api.types.is_numeric_dtype(frame[column].dtype):
+        try:
+            return float(value)
+        except ValueError:
+            raise ValueError(f"'{column}' is numeric, '{value}' is not a number")
+    if op not in ("==", "!="):
+        raise ValueError(f"'{op}' needs a numeric column, '{column}' is categorical")
+    return value
+
+
+def parse_view_filters(expressions, frame):
+    # "column<op>value" expressions, e.g. lr_probs>=0.5 or source==B cells
+    filters = []
+    for expression in expressions:
+        match = FILTER_PATTERN.match(expression)
+        if match is None:
+            raise ValueError(f"Invalid filter '{expression}'")
+        column = match.group("column").strip()
+        if column not in frame.columns:
+            raise KeyError(f"Column '{column}' not found")
+        op = match.group("op")
+        filters.append(
+            (column, op, parse_filter_value(frame, column, op, match.group("value")))
+        )
+    return filters
+
+
+def get_sort_order(entry, column, descending):
+    # Row positions of the view sorted by a column, computed once per column.
+    # Descending order reverses the stable ascending order, NaNs stay last.
+    orders = entry.setdefault("sort_orders", {})
+    order = orders.get(column)
+    if order is None:
+        with compute_lock((id(entry), "sort", column)):
+            order = orders.get(column)
+            if order is None:
+                values = entry["frame"][column].reset_index(drop=True)
+                sorted_values = values.sort_values(kind="stable", na_position="last")
+                order = {
+                    "order": sorted_values.index.to_numpy(),
+                    "nan_count": int(values.isna().sum()),
+                }
+                orders[column] = order
+    positions = order["order"]
+    if descending:
+        valid = positions[: len(positions) - order["nan_count"]]
+        positions = np.concatenate([valid[::-1], positions[len(valid) :]])
+    return positions
+
+
+def page_bounds(args):
+    offset = int_arg(args, "offset", 0)
+    limit = int_arg(args, "limit", DEFAULT_PAGE_LIMIT)
+    if offset < 0 or not 0 < limit <= MAX_PAGE_LIMIT:
+        raise ValueError(
+            f"'offset' must be >= 0 and 'limit' between 1 and {MAX_PAGE_LIMIT}"
+        )
+    return offset, limit
+
+
+def page_liana_view(entry, args):
+    # One page of a cached view: predicates, then sort, then offset/limit and
+    # column projection. Returns the page frame and the filtered row count.
+    df = entry["frame"]
+    offset, limit = page_bounds(args)
+    sort_dir = args.get("sort_dir", "asc")
+    if sort_dir not in ("asc", "desc"):
+        raise ValueError("'sort_dir' must be 'asc' or 'desc'")
+
+    columns = [c for c in args.get("columns", "").split(",") if c]
+    for column in columns:
+        if column not in df.columns:
+            raise KeyError(f"Column '{column}' not found")
+    filters = parse_view_filters(args.getlist("filter"), df)
+
+    sort_by = args.get("sort_by")
+    if sort_by is not None:
+        if sort_by not in df.columns:
+            raise KeyError(f"Column '{sort_by}' not found")
+        positions = get_sort_order(entry, sort_by, sort_dir == "desc")
+    else:
+        positions = np.arange(len(df))
+
+    if filters:
+        mask = np.ones(len(df), dtype=bool)
+        for column, op, value in filters:
+            mask &= filter_mask(df[column], op, value).to_numpy(dtype=bool)
+        positions = positions[mask[positions]]
+
+    page = df.iloc[positions[offset : offset + limit]]
+    if columns:
+        page = page[columns]
+    return page, len(positions)
+
+
+# Query parameter of /bubble -> column of the "bubble" view it filters on
+BUBBLE_FILTERS = {
+    "source": "source",
+    "target": "target",
+    "ligand": "ligand_complex",
+    "receptor": "receptor_complex",
+    "pathway": "pathway_name",
+}
+
+
+def get_bubble_index(dataset_id=None):
+    # Categorical codes of the filterable columns of the "bubble" view, built
+    # once per dataset version so /bubble filters are integer lookups
+    dataset_id = dataset_id or DEFAULT_DATASET
+    view = get_liana_view("bubble", dataset_id)
+    if view is None:
+        return None
+    key = (dataset_id, "bubble-index")
+    entry = view_cache.get(key)
+    if entry is not None:
+        return entry
+
+    with compute_lock(key):
+        entry = view_cache.get(key)
+        if entry is not None:
+            return entry
+        frame = view["frame"]
+        columns = {}
+        for column in set(BUBBLE_FILTERS.values()) | {"Interacting_Pair", "Interaction"}:
+            if column in frame.columns:
+                values = categorical_values(frame[column])
+                columns[column] = {
+                    "codes": np.asarray(values.codes),
+                    "categories": values.categories,
+                }
+        entry = {
+            "columns": columns,
+            "nbytes": sum(c["codes"].nbytes for c in columns.values()),
+        }
+        with cache_lock:
+            view_cache[key] = entry
+        return entry
+
+
+def query_bubble(dataset_id, filters, prob_column, pvalue_column, pvalue_max, top_k):
+    # Bubbles matching every filter list and the p-value threshold, strongest
+    # first, keeping at most top_k per Interacting_Pair
+    view = get_liana_view("bubble", dataset_id)
+    index = get_bubble_index(dataset_id)
+    frame = view["frame"]
+    for column in (prob_column, pvalue_column):
+        if column not in frame.columns:
+            raise KeyError(f"Column '{column}' not found")
+        if not pd.api.types.is_numeric_dtype(frame[column].dtype):
+            raise ValueError(f"'{column}' is categorical, a numeric column is needed")
+
+    mask = np.ones(len(frame), dtype=bool)
+    for column, values in filters.items():
+        if column not in index["columns"]:
+            raise KeyError(f"Column '{column}' not found")
+        codes = index["columns"][column]["codes"]
+        categories = index["columns"][column]["categories"]
+        wanted = categories.get_indexer(pd.Index(values))
+        # Appended False so that missing values (code -1) never match
+        lookup = np.zeros(len(categories) + 1, dtype=bool)
+        lookup[wanted[wanted >= 0]] = True
+        mask &= lookup[codes]
+
+    probs = pd.to_numeric(frame[prob_column], errors="coerce").to_numpy()
+    if pvalue_max is not None:
+        pvalues = pd.to_numeric(frame[pvalue_column], errors="coerce").to_numpy()
+        mask &= pvalues <= pvalue_max
+    rows = np.flatnonzero(mask)
+    rows = rows[np.argsort(-probs[rows], kind="stable")]
+
+    pair_codes = index["columns"]["Interacting_Pair"]["codes"][rows]
+    if top_k is not None:
+        rank = pd.Series(pair_codes).groupby(pair_codes).cumcount().to_numpy()
+        rows = rows[rank < top_k]
+        pair_codes = pair_codes[rank < top_k]
+    interaction_codes = index["columns"]["Interaction"]["codes"][rows]
+
+    # Axis labels in order of first appearance, points refer to them by index
+    pair_axis = pd.Index(pd.unique(pair_codes))
+    interaction_axis = pd.Index(pd.unique(interaction_codes))
+    pvalues = pd.to_numeric(frame[pvalue_column], errors="coerce").iloc[rows]
+    return {
+        "total": int(mask.sum()),
+        "pairs": list(index["columns"]["Interacting_Pair"]["categories"][pair_axis]),
+        "interactions": list(
+            index["columns"]["Interaction"]["categories"][interaction_axis]
+        ),
+        "points": {
+            "pair": pair_axis.get_indexer(pair_codes).tolist(),
+            "interaction": interaction_axis.get_indexer(interaction_codes).tolist(),
+            "prob": np.nan_to_num(probs[rows]).tolist(),
+            "pvalue": pvalues.astype(object).where(pvalues.notna(), None).tolist(),
+        },
+    }
+
+
+# Generic query over uns["liana_annotated"]:
+#   /query?where=lr_probs>=0.5&where=cellchat_pvals<=0.01
+#         &where=source in B cells,T cells&group_by=source,target
+#         &agg=count&agg=mean:lr_probs
+# Thresholds (<, <=, >, >=, ==, !=) apply to numeric columns, ==, !=, in and
+# not in to the categorical ones. Row results are paged with offset/limit as
+# in /data-table. A query is normalized first, so the same filters in another
+# order or written as == instead of in share one cached body, and queries
+# with the same filters share the matching rows.
+QUERY_AGGREGATES = ["count", "sum", "mean", "min", "max"]
+QUERY_MAX_FILTERS = 32
+# Number of distinct normalized queries kept per dataset, and the most bytes
+# of their bodies
+QUERY_CACHE_SIZE = 128
+QUERY_CACHE_MAX_BYTES = 64 * 1024**2
+# Number of distinct filter sets whose matching rows are kept per dataset
+QUERY_MATCHES_CACHE_SIZE = 16
+MEMBERSHIP_PATTERN = re.compile(r"^(?P<column>[^<>=!]+?)\s+(?P<op>not in|in)\s+(?P<values>.*)$")
+THRESHOLD_OPS = ["<", "<=", ">", ">="]
+
+
+def parse_query_columns(value, columns):
+    names = [name.strip() for name in value.split(",") if name.strip()]
+    for name in names:
+        if name not in columns:
+            raise KeyError(f"Column '{name}' not found")
+    return tuple(names)
+
+
+def parse_query_filter(expression, frame):
+    # One where= expression as (column, op, value), with value a float for
+    # numeric columns and a sorted tuple of labels for in/not in
+    match = MEMBERSHIP_PATTERN.match(expression)
+    if match is not None:
+        op = match.group("op")
+        values = [v.strip() for v in match.group("values").split(",") if v.strip()]
+    else:
+        match = FILTER_PATTERN.match(expression)
+        if match is None:
+            raise ValueError(f"Invalid filter '{expression}'")
+        op = match.group("op")
+        values = [match.group("value").strip()]
+    column = match.group("column").strip()
+    if column not in frame.columns:
+        raise KeyError(f"Column '{column}' not found")
+
+    if pd.api.types.is_numeric_dtype(frame[column].dtype):
+        if op in ("in", "not in"):
+            raise ValueError(f"'{op}' needs a categorical column, '{column}' is numeric")
+        try:
+            return (column, op, float(values[0]))
+        except ValueError:
+            raise ValueError(f"'{column}' is numeric, '{values[0]}' is not a number")
+    if op in THRESHOLD_OPS:
+        raise ValueError(f"'{op}' needs a numeric column, '{column}' is categorical")
+    if not values:
+        raise ValueError(f"Invalid filter '{expression}'")
+    op = {"==": "in", "!=": "not in"}.get(op, op)
+    return (column, op, tuple(sorted(set(values))))
+
+
+def normalize_query(args, frame):
+    # Hashable canonical form of the where/select/group_by/agg parameters and
+    # of the page of row results
+    expressions = args.getlist("where")
+    if len(expressions) > QUERY_MAX_FILTERS:
+        raise ValueError(f"At most {QUERY_MAX_FILTERS} filters per query")
+    filters = tuple(sorted(set(parse_query_filter(e, frame) for e in expressions)))
+    select = parse_query_columns(args.get("select", ""), frame.columns)
+    group_by = parse_query_columns(args.get("group_by", ""), frame.columns)
+
+    aggregates = []
+    for value in args.getlist("agg"):
+        name, _, column = value.partition(":")
+        if name not in QUERY_AGGREGATES:
+            raise ValueError(
+                f"Unknown aggregate '{name}', expected one of {', '.join(QUERY_AGGREGATES)}"
+            )
+        if name == "count":
+            column = ""
+        elif column not in frame.columns:
+            raise KeyError(f"Column '{column}' not found")
+        elif not pd.api.types.is_numeric_dtype(frame[column].dtype):
+            raise ValueError(f"'{name}' needs a numeric column, '{column}' is categorical")
+        aggregates.append((name, column))
+    if aggregates and not group_by:
+        raise ValueError("'agg' needs 'group_by'")
+    if select and group_by:
+        raise ValueError("'select' and 'group_by' cannot be combined")
+    if group_by and not aggregates:
+        aggregates = [("count", "")]
+    if not group_by:
+        page = page_bounds(args)
+    elif "offset" in args or "limit" in args:
+        raise ValueError("'offset' and 'limit' page row results, not 'group_by'")
+    else:
+        page = None
+    return (filters, select, group_by, tuple(dict.fromkeys(aggregates)), page)
+
+
+def compile_query(filters, frame, codes):
+    # Mask steps of normalized filters. Categorical filters become a boolean
+    # lookup over the column's codes, numeric ones an operator over its values.
+    steps = []
+    for column, op, value in filters:
+        if op in ("in", "not in"):
+            if column not in codes:
+                values = categorical_values(frame[column])
+                codes[column] = (np.asarray(values.codes), values.categories)
+            column_codes, categories = codes[column]
+            wanted = categories.get_indexer(pd.Index(value))
+            # Extra last slot for missing values (code -1), which only
+            # "not in" matches, as != does
+            lookup = np.zeros(len(categories) + 1, dtype=bool)
+            lookup[wanted[wanted >= 0]] = True
+            if op == "not in":
+                lookup = ~lookup
+            steps.append((column_codes, lookup))
+        else:
+            steps.append((frame[column].to_numpy(), FILTER_OPS[op], value))
+    return steps
+
+
+def query_matches(cache, filters, frame):
+    # Positions of the rows matching a set of filters, kept for the
+    # QUERY_MATCHES_CACHE_SIZE most recently used filter sets
+    with cache_lock:
+        rows = cache["matches"].get(filters)
+        if rows is not None:
+            cache["matches"].move_to_end(filters)
+    count_cache("query-matches", rows is not None)
+    if rows is not None:
+        return rows
+
+    mask = np.ones(len(frame), dtype=bool)
+    for step in compile_query(filters, frame, cache["codes"]):
+        if len(step) == 2:
+            column_codes, lookup = step
+            mask &= lookup[column_codes]
+        else:
+            values, op, value = step
+            mask &= op(values, value)
+    rows = np.flatnonzero(mask)
+    with cache_lock:
+        matches = cache["matches"]
+        matches[filters] = rows
+        while len(matches) > QUERY_MATCHES_CACHE_SIZE:
+            matches.popitem(last=False)
+        cache["base_nbytes"] = sum(r.nbytes for r in matches.values()) + sum(
+            c.nbytes for c, _ in cache["codes"].values()
+        )
+    return rows
+
+
+def run_query(query, rows, frame):
+    # JSON body of a query over its matching rows: one page of them,
+    # projected, or one row per group with its aggregates
+    _, select, group_by, aggregates, page = query
+    if group_by:
+        grouped = frame.iloc[rows].groupby(list(group_by), observed=True, sort=True)
+        df = pd.DataFrame(
+            {
+                name if name == "count" else f"{name}_{column}": (
+                    grouped.size() if name == "count" else grouped[column].agg(name)
+                )
+                for name, column in aggregates
+            }
+        ).reset_index()
+        body = '{"total": %d, "rows": %s}' % (len(rows), df.to_json(orient="records"))
+        return body.encode("utf-8")
+
+    offset, limit = page
+    df = frame.iloc[rows[offset : offset + limit]]
+    if select:
+        df = df[list(select)]
+    body = '{"total": %d, "offset": %d, "limit": %d, "rows": %s}' % (
+        len(rows),
+        offset,
+        limit,
+        df.to_json(orient="records"),
+    )
+    return body.encode("utf-8")
+
+
+def get_query_result(dataset_id, args):
+    # Cached body of a query, keyed by its normalized form. None when the
+    # LIANA results are missing.
+    dataset_id = dataset_id or DEFAULT_DATASET
+    adata = get_dataset(dataset_id)
+    if adata is None or "liana_annotated" not in adata.uns:
+        return None
+    frame = adata.uns["liana_annotated"]
+    query = normalize_query(args, frame)
+
+    key = (dataset_id, "queries")
+    with cache_lock:
+        cache = view_cache.setdefault(
+            key,
+            {
+                "results": OrderedDict(),
+                "matches": OrderedDict(),
+                "codes": {},
+                "base_nbytes": 0,
+                "nbytes": 0,
+            },
+        )
+        entry = cache["results"].get(query)
+        if entry is not None:
+            cache["results"].move_to_end(query)
+    count_cache("queries", entry is not None)
+    if entry is not None:
+        return entry
+
+    with compute_lock((dataset_id, "query", query)):
+        entry = cache["results"].get(query)
+        if entry is not None:
+            return entry
+        with timed("filter"):
+            rows = query_matches(cache, query[0], frame)
+            body = run_query(query, rows, frame)
+        entry = {
+            "body": body,
+            "etag": hashlib.sha1(body).hexdigest(),
+            "nbytes": len(body),
+        }
+        with cache_lock:
+            store_cached_result(
+                cache, query, entry, QUERY_CACHE_SIZE, QUERY_CACHE_MAX_BYTES
+            )
+            enforce_dataset_budget(keep=dataset_id)
+        return entry
+
+
+# Autocomplete fields -> column of uns["liana_annotated"] they come from,
+# "gene" comes from var_names
+SEARCH_FIELDS = {
+    "ligand": "ligand_complex",
+    "receptor": "receptor_complex",
+    "pathway": "pathway_name",
+    "gene": None,
+}
+# Separator of the subunits of a complex, e.g. ITGA1_ITGB1
+COMPLEX_SEPARATOR = "_"
+SEARCH_DEFAULT_LIMIT = 10
+SEARCH_MAX_LIMIT = 100
+
+
+def get_search_index(dataset_id=None):
+    # Sorted lowercase keys with their field, value and score, built once per
+    # dataset version. A value is scored by its strongest lr_probs, genes by
+    # the strongest interaction of a complex they are part of. Complexes are
+    # also keyed by each subunit so "ITGB1" finds "ITGA1_ITGB1".
+    dataset_id = dataset_id or DEFAULT_DATASET
+    view = get_liana_view("data-table", dataset_id)
+    key = (dataset_id, "search-index")
+    entry = view_cache.get(key)
+    if entry is not None:
+        return entry
+
+    with compute_lock(key):
+        entry = view_cache.get(key)
+        if entry is not None:
+            return entry
+        fields = list(SEARCH_FIELDS)
+        frame = view["frame"] if view is not None else pd.DataFrame()
+        keys, field_ids, values, scores = [], [], [], []
+        gene_scores = {}
+        for field, column in SEARCH_FIELDS.items():
+            if column is None or column not in frame.columns:
+                continue
+            probs = pd.to_numeric(frame["lr_probs"], errors="coerce")
+            strongest = probs.groupby(frame[column].astype(str)).max()
+            for value, score in strongest.items():
+                for name in {value, *value.split(COMPLEX_SEPARATOR)}:
+                    keys.append(name.lower())
+                    field_ids.append(fields.index(field))
+                    values.append(value)
+                    scores.append(score)
+                if field != "pathway":
+                    for gene in value.split(COMPLEX_SEPARATOR):
+                        gene_scores[gene] = max(score, gene_scores.get(gene, 0.0))
+
+        adata = get_dataset(dataset_id)
+        if adata is not None:
+            for gene in adata.var_names.astype(str):
+                keys.append(gene.lower())
+                field_ids.append(fields.index("gene"))
+                values.append(gene)
+                scores.append(gene_scores.get(gene, 0.0))
+
+        keys = np.array(keys, dtype=object)
+        order = np.argsort(keys, kind="stable")
+        entry = {
+            "keys": keys[order],
+            "fields": np.array(field_ids, dtype=np.int8)[order],
+            "values": np.array(values, dtype=object)[order],
+            "scores": np.nan_to_num(np.array(scores, dtype=float))[order],
+            "field_names": fields,
+        }
+        entry["nbytes"] = sum(
+            object_nbytes(entry[name]) for name in ("keys", "fields", "values", "scores")
+        )
+        with cache_lock:
+            view_cache[key] = entry
+        return entry
+
+
+def search_prefix(index, prefix, fields, limit):
+    # Entries whose key starts with prefix, strongest first, one per value
+    prefix = prefix.lower()
+    start = np.searchsorted(index["keys"], prefix, side="left")
+    end = np.searchsorted(index["keys"], prefix + "\uffff", side="left")
+    candidates = np.arange(start, end)
+    if fields:
+        wanted = [index["field_names"].index(field) for field in fields]
+        candidates = candidates[np.isin(index["fields"][candidates], wanted)]
+
+    # Only the strongest few need sorting, subunit keys can repeat a value
+    scores = index["scores"][candidates]
+    if len(candidates) > limit * 4:
+        top = np.argpartition(-scores, limit * 4)[: limit * 4]
+        candidates, scores = candidates[top], scores[top]
+    candidates = candidates[np.lexsort((index["keys"][candidates], -scores))]
+
+    results = []
+    seen = set()
+    for i in candidates:
+        field = index["field_names"][index["fields"][i]]
+        value = index["values"][i]
+        if (field, value) in seen:
+            continue
+        seen.add((field, value))
+        results.append(
+            {"value": value, "field": field, "score": float(index["scores"][i])}
+        )
+        if len(results) == limit:
+            break
+    return results
+
+
+# Precomputed per-Cell_Type expression summaries written at ingest, as
+# uns[CELL_TYPE_SUMMARY_KEY] = {"mean": genes x cell types, "fraction": ...}
+CELL_TYPE_SUMMARY_KEY = "cell_type_expression"
+# Number of (selection, gene) summaries kept per dataset
+SELECTION_SUMMARY_CACHE_SIZE = 4096
+
+
+def expression_summaries(columns, groups, n_groups):
+    # Mean expression and fraction of expressing cells of every column of a
+    # CSC matrix within each group, groups holds one code per row (-1 = none)
+    valid = groups >= 0
+    membership = sp.csr_matrix(
+        (np.ones(valid.sum()), (groups[valid], np.flatnonzero(valid))),
+        shape=(n_groups, columns.shape[0]),
+    )
+    counts = np.asarray(membership.sum(axis=1)).ravel()
+    expressing = columns.copy()
+    expressing.data = (expressing.data > 0).astype(float)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.asarray((membership @ columns).todense()) / counts[:, None]
+        fraction = np.asarray((membership @ expressing).todense()) / counts[:, None]
+    return np.nan_to_num(mean), np.nan_to_num(fraction), counts
+
+
+def get_cell_type_summaries(dataset_id, genes):
+    # {gene: (mean, fraction)} over the Cell_Type categories, from the ingest
+    # summaries when present, otherwise computed from X once per gene
+    dataset_id = dataset_id or DEFAULT_DATASET
+    adata = get_dataset(dataset_id)
+    key = (dataset_id, "cell-type-expression")
+    with cache_lock:
+        entry = view_cache.setdefault(
+            key, {"genes": {}, "cell_types": None, "counts": None, "nbytes": 0}
+        )
+    cell_types = pd.Categorical(adata.obs["Cell_Type"])
+    entry["cell_types"] = list(cell_types.categories.astype(str))
+
+    missing = [gene for gene in genes if gene not in entry["genes"]]
+    if missing and CELL_TYPE_SUMMARY_KEY in adata.uns:
+        precomputed = adata.uns[CELL_TYPE_SUMMARY_KEY]
+        for gene in missing:
+            if gene in precomputed["mean"].index:
+                entry["genes"][gene] = (
+                    precomputed["mean"].loc[gene, entry["cell_types"]].to_numpy(),
+                    precomputed["fraction"].loc[gene, entry["cell_types"]].to_numpy(),
+                )
+        missing = [gene for gene in missing if gene not in entry["genes"]]
+
+    if missing:
+        with compute_lock(key):
+            missing = [gene for gene in missing if gene not in entry["genes"]]
+            positions = adata.var_names.get_indexer(missing)
+            columns = adata.read_var_columns(positions)
+            mean, fraction, counts = expression_summaries(
+                columns, np.asarray(cell_types.codes), len(entry["cell_types"])
+            )
+            for i, gene in enumerate(missing):
+                entry["genes"][gene] = (mean[:, i], fraction[:, i])
+            entry["counts"] = counts
+            entry["nbytes"] += mean.nbytes + fraction.nbytes
+    if entry["counts"] is None:
+        entry["counts"] = np.bincount(
+            cell_types.codes[cell_types.codes >= 0], minlength=len(entry["cell_types"])
+        )
+    return entry
+
+
+def get_selection_summaries(dataset_id, rows, genes):
+    # {gene: (mean, fraction)} within one stored selection, cached per
+    # (selection, gene) pair
+    dataset_id = dataset_id or DEFAULT_DATASET
+    adata = get_dataset(dataset_id)
+    key = (dataset_id, "selection-expression")
+    with cache_lock:
+        entry = view_cache.setdefault(key, {"results": OrderedDict(), "nbytes": 0})
+    results = entry["results"]
+    selection_key = hashlib.sha1(np.asarray(rows).tobytes()).hexdigest()
+
+    summaries = {}
+    missing = []
+    with cache_lock:
+        for gene in genes:
+            summary = results.get((selection_key, gene))
+            if summary is None:
+                missing.append(gene)
+            else:
+                results.move_to_end((selection_key, gene))
+                summaries[gene] = summary
+    if missing:
+        columns = adata.read_var_columns(adata.var_names.get_indexer(missing))
+        groups = np.full(columns.shape[0], -1)
+        groups[rows] = 0
+        mean, fraction, _ = expression_summaries(columns, groups, 1)
+        with cache_lock:
+            for i, gene in enumerate(missing):
+                summaries[gene] = results[(selection_key, gene)] = (
+                    mean[:, i],
+                    fraction[:, i],
+                )
+            while len(results) > SELECTION_SUMMARY_CACHE_SIZE:
+                results.popitem(last=False)
+    return summaries
+
+
+# Cell shapes of the Xenium dataset served by /spatial/cells
+SPATIAL_SHAPES = "cell_circles"
+SPATIAL_COORDINATE_SYSTEM = "global"
+# Cells per side of the finest grid over the centroids, a power of two so
+# coarser levels merge 2x2 cells
+SPATIAL_GRID_SIZE = 1024
+# Viewports holding more cells than this are answered with grid bins
+SPATIAL_MAX_CELLS = 20000
+# Bins per side of an aggregated viewport, at most
+SPATIAL_BINS = 128
+
+
+def read_cell_shapes(xenium_path):
+    # Ids, centroids in the global coordinate system and radii of the cells
+    sdata = sd.read_zarr(xenium_path, selection=("shapes",))
+    shapes = sdata.shapes[SPATIAL_SHAPES]
+    points = np.column_stack(
+        [shapes.geometry.x.to_numpy(), shapes.geometry.y.to_numpy(), np.ones(len(shapes))]
+    )
+    transformation = sd.transformations.get_transformation(
+        shapes, to_coordinate_system=SPATIAL_COORDINATE_SYSTEM
+    )
+    affine = transformation.to_affine_matrix(input_axes=("x", "y"), output_axes=("x", "y"))
+    points = points @ np.asarray(affine).T
+    radius = (
+        shapes["radius"].to_numpy()
+        if "radius" in shapes
+        else np.zeros(len(shapes))
+    )
+    return shapes.index.astype(str).to_numpy(), points[:, 0], points[:, 1], radius
+
+
+def get_spatial_index(dataset_id=None):
+    # Uniform grid over the cell centroids: cells sorted by grid cell with the
+    # offset of every grid cell, plus count/x/y sums per grid cell for each
+    # level of detail (level k merges 2^k x 2^k grid cells)
+    dataset_id = dataset_id or DEFAULT_DATASET
+    key = (dataset_id, "spatial-index")
+    with cache_lock:
+        index = view_cache.get(key)
+    if index is not None:
+        return index
+    with compute_lock(key):
+        with cache_lock:
+            index = view_cache.get(key)
+        if index is not None:
+            return index
+
+        spec = get_dataset_registry()[dataset_id]
+        ids, x, y, radius = read_cell_shapes(
+            os.path.join(BASE_DIR, spec["xenium_zarr_file"])
+        )
+        size = SPATIAL_GRID_SIZE
+        origin = np.array([x.min(), y.min()])
+        cell_size = max(x.max() - origin[0], y.max() - origin[1], 1e-9) / size
+        gx = np.clip(((x - origin[0]) / cell_size).astype(np.int64), 0, size - 1)
+        gy = np.clip(((y - origin[1]) / cell_size).astype(np.int64), 0, size - 1)
+        grid_cell = gy * size + gx
+        order = np.argsort(grid_cell, kind="stable")
+        offsets = np.searchsorted(grid_cell[order], np.arange(size * size + 1))
+
+        levels = [
+            {
+                name: np.bincount(grid_cell, weights=weights, minlength=size * size)
+                .reshape(size, size)
+                for name, weights in (("count", None), ("x", x), ("y", y))
+            }
+        ]
+        while len(levels[-1]["count"]) > 1:
+            side = len(levels[-1]["count"]) // 2
+            levels.append(
+                {
+                    name: values.reshape(side, 2, side, 2).sum(axis=(1, 3))
+                    for name, values in levels[-1].items()
+                }
+            )
+
+        index = {
+            "ids": ids[order],
+            "x": x[order],
+            "y": y[order],
+            "radius": radius[order],
+            "offsets": offsets,
+            "levels": levels,
+            "origin": origin,
+            "cell_size": cell_size,
+        }
+        index["nbytes"] = sum(
+            value.nbytes for value in index.values() if isinstance(value, np.ndarray)
+        ) + sum(values.nbytes for level in levels for values in level.values())
+        with cache_lock:
+            view_cache[key] = index
+            enforce_dataset_budget(keep=dataset_id)
+        return index
+
+
+def query_spatial_cells(index, x0, y0, x1, y1, max_cells, bins):
+    # The cells inside a viewport, or the non-empty grid bins covering it when
+    # it holds more than max_cells cells
+    size = SPATIAL_GRID_SIZE
+    origin, cell_size = index["origin"], index["cell_size"]
+    ix0, ix1 = np.clip(
+        ((np.array([x0, x1]) - origin[0]) / cell_size).astype(np.int64), 0, size - 1
+    )
+    iy0, iy1 = np.clip(
+        ((np.array([y0, y1]) - origin[1]) / cell_size).astype(np.int64), 0, size - 1
+    )
+    candidates = int(index["levels"][0]["count"][iy0 : iy1 + 1, ix0 : ix1 + 1].sum())
+
+    if candidates <= max_cells:
+        # Grid cells of one grid row are contiguous in the sorted cells
+        offsets = index["offsets"]
+        rows = np.concatenate(
+            [
+                np.arange(offsets[gy * size + ix0], offsets[gy * size + ix1 + 1])
+                for gy in range(iy0, iy1 + 1)
+            ]
+        )
+        x, y = index["x"][rows], index["y"][rows]
+        rows = rows[(x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)]
+        return {
+            "level": "cells",
+            "ids": index["ids"][rows].tolist(),
+            "x": index["x"][rows].tolist(),
+            "y": index["y"][rows].tolist(),
+            "radius": index["radius"][rows].tolist(),
+        }
+
+    level = 0
+    while (ix1 - ix0 + 1) >> level > bins or (iy1 - iy0 + 1) >> level > bins:
+        level += 1
+    grids = index["levels"][level]
+    window = (slice(iy0 >> level, (iy1 >> level) + 1), slice(ix0 >> level, (ix1 >> level) + 1))
+    count = grids["count"][window]
+    nonzero = count > 0
+    return {
+        "level": "bins",
+        "bin_size": float(cell_size * 2**level),
+        "count": count[nonzero].astype(int).tolist(),
+        "x": (grids["x"][window][nonzero] / count[nonzero]).tolist(),
+        "y": (grids["y"][window][nonzero] / count[nonzero]).tolist(),
+    }
+
+
+# Cell type column of the Xenium table used for neighborhood enrichment
+SPATIAL_CELL_TYPE_KEY = "clusters"
+# Default neighborhood radius (global coordinate units) and permutations, and
+# the values clients may ask for, each combination is one cached result
+NEIGHBORHOOD_RADIUS = 30.0
+NEIGHBORHOOD_PERMUTATIONS = 1000
+NEIGHBORHOOD_RADII = [15.0, 30.0, 50.0, 100.0]
+NEIGHBORHOOD_PERMUTATION_CHOICES = [100, 1000]
+# Processes sharing the permutations
+NEIGHBORHOOD_WORKERS = min(8, os.cpu_count() or 1)
+# Result files kept in CONFIG_DIR over all datasets, least recently used
+# ones are removed first
+NEIGHBORHOOD_CACHE_FILES = 32
+# Seconds a client is told to wait before polling a running job again
+NEIGHBORHOOD_RETRY_AFTER = 5
+
+# Enrichments run one at a time, off the request threads
+neighborhood_executor = ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="cellxplore-neighborhood"
+)
+# (dataset id, "neighborhood", inputs) -> {"status", "error", ...} of the jobs
+# that have not finished yet, or that failed since the last request
+neighborhood_jobs = {}
+
+
+def read_cell_labels(xenium_path, key):
+    # Labels of the cells of SPATIAL_SHAPES from the table annotating them,
+    # indexed by cell id
+    sdata = sd.read_zarr(xenium_path, selection=("tables",))
+    table = sdata.tables["table"]
+    attrs = table.uns["spatialdata_attrs"]
+    obs = table.obs[table.obs[attrs["region_key"]] == SPATIAL_SHAPES]
+    return pd.Series(
+        obs[key].to_numpy(), index=obs[attrs["instance_key"]].astype(str)
+    )
+
+
+def neighborhood_counts(edges, labels, n_labels):
+    # Number of neighbor pairs between every two labels, both directions
+    pairs = labels[edges[:, 0]] * n_labels + labels[edges[:, 1]]
+    counts = np.bincount(pairs, minlength=n_labels * n_labels).reshape(
+        n_labels, n_labels
+    )
+    return counts + counts.T
+
+
+def permuted_neighborhood_counts(edges_name, edges_shape, labels, n_labels, seed, permutations):
+    # Sum and sum of squares of the pair counts over label permutations. The
+    # edges are read from shared memory instead of being pickled to every
+    # worker.
+    edges_memory = shared_memory.SharedMemory(name=edges_name)
+    try:
+        edges = np.ndarray(edges_shape, dtype=np.int64, buffer=edges_memory.buf)
+        rng = np.random.default_rng(seed)
+        total = np.zeros((n_labels, n_labels))
+        squares = np.zeros((n_labels, n_labels))
+        for _ in range(permutations):
+            counts = neighborhood_counts(edges, rng.permutation(labels), n_labels)
+            total += counts
+            squares += counts.astype(float) ** 2
+        del edges
+        return total, squares
+    finally:
+        edges_memory.close()
+
+
+def compute_neighborhood_enrichment(x, y, labels, radius, permutations):
+    # z-scores of the observed neighbor counts of every cell type pair against
+    # permutations of the labels, the permutations are split over processes
+    cell_types = pd.Categorical(labels)
+    codes = np.asarray(cell_types.codes)
+    labelled = np.flatnonzero(codes >= 0)
+    codes = codes[labelled]
+    n_labels = len(cell_types.categories)
+    tree = cKDTree(np.column_stack([x[labelled], y[labelled]]))
+    edges = tree.query_pairs(radius, output_type="ndarray").astype(np.int64)
+    observed = neighborhood_counts(edges, codes, n_labels)
+
+    workers = max(1, min(NEIGHBORHOOD_WORKERS, permutations))
+    shares = [len(share) for share in np.array_split(np.arange(permutations), workers)]
+    seeds = np.random.SeedSequence(0).spawn(workers)
+    total = np.zeros((n_labels, n_labels))
+    squares = np.zeros((n_labels, n_labels))
+    edges_memory = shared_memory.SharedMemory(create=True, size=max(edges.nbytes, 1))
+    try:
+        np.ndarray(edges.shape, dtype=np.int64, buffer=edges_memory.buf)[:] = edges
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            jobs = [
+                pool.submit(
+                    permuted_neighborhood_counts,
+                    edges_memory.name,
+                    edges.shape,
+                    codes,
+                    n_labels,
+                    seed,
+                    share,
+                )
+                for seed, share in zip(seeds, shares)
+            ]
+            for job in jobs:
+                job_total, job_squares = job.result()
+                total += job_total
+                squares += job_squares
+    finally:
+        edges_memory.close()
+        edges_memory.unlink()
+    mean = total / permutations
+    std = np.sqrt(np.maximum(squares / permutations - mean**2, 0))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        zscore = np.where(std > 0, (observed - mean) / std, 0.0)
+    return {
+        "cell_types": list(cell_types.categories.astype(str)),
+        "counts": observed.tolist(),
+        "zscore": zscore.tolist(),
+        "radius": radius,
+        "permutations": permutations,
+        "n_edges": int(len(edges)),
+    }
+
+
+def neighborhood_cache_entry(dataset_id, key, radius, permutations):
+    # view_cache key and CONFIG_DIR file of an enrichment, both tied to the
+    # version of the Xenium store
+    spec = get_dataset_registry()[dataset_id]
+    xenium_path = os.path.join(BASE_DIR, spec["xenium_zarr_file"])
+    inputs = hashlib.sha1(
+        json.dumps(
+            [dataset_fingerprint(xenium_path), key, radius, permutations]
+        ).encode()
+    ).hexdigest()
+    path = os.path.join(CONFIG_DIR, f"{dataset_id}_neighborhood_{inputs[:16]}.json")
+    return (dataset_id, "neighborhood", inputs), path
+
+
+def evict_neighborhood_files():
+    # Keep the NEIGHBORHOOD_CACHE_FILES most recently used result files
+    paths = []
+    for name in os.listdir(CONFIG_DIR):
+        if "_neighborhood_" in name and name.endswith(".json"):
+            path = os.path.join(CONFIG_DIR, name)
+            try:
+                paths.append((os.stat(path).st_mtime, path))
+            except FileNotFoundError:
+                continue
+    paths.sort(reverse=True)
+    for _, path in paths[NEIGHBORHOOD_CACHE_FILES:]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def write_neighborhood_enrichment(dataset_id, key, radius, permutations):
+    # Compute an enrichment and write its JSON file, returns the body
+    _, path = neighborhood_cache_entry(dataset_id, key, radius, permutations)
+    spec = get_dataset_registry()[dataset_id]
+    xenium_path = os.path.join(BASE_DIR, spec["xenium_zarr_file"])
+    index = get_spatial_index(dataset_id)
+    labels = read_cell_labels(xenium_path, key).reindex(index["ids"])
+    result = compute_neighborhood_enrichment(
+        index["x"], index["y"], labels.to_numpy(), radius, permutations
+    )
+    body = json.dumps(result, separators=JSON_SEPARATORS).encode("utf-8")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(body)
+    os.replace(tmp_path, path)
+    evict_neighborhood_files()
+    return body
+
+
+def run_neighborhood_job(dataset_id, key, radius, permutations, cache_key, job):
+    job["status"] = "running"
+    try:
+        body = write_neighborhood_enrichment(dataset_id, key, radius, permutations)
+        with cache_lock:
+            view_cache[cache_key] = {
+                "body": body,
+                "etag": hashlib.sha1(body).hexdigest(),
+                "nbytes": len(body),
+            }
+            neighborhood_jobs.pop(cache_key, None)
+    except Exception as e:
+        logger.exception("Neighborhood enrichment of %s failed: %s", dataset_id, e)
+        job["status"] = "failed"
+        job["error"] = f"Column not found: {error_message(e)}" if isinstance(
+            e, KeyError
+        ) else str(e)
+
+
+def get_neighborhood_enrichment(dataset_id, key, radius, permutations):
+    # Enrichment JSON body, computed once per inputs by a background job and
+    # kept in CONFIG_DIR so restarts and other workers reuse it. Returns
+    # (entry, None) once available, otherwise (None, state of the job).
+    dataset_id = dataset_id or DEFAULT_DATASET
+    cache_key, path = neighborhood_cache_entry(dataset_id, key, radius, permutations)
+    with cache_lock:
+        entry = view_cache.get(cache_key)
+    if entry is not None:
+        return entry, None
+
+    try:
+        with open(path, "rb") as f:
+            body = f.read()
+        os.utime(path)
+    except FileNotFoundError:
+        body = None
+    if body is not None:
+        entry = {
+            "body": body,
+            "etag": hashlib.sha1(body).hexdigest(),
+            "nbytes": len(body),
+        }
+        with cache_lock:
+            view_cache[cache_key] = entry
+        return entry, None
+
+    with cache_lock:
+        job = neighborhood_jobs.get(cache_key)
+        if job is not None and job["status"] == "failed":
+            # Reported once, the next request starts a new job
+            del neighborhood_jobs[cache_key]
+            return None, dict(job)
+        if job is None:
+            job = {
+                "status": "queued",
+                "error": None,
+                "radius": radius,
+                "permutations": permutations,
+                "cell_type_key": key,
+            }
+            neighborhood_jobs[cache_key] = job
+            neighborhood_executor.submit(
+                run_neighborhood_job,
+                dataset_id,
+                key,
+                radius,
+                permutations,
+                cache_key,
+                job,
+            )
+        return None, dict(job)
+
+
+# Number of distinct cell type selections whose /filter-table body is kept,
+# and the most bytes of such bodies kept per dataset
+SELECTION_RESULTS_CACHE_SIZE = 32
+SELECTION_RESULTS_MAX_BYTES = 256 * 1024**2
+
+
+def get_selection_index(dataset_id=None):
+    # Integer-coded lookups for /filter-table, built once per dataset version:
+    # barcode -> obs row -> Cell_Type code, and Cell_Type code -> rows of the
+    # "data-table" view with that source (stored as one argsort + offsets)
+    dataset_id = dataset_id or DEFAULT_DATASET
+    view = get_liana_view("data-table", dataset_id)
+    if view is None:
+        return None
+    key = (dataset_id, "selection-index")
+    entry = view_cache.get(key)
+    if entry is not None:
+        return entry
+
+    with compute_lock(key):
+        entry = view_cache.get(key)
+        if entry is not None:
+            return entry
+        cell_types = pd.Categorical(get_dataset(dataset_id).obs["Cell_Type"])
+        categories = cell_types.categories.astype(str)
+        frame = view["frame"]
+        source_codes = categorical_values(frame["source"], categories).codes
+        target_codes = categorical_values(frame["target"], categories).codes
+        # Rows with an unknown source (code -1) sort first and are never used
+        source_order = np.argsort(source_codes, kind="stable")
+        source_offsets = np.searchsorted(
+            source_codes[source_order], np.arange(len(categories) + 1)
+        )
+        barcodes = get_dataset(dataset_id).obs.index
+        entry = {
+            "barcodes": barcodes,
+            "cell_codes": np.asarray(cell_types.codes),
+            "cell_types": list(categories),
+            "target_codes": np.asarray(target_codes),
+            "source_order": source_order,
+            "source_offsets": source_offsets,
+            "results": OrderedDict(),
+        }
+        entry["base_nbytes"] = entry["nbytes"] = sum(
+            entry[name].nbytes
+            for name in ("cell_codes", "target_codes", "source_order", "source_offsets")
+        )
+        with cache_lock:
+            view_cache[key] = entry
+            enforce_dataset_budget(keep=dataset_id)
+        return entry
+
+
+def selected_cell_types(index, barcodes=None, rows=None):
+    # Boolean mask over the cell type codes present in a selection, given
+    # either barcodes or obs row positions
+    if rows is None:
+        rows = index["barcodes"].get_indexer(pd.Index(barcodes))
+        rows = rows[rows >= 0]
+    codes = index["cell_codes"][rows]
+    selected = np.zeros(len(index["cell_types"]), dtype=bool)
+    selected[codes[codes >= 0]] = True
+    return selected
+
+
+def selected_interaction_rows(index, selected):
+    # Rows of the "data-table" view whose source and target are both selected,
+    # touching only the rows whose source is selected
+    codes = np.flatnonzero(selected)
+    offsets = index["source_offsets"]
+    if len(codes) == 0:
+        return np.array([], dtype=np.intp)
+    rows = np.concatenate(
+        [index["source_order"][offsets[code] : offsets[code + 1]] for code in codes]
+    )
+    # Appended False so that unknown targets (code -1) are never selected
+    rows = rows[np.append(selected, False)[index["target_codes"][rows]]]
+    rows.sort()
+    return rows
+
+
+def selection_interactions_body(dataset_id, index, selected):
+    # JSON body of the interactions between the selected cell types, cached
+    # per distinct set of cell types. The bodies count towards the index's
+    # nbytes and so towards the dataset budget.
+    key = selected.tobytes()
+    with cache_lock:
+        entry = index["results"].get(key)
+        if entry is not None:
+            index["results"].move_to_end(key)
+            return entry["body"]
+    rows = selected_interaction_rows(index, selected)
+    frame = get_liana_view("data-table", dataset_id)["frame"]
+    body = frame.iloc[rows].to_json(orient="records").encode("utf-8")
+    with cache_lock:
+        store_cached_result(
+            index,
+            key,
+            {"body": body, "nbytes": len(body)},
+            SELECTION_RESULTS_CACHE_SIZE,
+            SELECTION_RESULTS_MAX_BYTES,
+        )
+        enforce_dataset_budget(keep=dataset_id)
+    return body
+
+
+# Selections stored by /process_selections, per session. Barcodes are kept as
+# obs row ids or as a bitset over the obs rows, whichever is smaller.
+SESSION_COOKIE = "cellxplore_session"
+SESSION_HEADER = "X-Session-Id"
+SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{16,64}$")
+SELECTION_TTL = 4 * 3600.0
+SELECTION_STORE_MAX_BYTES = 256 * 1024**2
+# Directory shared by the workers of one host, None keeps selections in memory
+SELECTION_STORE_DIR = None
+# Minimum number of seconds between two sweeps of SELECTION_STORE_DIR
+SELECTION_SWEEP_INTERVAL = 60.0
+
+# session id -> {"selections", "touched", "nbytes"}, least recently used first
+selection_store = OrderedDict()
+selection_sweep = {"last": None}
+
+
+def request_session_id():
+    session_id = request.headers.get(SESSION_HEADER) or request.cookies.get(
+        SESSION_COOKIE
+    )
+    if session_id is not None and SESSION_ID_PATTERN.match(session_id):
+        return session_id
+    return None
+
+
+def encode_selection(dataset_id, rows, n_obs):
+    rows = np.unique(rows[rows >= 0]).astype(np.int32)
+    if (n_obs + 7) // 8 < rows.nbytes:
+        mask = np.zeros(n_obs, dtype=bool)
+        mask[rows] = True
+        return {"dataset": dataset_id, "n_obs": n_obs, "bits": np.packbits(mask)}
+    return {"dataset": dataset_id, "n_obs": n_obs, "rows": rows}
+
+
+def selection_rows(selection):
+    if "bits" in selection:
+        bits = np.unpackbits(selection["bits"], count=selection["n_obs"])
+        return np.flatnonzero(bits)
+    return selection["rows"]
+
+
+def selection_nbytes(selections):
+    return sum(
+        (selection.get("bits") if "bits" in selection else selection["rows"]).nbytes
+        for selection in selections.values()
+    )
+
 
-zarr_cache = None
+def selection_store_path(session_id):
+    return os.path.join(SELECTION_STORE_DIR, f"{session_id}.npz")
 
-# Constants /Users/olympia/cellXplore_App/datasets/Xenium_proper_data.zarr
-# /Users/olympia/cellXplore_App/datasets/sc_FPPE_breast_cancer.zarr
-# Paths
-MERGED_ZARR_FILE = "sc_FPPE_breast_cancer.zarr"
-XENIUM_ZARR_FILE = "Xenium_proper_data.zarr"  # Xenium dataset
-CONFIG_DIR = "/home/olympia/cellXplore_App/configs/"
-BASE_DIR = "/home/olympia/cellXplore_App/datasets/"
-SAMPLE_NAME = "Breast_Cancer"  # Sample name
-DESCRIPTION = "High resolution mapping of the tumor microenvironment using integrated single-cell, spatial and in situ analysis. Janesick, A., Shelansky, R., Gottscho, A.D. et al. Nat Commun 14, 8353 (2023). https://doi.org/10.1038/s41467-023-43458-x"
+
+def write_selections_file(session_id, selections):
+    # One .npz per session, written to a temporary file and renamed so other
+    # workers never read a partial file
+    os.makedirs(SELECTION_STORE_DIR, exist_ok=True)
+    arrays = {}
+    meta = {}
+    for i, (name, selection) in enumerate(selections.items()):
+        kind = "bits" if "bits" in selection else "rows"
+        arrays[f"a{i}"] = selection[kind]
+        meta[f"a{i}"] = {
+            "name": name,
+            "kind": kind,
+            "dataset": selection["dataset"],
+            "n_obs": selection["n_obs"],
+        }
+    arrays["meta"] = np.array(json.dumps(meta))
+    path = selection_store_path(session_id)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def read_selections_file(session_id):
+    path = selection_store_path(session_id)
+    try:
+        if time.time() - os.stat(path).st_mtime > SELECTION_TTL:
+            os.remove(path)
+            return None
+        with np.load(path, allow_pickle=False) as npz:
+            meta = json.loads(str(npz["meta"]))
+            selections = {}
+            for key, info in meta.items():
+                selections[info["name"]] = {
+                    "dataset": info["dataset"],
+                    "n_obs": info["n_obs"],
+                    info["kind"]: npz[key],
+                }
+        return selections
+    except FileNotFoundError:
+        return None
+
+
+def evict_selections():
+    # Drop expired sessions, then least recently used ones over the budget
+    now = time.monotonic()
+    with cache_lock:
+        for session_id in list(selection_store):
+            if now - selection_store[session_id]["touched"] > SELECTION_TTL:
+                del selection_store[session_id]
+        total = sum(entry["nbytes"] for entry in selection_store.values())
+        while total > SELECTION_STORE_MAX_BYTES and len(selection_store) > 1:
+            _, entry = selection_store.popitem(last=False)
+            total -= entry["nbytes"]
+
+
+def evict_selection_files(keep=None):
+    # Remove session files (and leftover temporary files) not used within
+    # SELECTION_TTL, then the least recently used ones until the directory
+    # fits SELECTION_STORE_MAX_BYTES. Files of other workers are included,
+    # one of them removing a file first is not an error.
+    now = time.monotonic()
+    with cache_lock:
+        last = selection_sweep["last"]
+        if last is not None and now - last < SELECTION_SWEEP_INTERVAL:
+            return
+        selection_sweep["last"] = now
+    try:
+        names = os.listdir(SELECTION_STORE_DIR)
+    except FileNotFoundError:
+        return
+    files = []
+    for name in names:
+        if not name.endswith((".npz", ".tmp")):
+            continue
+        path = os.path.join(SELECTION_STORE_DIR, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+    files.sort()
+    total = sum(size for _, size, _ in files)
+    for mtime, size, path in files:
+        expired = time.time() - mtime > SELECTION_TTL
+        if not expired and (total <= SELECTION_STORE_MAX_BYTES or path == keep):
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def store_selections(session_id, selections):
+    with cache_lock:
+        selection_store[session_id] = {
+            "selections": selections,
+            "touched": time.monotonic(),
+            "nbytes": selection_nbytes(selections),
+        }
+        selection_store.move_to_end(session_id)
+    if SELECTION_STORE_DIR is not None:
+        write_selections_file(session_id, selections)
+        evict_selection_files(keep=selection_store_path(session_id))
+    evict_selections()
+
+
+def load_selections(session_id):
+    # Selections of a session, from memory or from the shared directory when
+    # they were stored by another worker. None once they have expired.
+    if session_id is None:
+        return None
+    with cache_lock:
+        entry = selection_store.get(session_id)
+        if entry is not None and SELECTION_STORE_DIR is None:
+            if time.monotonic() - entry["touched"] <= SELECTION_TTL:
+                entry["touched"] = time.monotonic()
+                selection_store.move_to_end(session_id)
+                return entry["selections"]
+            del selection_store[session_id]
+            return None
+    if SELECTION_STORE_DIR is None:
+        return None
+    # The file is the source of truth when workers share the store
+    selections = read_selections_file(session_id)
+    if selections is not None:
+        os.utime(selection_store_path(session_id))
+        with cache_lock:
+            selection_store[session_id] = {
+                "selections": selections,
+                "touched": time.monotonic(),
+                "nbytes": selection_nbytes(selections),
+            }
+            selection_store.move_to_end(session_id)
+    return selections
+
+
+def warm_view_cache(dataset_id=None):
+    for view_name in LIANA_VIEWS:
+        get_liana_view(view_name, dataset_id)
+
+
+# Bodies smaller than this are sent uncompressed
+COMPRESSION_MIN_BYTES = 1024
+# A compressed variant is only used when it is at most this fraction of the body
+COMPRESSION_MAX_RATIO = 0.9
+# Content-Encoding -> compressor of cached bodies (compressed once, at a high
+# level) and of other responses (per request, at a fast level), in order of
+# preference when the client accepts several equally
+COMPRESSORS = {}
+if brotli is not None:
+    COMPRESSORS["br"] = {
+        "cached": lambda body: brotli.compress(body, quality=9),
+        "dynamic": lambda body: brotli.compress(body, quality=4),
+    }
+if zstandard is not None:
+    COMPRESSORS["zstd"] = {
+        "cached": lambda body: zstandard.ZstdCompressor(level=12).compress(body),
+        "dynamic": lambda body: zstandard.ZstdCompressor(level=3).compress(body),
+    }
+COMPRESSORS["gzip"] = {
+    "cached": lambda body: gzip.compress(body, compresslevel=9, mtime=0),
+    "dynamic": lambda body: gzip.compress(body, compresslevel=6, mtime=0),
+}
+
+
+def negotiate_encoding(nbytes):
+    # Content-Encoding for a body of nbytes, None to send it as it is
+    if nbytes < COMPRESSION_MIN_BYTES or request.range is not None:
+        return None
+    return request.accept_encodings.best_match(list(COMPRESSORS))
+
+
+def cached_variant(entry, encoding, on_grow=None):
+    # entry["body"] compressed with encoding, computed once and kept in
+    # entry["variants"]. None when compression does not pay off.
+    variants = entry.setdefault("variants", {})
+    count_cache("compressed", encoding in variants)
+    if encoding not in variants:
+        body = entry["body"]
+        with timed("compress"):
+            compressed = COMPRESSORS[encoding]["cached"](body)
+        if len(compressed) > len(body) * COMPRESSION_MAX_RATIO:
+            compressed = None
+        # Only the thread whose variant is kept accounts for it
+        if variants.setdefault(encoding, compressed) is compressed and compressed:
+            entry["nbytes"] = entry.get("nbytes", 0) + len(compressed)
+            if on_grow is not None:
+                on_grow(len(compressed))
+    return variants[encoding]
+
+
+def compress_cached_response(response, entry, on_grow=None):
+    # Swap in the precompressed variant of a cached body the client accepts,
+    # with its own ETag
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate_encoding(len(entry["body"]))
+    if encoding is None:
+        return response
+    compressed = cached_variant(entry, encoding, on_grow)
+    if compressed is not None:
+        response.set_data(compressed)
+        response.headers["Content-Encoding"] = encoding
+        response.set_etag(f"{entry['etag']}-{encoding}")
+    return response
 
 
-def load_cached_zarr():
-    global zarr_cache
-    if zarr_cache is None:
-        zarr_cache = ad.read_zarr(os.path.join(BASE_DIR, MERGED_ZARR_FILE))
-        pprint(zarr_cache)
+def cached_json_response(entry):
+    # Serve pre-serialized bytes, answering 304 when the client's ETag matches
+    response = Response(entry["body"], mimetype="application/json")
+    response.set_etag(entry["etag"])
+    response.headers["Cache-Control"] = "no-cache"
+    compress_cached_response(response, entry)
+    return response.make_conditional(request)
 
 
-# Load the Zarr file at application startup
-load_cached_zarr()
+def iter_gzip(chunks):
+    # gzip stream of a body produced chunk by chunk
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+# Other formats for the interaction tables, negotiated with ?format= or Accept
+TABLE_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+}
+# Formats that need pyarrow
+ARROW_FORMATS = ["arrow", "parquet"]
+# String columns sent as Arrow dictionaries, they repeat a few values per row
+DICTIONARY_COLUMNS = [
+    "source",
+    "target",
+    "ligand_complex",
+    "receptor_complex",
+    "pathway_name",
+]
+ARROW_BATCH_ROWS = 65536
+
+
+def requested_table_format():
+    # "json" unless the client asked for NDJSON, or Arrow/Parquet and pyarrow
+    # is available
+    fmt = request.args.get("format")
+    if fmt is None:
+        fmt = request.accept_mimetypes.best_match(
+            ["application/json"] + list(TABLE_FORMATS.values()),
+            default="application/json",
+        )
+        fmt = next((k for k, v in TABLE_FORMATS.items() if v == fmt), "json")
+    if fmt != "json" and (fmt not in TABLE_FORMATS or (fmt in ARROW_FORMATS and pa is None)):
+        return None
+    return fmt
+
+
+def frame_to_arrow_table(df):
+    df = df.copy()
+    for column in DICTIONARY_COLUMNS:
+        if column in df.columns and not isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype("category")
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def encode_frame(df, fmt):
+    if fmt == "ndjson":
+        return df.to_json(orient="records", lines=True).encode("utf-8")
+    table = frame_to_arrow_table(df)
+    sink = pa.BufferOutputStream()
+    if fmt == "arrow":
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            for batch in table.to_batches(max_chunksize=ARROW_BATCH_ROWS):
+                writer.write_batch(batch)
+    else:
+        pq.write_table(table, sink, compression="zstd")
+    return sink.getvalue().to_pybytes()
+
+
+def iter_json_records(df, ndjson=False):
+    # JSON array (or NDJSON lines) of a frame, encoded STREAM_CHUNK_ROWS rows
+    # at a time so only one slice is serialized in memory at once
+    if not ndjson:
+        yield b"["
+    for start in range(0, len(df), STREAM_CHUNK_ROWS):
+        chunk = df.iloc[start : start + STREAM_CHUNK_ROWS]
+        if ndjson:
+            lines = chunk.to_json(orient="records", lines=True).rstrip("\n")
+            yield lines.encode("utf-8") + b"\n"
+        else:
+            records = chunk.to_json(orient="records")[1:-1].encode("utf-8")
+            yield records if start == 0 else b"," + records
+    if not ndjson:
+        yield b"]"
+
+
+def streamed_view_response(entry, fmt):
+    # Streamed bodies are gzip-compressed on the fly when the client accepts it
+    records = iter_json_records(entry["frame"], ndjson=fmt == "ndjson")
+    etag = f"{entry['etag']}-{fmt}"
+    gzipped = request.accept_encodings["gzip"] > 0 and request.range is None
+    if gzipped:
+        records = iter_gzip(records)
+        etag += "-gzip"
+    response = Response(records, mimetype=TABLE_FORMATS.get(fmt, "application/json"))
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    response.vary.add("Accept")
+    response.vary.add("Accept-Encoding")
+    if gzipped:
+        response.headers["Content-Encoding"] = "gzip"
+    return response.make_conditional(request)
+
+
+def unsupported_format_response():
+    return (
+        jsonify(
+            {
+                "error": "Unsupported format, expected one of: json, "
+                + ", ".join(TABLE_FORMATS)
+                + (" (pyarrow not installed)" if pa is None else "")
+            }
+        ),
+        406,
+    )
+
+
+def cached_view_response(entry):
+    # JSON by default, NDJSON, Arrow IPC or Parquet when negotiated. Other
+    # bodies are encoded on first use and kept in the view cache entry, except
+    # JSON and NDJSON of large views, which are streamed.
+    fmt = requested_table_format()
+    if fmt is None:
+        return unsupported_format_response()
+    if entry["body"] is None and fmt in ("json", "ndjson"):
+        return streamed_view_response(entry, fmt)
+    if fmt == "json":
+        response = cached_json_response(entry)
+        response.vary.add("Accept")
+        return response
+
+    encoded = entry.get(fmt)
+    if encoded is None:
+        with compute_lock((id(entry), fmt)):
+            encoded = entry.get(fmt)
+            if encoded is None:
+                with timed("serialize"):
+                    body = encode_frame(entry["frame"], fmt)
+                encoded = {"body": body, "etag": hashlib.sha1(body).hexdigest()}
+                entry[fmt] = encoded
+                entry["nbytes"] = entry.get("nbytes", 0) + len(body)
+
+    response = Response(encoded["body"], mimetype=TABLE_FORMATS[fmt])
+    response.set_etag(encoded["etag"])
+    response.headers["Cache-Control"] = "no-cache"
+    response.vary.add("Accept")
+    compress_cached_response(
+        response,
+        encoded,
+        on_grow=lambda nbytes: entry.update(nbytes=entry.get("nbytes", 0) + nbytes),
+    )
+    return response.make_conditional(request)
 
 
 def generate_config(
-    merged_zarr_file, xenium_zarr_file, output_dir, base_dir, sample, description
+    merged_zarr_file,
+    xenium_zarr_file,
+    output_dir,
+    base_dir,
+    sample,
+    description,
+    name="Breast Cancer Multi-Modal",
+    base_url=DATASETS_URL,
 ):
     try:
         os.makedirs(output_dir, exist_ok=True)
@@ -56,7 +2770,7 @@ def generate_config(
         # Initialize Vitessce Configuration
         vc = VitessceConfig(
             schema_version="1.0.17",
-            name="Breast Cancer Multi-Modal",
+            name=name,
             description=description,
             base_dir=base_dir,
         )
@@ -160,50 +2874,43 @@ def generate_config(
         # vc.layout((scatterplot / spatial_view) | (cell_sets / feature_list / xenium_obs_sets / lc_view / feature_list_spatial))
 
         # Save the generated configuration
-        config_dict = vc.to_dict(
-            base_url="http://oh-cxg-dev.mvls.gla.ac.uk/datasets"
-        )  # config_dict = vc.to_dict(base_url="http://oh-cxg-dev.mvls.gla.ac.uk/datasets")
+        config_dict = vc.to_dict(base_url=base_url)
         output_path = os.path.join(output_dir, f"{sample}.json")
         with open(output_path, "w") as json_file:
-            json.dump(config_dict, json_file, indent=4)
+            json.dump(config_dict, json_file, separators=(",", ":"))
 
-        print(
-            f"Configuration generated for {sample} with Single-Cell and Xenium datasets"
+        logger.info(
+            "Configuration generated for %s with Single-Cell and Xenium datasets", sample
         )
+        return config_dict
 
     except Exception as e:
-        print(f"Error generating configuration: {str(e)}")
-        traceback.print_exc()
-
-
-# Generate config with both datasets
-generate_config(
-    MERGED_ZARR_FILE, XENIUM_ZARR_FILE, CONFIG_DIR, BASE_DIR, SAMPLE_NAME, DESCRIPTION
-)
+        logger.exception("Error generating configuration: %s", e)
 
 
 @app.route("/get_config", methods=["GET"])
 def get_config():
     try:
-        config_path = os.path.join(CONFIG_DIR, f"{SAMPLE_NAME}.json")
-        if not os.path.exists(config_path):
-            return jsonify({"error": "Configuration file not found"}), 404
-
-        with open(config_path, "r") as f:
-            config = json.load(f)
-        return jsonify(config), 200
+        return dataset_config_response(request_dataset(), "main")
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
-def generate_dual_scatter_config(xenium_zarr_file, output_dir, base_dir):
+def generate_dual_scatter_config(
+    xenium_zarr_file,
+    output_dir,
+    base_dir,
+    output_name="dual_sc.json",
+    name="Breast Cancer Multi-Modal",
+    base_url=DATASETS_URL,
+):
     try:
         os.makedirs(output_dir, exist_ok=True)
 
         # Initialize Vitessce Configuration
         vc = VitessceConfig(
             schema_version="1.0.17",
-            name="Breast Cancer Multi-Modal",
+            name=name,
             base_dir=base_dir,
         )
 
@@ -295,199 +3002,488 @@ def generate_dual_scatter_config(xenium_zarr_file, output_dir, base_dir):
         )
 
         # Save the generated configuration
-        config_dict = vc.to_dict(
-            base_url="http://oh-cxg-dev.mvls.gla.ac.uk/datasets"
-        )  # config_dict = vc.to_dict(base_url="http://oh-cxg-dev.mvls.gla.ac.uk/datasets")
-        output_path = os.path.join(output_dir, "dual_sc.json")
+        config_dict = vc.to_dict(base_url=base_url)
+        output_path = os.path.join(output_dir, output_name)
         with open(output_path, "w") as json_file:
-            json.dump(config_dict, json_file, indent=4)
+            json.dump(config_dict, json_file, separators=(",", ":"))
+
+        logger.info("Configuration generated for dual-view Single-Cell datasets")
+        return config_dict
+
+    except Exception as e:
+        logger.exception("Error generating configuration: %s", e)
+
+
+def config_file_names(dataset_id):
+    # Main and dual-view config files of a dataset, the default dataset keeps
+    # its original file names
+    if dataset_id == DEFAULT_DATASET:
+        return f"{SAMPLE_NAME}.json", "dual_sc.json"
+    return f"{dataset_id}.json", f"{dataset_id}_dual_sc.json"
+
 
-        print(f"Configuration generated for dual-view Single-Cell datasets")
+CONFIG_KINDS = ["main", "dual"]
+# (dataset id, kind) -> {"inputs", "checked", "body", "etag"}
+config_cache = {}
+config_lock = threading.Lock()
 
+
+def code_digest(function):
+    # Changes whenever the body of a config generator is edited
+    code = function.__code__
+    return hashlib.sha1(code.co_code + repr(code.co_consts).encode()).hexdigest()
+
+
+# tuple of zarr store paths -> {"version", "checked"}
+store_versions = {}
+
+
+def dataset_store_roots(dataset_id):
+    spec = get_dataset_registry()[dataset_id]
+    return tuple(
+        os.path.normpath(os.path.join(BASE_DIR, spec[key]))
+        for key in ("merged_zarr_file", "xenium_zarr_file")
+        if spec.get(key)
+    )
+
+
+def stores_version(roots):
+    # Short hash of the fingerprints of a dataset's zarr stores. Configs point
+    # at /datasets/@<version>/, so rewriting a store moves its chunks to new
+    # URLs and the old ones can be cached forever.
+    now = time.monotonic()
+    entry = store_versions.get(roots)
+    if entry is None or now - entry["checked"] >= FINGERPRINT_TTL:
+        digest = hashlib.sha1()
+        for root in roots:
+            digest.update(f"{root}:{dataset_fingerprint(root)};".encode())
+        entry = {"version": digest.hexdigest()[:16], "checked": now}
+        store_versions[roots] = entry
+    return entry["version"]
+
+
+def config_inputs_hash(dataset_id, kind, version):
+    # Hash of everything a generated config depends on: the registry entry,
+    # the generator code and the version of the dataset files it points to
+    spec = get_dataset_registry()[dataset_id]
+    generator = generate_config if kind == "main" else generate_dual_scatter_config
+    return hashlib.sha1(
+        json.dumps(
+            [
+                dataset_id,
+                kind,
+                spec,
+                BASE_DIR,
+                DATASETS_URL,
+                code_digest(generator),
+                version,
+            ],
+            sort_keys=True,
+        ).encode()
+    ).hexdigest()
+
+
+def build_dataset_config(dataset_id, kind, version):
+    spec = get_dataset_registry()[dataset_id]
+    config_name = config_file_names(dataset_id)[CONFIG_KINDS.index(kind)]
+    name = spec.get("name", dataset_id)
+    base_url = f"{DATASETS_URL}/@{version}"
+    if kind == "main":
+        return generate_config(
+            spec["merged_zarr_file"],
+            spec["xenium_zarr_file"],
+            CONFIG_DIR,
+            BASE_DIR,
+            os.path.splitext(config_name)[0],
+            spec.get("description", ""),
+            name=name,
+            base_url=base_url,
+        )
+    return generate_dual_scatter_config(
+        spec["xenium_zarr_file"],
+        CONFIG_DIR,
+        BASE_DIR,
+        output_name=config_name,
+        name=name,
+        base_url=base_url,
+    )
+
+
+def get_dataset_config(dataset_id, kind):
+    # Serialized Vitessce config, regenerated only when its inputs change.
+    # The input hash is stored next to the JSON file so other processes and
+    # restarts reuse the file instead of rebuilding it.
+    key = (dataset_id, kind)
+    now = time.monotonic()
+    entry = config_cache.get(key)
+    count_cache("configs", entry is not None)
+    if entry is not None and now - entry["checked"] < FINGERPRINT_TTL:
+        return entry
+
+    with config_lock:
+        version = stores_version(dataset_store_roots(dataset_id))
+        inputs = config_inputs_hash(dataset_id, kind, version)
+        entry = config_cache.get(key)
+        if entry is not None and entry["inputs"] == inputs:
+            entry["checked"] = now
+            return entry
+
+        config_path = os.path.join(
+            CONFIG_DIR, config_file_names(dataset_id)[CONFIG_KINDS.index(kind)]
+        )
+        hash_path = config_path + ".sha1"
+        config = None
+        if os.path.exists(config_path) and os.path.exists(hash_path):
+            with open(hash_path, "r") as f:
+                if f.read().strip() == inputs:
+                    with open(config_path, "r") as config_file:
+                        config = json.load(config_file)
+        if config is None:
+            config = build_dataset_config(dataset_id, kind, version)
+            if config is None:
+                return None
+            with open(hash_path, "w") as f:
+                f.write(inputs)
+
+        body = json.dumps(config, separators=JSON_SEPARATORS).encode("utf-8")
+        entry = {
+            "inputs": inputs,
+            "checked": now,
+            "body": body,
+            "etag": hashlib.sha1(body).hexdigest(),
+        }
+        config_cache[key] = entry
+        return entry
+
+
+def dataset_config_response(dataset_id, kind):
+    entry = get_dataset_config(dataset_id, kind)
+    if entry is None:
+        return jsonify({"error": "Configuration could not be generated"}), 500
+    return cached_json_response(entry)
+
+
+# Startup work (dataset load, cached views, Vitessce configs) runs once per
+# process in warm_up(), either in a background thread so Flask binds at once,
+# or synchronously before forking workers so they share it copy-on-write
+warm_up_state = {"status": "pending", "error": None, "started": None, "finished": None}
+warm_up_lock = threading.Lock()
+
+
+def warm_up():
+    warm_up_state["status"] = "running"
+    warm_up_state["started"] = time.time()
+    try:
+        # Load the default dataset at application startup, the others are
+        # opened on their first request
+        get_dataset(DEFAULT_DATASET)
+        warm_view_cache(DEFAULT_DATASET)
+        # Generate config with both datasets
+        for kind in CONFIG_KINDS:
+            get_dataset_config(DEFAULT_DATASET, kind)
+        warm_up_state["status"] = "ready"
     except Exception as e:
-        print(f"Error generating configuration: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Error during warm-up: %s", e)
+        warm_up_state["status"] = "failed"
+        warm_up_state["error"] = str(e)
+    finally:
+        warm_up_state["finished"] = time.time()
+
+
+def start_warm_up(background=True):
+    # Run warm_up() at most once per process
+    with warm_up_lock:
+        if warm_up_state["status"] != "pending":
+            return
+        warm_up_state["status"] = "running"
+    if background:
+        threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    else:
+        warm_up()
+
+
+def create_app(background=True):
+    # App factory for WSGI servers, e.g. gunicorn "main:create_app()", or with
+    # --preload and create_app(background=False) to warm up before forking
+    start_warm_up(background=background)
+    return app
+
+
+@app.before_request
+def warm_up_on_first_request():
+    # Servers that import `app` directly (flask run, gunicorn main:app) never
+    # call create_app(), the first request starts the warm-up in the
+    # background instead
+    if warm_up_state["status"] == "pending":
+        start_warm_up()
+
 
+@app.before_request
+def check_dataset():
+    # Every endpoint takes ?dataset=<id>, unknown ids are rejected up front
+    dataset_id = request.args.get("dataset")
+    if dataset_id is not None and dataset_id not in get_dataset_registry():
+        return jsonify({"error": f"Unknown dataset '{dataset_id}'"}), 404
 
-# Generate config with both datasets
-generate_dual_scatter_config(XENIUM_ZARR_FILE, CONFIG_DIR, BASE_DIR)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    # Registered before compress_response so it runs after it and sees the
+    # size that is sent
+    endpoint = current_endpoint()
+    count_metric(
+        "cellxplore_requests_total", endpoint=endpoint, status=str(response.status_code)
+    )
+    started = g.get("request_started")
+    if started is not None:
+        observe_metric(
+            "cellxplore_request_seconds",
+            time.perf_counter() - started,
+            LATENCY_BUCKETS,
+            endpoint=endpoint,
+        )
+    if response.content_length is not None:
+        observe_metric(
+            "cellxplore_response_bytes",
+            response.content_length,
+            SIZE_BUCKETS,
+            endpoint=endpoint,
+        )
+    return response
+
+
+@app.after_request
+def compress_response(response):
+    # Responses built per request (jsonify) are compressed here, cached bodies
+    # already negotiated their precompressed variant
+    if (
+        response.status_code != 200
+        or response.direct_passthrough
+        or response.is_streamed
+        or "Content-Encoding" in response.headers
+        or "accept-encoding" in response.vary
+        or response.mimetype != "application/json"
+    ):
+        return response
+    body = response.get_data()
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate_encoding(len(body))
+    if encoding is None:
+        return response
+    with timed("compress"):
+        compressed = COMPRESSORS[encoding]["dynamic"](body)
+    if len(compressed) <= len(body) * COMPRESSION_MAX_RATIO:
+        response.set_data(compressed)
+        response.headers["Content-Encoding"] = encoding
+        if response.get_etag()[0]:
+            response.set_etag(f"{response.get_etag()[0]}-{encoding}")
+    return response
+
+
+@app.route("/dataset-registry", methods=["GET"])
+def get_registry():
+    with cache_lock:
+        loaded = {
+            dataset_id: dataset_nbytes(dataset_id) for dataset_id in dataset_cache
+        }
+        stats = dict(dataset_cache_stats)
+    datasets = [
+        {
+            "id": dataset_id,
+            "name": spec.get("name", dataset_id),
+            "description": spec.get("description", ""),
+            "loaded": dataset_id in loaded,
+            "nbytes": loaded.get(dataset_id, 0),
+        }
+        for dataset_id, spec in get_dataset_registry().items()
+    ]
+    return jsonify(
+        {
+            "default": DEFAULT_DATASET,
+            "datasets": datasets,
+            "cache": {
+                **stats,
+                "nbytes": sum(loaded.values()),
+                "max_bytes": DATASET_CACHE_MAX_BYTES,
+            },
+        }
+    )
+
+
+def metric_labels(labels):
+    # {name="value",...} with backslashes and quotes escaped
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    # Prometheus text format
+    with metrics_lock:
+        values = {
+            key: list(value) if isinstance(value, list) else value
+            for key, value in metric_values.items()
+        }
+    lines = []
+    for name, (kind, help_text) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        buckets = SIZE_BUCKETS if name == "cellxplore_response_bytes" else LATENCY_BUCKETS
+        for (metric, labels), value in sorted(values.items()):
+            if metric != name:
+                continue
+            if kind == "counter":
+                lines.append(f"{name}{metric_labels(labels)} {value}")
+                continue
+            counts = value[: len(buckets)] + [value[-1]]
+            for bound, count in zip(buckets + ("+Inf",), counts):
+                lines.append(
+                    f"{name}_bucket{metric_labels(labels + (('le', bound),))} {count}"
+                )
+            lines.append(f"{name}_sum{metric_labels(labels)} {value[-2]}")
+            lines.append(f"{name}_count{metric_labels(labels)} {value[-1]}")
+
+    with cache_lock:
+        cache_bytes = {
+            "datasets": sum(dataset_nbytes(dataset_id) for dataset_id in dataset_cache),
+            "selections": sum(entry["nbytes"] for entry in selection_store.values()),
+        }
+        dataset_stats = dict(dataset_cache_stats)
+    cache_bytes["chunks"] = chunk_cache_nbytes
+    lines.append("# HELP cellxplore_cache_bytes Memory held by each cache")
+    lines.append("# TYPE cellxplore_cache_bytes gauge")
+    for cache, nbytes in cache_bytes.items():
+        lines.append(f'cellxplore_cache_bytes{{cache="{cache}"}} {nbytes}')
+    lines.append("# HELP cellxplore_dataset_cache_total Dataset cache events")
+    lines.append("# TYPE cellxplore_dataset_cache_total counter")
+    for event, count in dataset_stats.items():
+        lines.append(f'cellxplore_dataset_cache_total{{event="{event}"}} {count}')
+    rss = process_rss()
+    if rss is not None:
+        lines.append("# HELP cellxplore_process_resident_memory_bytes Resident memory")
+        lines.append("# TYPE cellxplore_process_resident_memory_bytes gauge")
+        lines.append(f"cellxplore_process_resident_memory_bytes {rss}")
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/ready", methods=["GET"])
+def get_ready():
+    status_code = 200 if warm_up_state["status"] == "ready" else 503
+    return jsonify(warm_up_state), status_code
 
 
 @app.route("/get_dual_config", methods=["GET"])
 def get_dual_config():
     try:
-        config_path = os.path.join(CONFIG_DIR, "dual_sc.json")
-        if not os.path.exists(config_path):
-            return jsonify({"error": "Configuration file not found"}), 404
-
-        with open(config_path, "r") as f:
-            config = json.load(f)
-        return jsonify(config), 200
+        return dataset_config_response(request_dataset(), "dual")
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
 @app.route("/")
 def serve_spa_default():
-    print("Serving default")
+    logger.debug("Serving default")
     return app.send_static_file("index.html")
 
 
 @app.route("/<path:path>")
 def serve_spa_files(path):
-    print("Serving " + path)
+    logger.debug("Serving %s", path)
     return app.send_static_file(path)
 
 
 @app.route("/data-table", methods=["GET"])
 def get_data_table():
     try:
-        # Check if the Zarr object is loaded
-        if zarr_cache is not None:
-            try:
-                # Access the DataFrame in the `.uns` slot
-                if "liana_annotated" in zarr_cache.uns:
-                    df = zarr_cache.uns["liana_annotated"]
-                    print("DataFrame accessed:", df)
-                    df = df[df["lr_probs"] > 0]
-                    print(list(df.columns.values))
-                    # Convert the DataFrame to JSON format
-                    data = df.to_json(orient="records")
-                    # print("Data converted to JSON format:", data)
-                else:
-                    print("Key 'Cellchat_Interactions' not found in zarr_cache")
-                    data = []  # Return an empty array if the key is not found
-            except Exception as e:
-                print("Error accessing DataFrame in 'zarr_cache.uns':", str(e))
-                traceback.print_exc()  # Prints the full traceback to console
-                return jsonify({"error": f"Failed to access DataFrame: {str(e)}"}), 500
-        else:
-            print("Zarr cache not loaded.")
-            data = []  # Return an empty array if Zarr file failed to load
+        entry = get_liana_view("data-table", request_dataset())
+        if entry is None:
+            logger.warning("Key 'liana_annotated' not found or Zarr cache not loaded.")
+            return Response("[]", mimetype="application/json")
 
-        # Log the data type for debugging
-        # print("Data type:", type(data))
+        if not any(param in request.args for param in PAGE_PARAMS):
+            # Return the cached table, or 304 if the client already has it
+            return cached_view_response(entry)
 
-        # Return the data as JSON
-        return Response(data, mimetype="application/json")
+        # Paged request: total count of matching rows plus one page of them
+        fmt = requested_table_format()
+        if fmt is None:
+            return unsupported_format_response()
+        page, total = page_liana_view(entry, request.args)
+        if fmt != "json":
+            response = Response(encode_frame(page, fmt), mimetype=TABLE_FORMATS[fmt])
+            response.headers["X-Total-Count"] = str(total)
+            return response
+        body = '{"total": %d, "offset": %d, "limit": %d, "rows": %s}' % (
+            total,
+            int_arg(request.args, "offset", 0),
+            int_arg(request.args, "limit", DEFAULT_PAGE_LIMIT),
+            page.to_json(orient="records"),
+        )
+        return Response(body, mimetype="application/json")
 
+    except (KeyError, ValueError) as e:
+        logger.debug("Invalid query in '/data-table' endpoint: %s", e)
+        return jsonify({"error": error_message(e)}), 400
     except Exception as e:
-        print("General error in '/data-table' endpoint:", str(e))
-        traceback.print_exc()  # Prints the full traceback to console
+        logger.exception("General error in '/data-table' endpoint: %s", e)
         return jsonify({"error": f"An error occurred: {str(e)}"}), 500
 
 
 @app.route("/prop-freq", methods=["GET"])
 def get_table_prop():
     try:
-        # Check if the Zarr object is loaded
-        if zarr_cache is not None:
-            try:
-                # Access the DataFrame in the `.uns` slot
-                if "liana_annotated" in zarr_cache.uns:
-                    df = zarr_cache.uns["liana_annotated"]
-                    # print("DataFrame accessed:", df)
-                    df = df[df["pathway_name"] != "Unknown"]
-                    df = df[df["lr_probs"] > 0]
-                    df = df[df["cellchat_pvals"] <= 0.05]
-                    # Convert the DataFrame to JSON format
-                    data = df.to_json(orient="records")
-                    # print("Data converted to JSON format:", data)
-                else:
-                    print("Key 'Cellchat_Interactions' not found in zarr_cache")
-                    data = []  # Return an empty array if the key is not found
-            except Exception as e:
-                print("Error accessing DataFrame in 'zarr_cache.uns':", str(e))
-                traceback.print_exc()  # Prints the full traceback to console
-                return jsonify({"error": f"Failed to access DataFrame: {str(e)}"}), 500
-        else:
-            print("Zarr cache not loaded.")
-            data = []  # Return an empty array if Zarr file failed to load
+        entry = get_liana_view("prop-freq", request_dataset())
+        if entry is None:
+            logger.warning("Key 'liana_annotated' not found or Zarr cache not loaded.")
+            return Response("[]", mimetype="application/json")
 
-        # Log the data type for debugging
-        # print("Data type:", type(data))
-
-        # Return the data as JSON
-        return Response(data, mimetype="application/json")
+        # Return the cached table, or 304 if the client already has it
+        return cached_view_response(entry)
 
     except Exception as e:
-        print("General error in '/prop-freq' endpoint:", str(e))
-        traceback.print_exc()  # Prints the full traceback to console
+        logger.exception("General error in '/prop-freq' endpoint: %s", e)
         return jsonify({"error": f"An error occurred: {str(e)}"}), 500
 
 
 @app.route("/sankey", methods=["GET"])
 def get_table_sankey():
     try:
-        # Check if the Zarr object is loaded
-        if zarr_cache is not None:
-            try:
-                # Access the DataFrame in the `.uns` slot
-                if "liana_annotated" in zarr_cache.uns:
-                    df = zarr_cache.uns["liana_annotated"]
-                    # print("DataFrame accessed:", df)
-
-                    # Convert the DataFrame to JSON format
-                    data = df.to_json(orient="records")
-                    # print("Data converted to JSON format:", data)
-                else:
-                    print("Key 'Cellchat_Interactions' not found in zarr_cache")
-                    data = []  # Return an empty array if the key is not found
-            except Exception as e:
-                print("Error accessing DataFrame in 'zarr_cache.uns':", str(e))
-                traceback.print_exc()  # Prints the full traceback to console
-                return jsonify({"error": f"Failed to access DataFrame: {str(e)}"}), 500
-        else:
-            print("Zarr cache not loaded.")
-            data = []  # Return an empty array if Zarr file failed to load
-
-        # Log the data type for debugging
-        # print("Data type:", type(data))
+        entry = get_liana_view("sankey", request_dataset())
+        if entry is None:
+            logger.warning("Key 'liana_annotated' not found or Zarr cache not loaded.")
+            return Response("[]", mimetype="application/json")
 
-        # Return the data as JSON
-        return Response(data, mimetype="application/json")
+        # Return the cached table, or 304 if the client already has it
+        return cached_view_response(entry)
 
     except Exception as e:
-        print("General error in '/sankey' endpoint:", str(e))
-        traceback.print_exc()  # Prints the full traceback to console
+        logger.exception("General error in '/sankey' endpoint: %s", e)
         return jsonify({"error": f"An error occurred: {str(e)}"}), 500
 
 
 @app.route("/circos", methods=["GET"])
 def get_table_circos():
     try:
-        # Check if the Zarr object is loaded
-        if zarr_cache is not None:
-            try:
-                # Access the DataFrame in the `.uns` slot
-                if "liana_annotated" in zarr_cache.uns:
-                    df = zarr_cache.uns["liana_annotated"]
-                    # print("DataFrame accessed:", df)
-                    df = df[df["lr_probs"] > 0]
-                    df = df[df["cellchat_pvals"] <= 0.05]
-                    # Convert the DataFrame to JSON format
-                    data = df.to_json(orient="records")
-                    # print("Data converted to JSON format:", data)
-                else:
-                    print("Key 'Cellchat_Interactions' not found in zarr_cache")
-                    data = []  # Return an empty array if the key is not found
-            except Exception as e:
-                print("Error accessing DataFrame in 'zarr_cache.uns':", str(e))
-                traceback.print_exc()  # Prints the full traceback to console
-                return jsonify({"error": f"Failed to access DataFrame: {str(e)}"}), 500
-        else:
-            print("Zarr cache not loaded.")
-            data = []  # Return an empty array if Zarr file failed to load
+        entry = get_liana_view("circos", request_dataset())
+        if entry is None:
+            logger.warning("Key 'liana_annotated' not found or Zarr cache not loaded.")
+            return Response("[]", mimetype="application/json")
 
-        # Log the data type for debugging
-        # print("Data type:", type(data))
-
-        # Return the data as JSON
-        return Response(data, mimetype="application/json")
+        # Return the cached table, or 304 if the client already has it
+        return cached_view_response(entry)
 
     except Exception as e:
-        print("General error in '/circos' endpoint:", str(e))
-        traceback.print_exc()  # Prints the full traceback to console
+        logger.exception("General error in '/circos' endpoint: %s", e)
         return jsonify({"error": f"An error occurred: {str(e)}"}), 500
 
 
@@ -495,17 +3491,9 @@ def get_table_circos():
 @app.route("/get_cellchat_data", methods=["GET"])
 def get_cellchat_data():
     try:
-        # Convert the Cellchat_Interactions data from uns to a DataFrame
-        if "liana_annotated" in zarr_cache.uns:
-            df = zarr_cache.uns["liana_annotated"]
-            df = df[df["lr_probs"] > 0]
-            # df = df[df["cellchat_pvals"] <= 0.05]
-            print("Bubble Plot DataFrame accessed:", df)
-            # Convert the DataFrame to JSON format (ensure 'source' and 'target' columns exist)
-            data = df[["source", "target"]].to_json(orient="records")
-            # Return the data as JSON response
-            return Response(data, mimetype="application/json")
-        else:
+        # Source/target pairs of every interaction with lr_probs > 0
+        entry = get_liana_view("cellchat-data", request_dataset())
+        if entry is None:
             return (
                 jsonify(
                     {
@@ -514,28 +3502,173 @@ def get_cellchat_data():
                 ),
                 500,
             )
+        return cached_view_response(entry)
     except KeyError as ke:
-        print(f"KeyError: {ke}")
-        return jsonify({"error": str(ke)}), 500
+        logger.warning("KeyError: %s", ke)
+        return jsonify({"error": error_message(ke)}), 500
     except Exception as e:
-        print("Error accessing Cellchat_Interactions data:", str(e))
-        traceback.print_exc()
+        logger.exception("Error accessing Cellchat_Interactions data: %s", e)
         return jsonify({"error": str(e)}), 500
 
 
+# Aggregated payloads for the plots, sized by the number of cell types
+# rather than by the number of interactions
+def cube_response(aggregate, dataset_id, prob_min, pvalue_max, **params):
+    # JSON response of an aggregate answered from the cube level of
+    # pvalue_max. Bodies are cached per level and lr_probs rank, so every
+    # threshold between the same distinct values shares one body, and the
+    # AGGREGATE_CACHE_SIZE most recently used ones are kept.
+    dataset_id = dataset_id or DEFAULT_DATASET
+    cube = get_liana_cube(dataset_id)
+    if cube is None:
+        return jsonify({"error": "'liana_annotated' not found in the Zarr file."}), 500
+    level_key = cube_level_key(cube, pvalue_max)
+    prob_rank = cube_prob_rank(cube, prob_min)
+    key = (aggregate.__name__, level_key, prob_rank, tuple(sorted(params.items())))
+    with cache_lock:
+        cache = view_cache.setdefault(
+            (dataset_id, "cube-results"), {"results": OrderedDict(), "nbytes": 0}
+        )
+        entry = cache["results"].get(key)
+        if entry is not None:
+            cache["results"].move_to_end(key)
+    count_cache("cube-results", entry is not None)
+    if entry is not None:
+        return cached_json_response(entry)
+
+    with compute_lock((dataset_id, "cube-results") + key):
+        entry = cache["results"].get(key)
+        if entry is None:
+            level = get_cube_level(dataset_id, cube, level_key)
+            with timed("filter"):
+                payload = aggregate(cube, level, prob_rank, **params)
+            with timed("serialize"):
+                body = json.dumps(payload, separators=JSON_SEPARATORS).encode("utf-8")
+            entry = {
+                "body": body,
+                "etag": hashlib.sha1(body).hexdigest(),
+                "nbytes": len(body),
+            }
+            with cache_lock:
+                store_cached_result(cache, key, entry, AGGREGATE_CACHE_SIZE)
+                enforce_dataset_budget(keep=dataset_id)
+    return cached_json_response(entry)
+
+
+@app.route("/aggregate/heatmap", methods=["GET"])
+def get_heatmap_aggregate():
+    # ?prob_min=<lr_probs threshold, default 0>&pvalue_max=<cellchat_pvals
+    # threshold, default none>&value=count|sum
+    try:
+        value = request.args.get("value", "count")
+        if value not in ("count", "sum"):
+            return jsonify({"error": "'value' must be 'count' or 'sum'"}), 400
+        return cube_response(
+            cube_heatmap,
+            request_dataset(),
+            prob_min=float_arg(request.args, "prob_min", 0),
+            pvalue_max=float_arg(request.args, "pvalue_max"),
+            value=value,
+        )
+    except ValueError as e:
+        return jsonify({"error": error_message(e)}), 400
+    except Exception as e:
+        logger.exception("General error in '/aggregate/heatmap' endpoint: %s", e)
+        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+
+
+@app.route("/aggregate/pathway-proportion", methods=["GET"])
+def get_pathway_proportion_aggregate():
+    # ?group_by=source|target&top_n=<n>&prob_min=<lr_probs threshold, default
+    # 0>&pvalue_max=<cellchat_pvals threshold, default 0.05>
+    try:
+        group_by = request.args.get("group_by", "source")
+        pathway = request.args.get("pathway", "pathway_name")
+        top_n = int_arg(request.args, "top_n", 10)
+        if not 1 <= top_n <= AGGREGATE_MAX_TOP:
+            return (
+                jsonify({"error": f"'top_n' must be between 1 and {AGGREGATE_MAX_TOP}"}),
+                400,
+            )
+        prob_min = float_arg(request.args, "prob_min", 0)
+        pvalue_max = float_arg(request.args, "pvalue_max", 0.05)
+
+        if group_by in ("source", "target") and pathway == "pathway_name":
+            return cube_response(
+                cube_pathway_proportion,
+                request_dataset(),
+                prob_min=prob_min,
+                pvalue_max=pvalue_max,
+                group_by=group_by,
+                top_n=top_n,
+            )
+        # Other columns are counted from the "prop-freq" view, whose
+        # thresholds are fixed
+        if prob_min != 0 or pvalue_max != 0.05:
+            return (
+                jsonify(
+                    {
+                        "error": "'prob_min' and 'pvalue_max' need group_by source or "
+                        "target and pathway pathway_name"
+                    }
+                ),
+                400,
+            )
+        entry = get_liana_aggregate(
+            "prop-freq",
+            aggregate_pathway_proportion,
+            dataset_id=request_dataset(),
+            group_by=group_by,
+            pathway=pathway,
+            top_n=top_n,
+        )
+        if entry is None:
+            return jsonify({"error": "'liana_annotated' not found in the Zarr file."}), 500
+        return cached_json_response(entry)
+    except (KeyError, ValueError) as e:
+        logger.warning("Invalid request: %s", e)
+        return jsonify({"error": error_message(e)}), 400
+    except Exception as e:
+        logger.exception("General error in '/aggregate/pathway-proportion' endpoint: %s", e)
+        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+
+
+@app.route("/aggregate/circos", methods=["GET"])
+def get_circos_aggregate():
+    try:
+        top_pairs = int_arg(request.args, "top_pairs", 10)
+        if not 1 <= top_pairs <= AGGREGATE_MAX_TOP:
+            return (
+                jsonify(
+                    {"error": f"'top_pairs' must be between 1 and {AGGREGATE_MAX_TOP}"}
+                ),
+                400,
+            )
+
+        entry = get_liana_aggregate(
+            "circos",
+            aggregate_circos,
+            dataset_id=request_dataset(),
+            top_pairs=top_pairs,
+        )
+        if entry is None:
+            return jsonify({"error": "'liana_annotated' not found in the Zarr file."}), 500
+        return cached_json_response(entry)
+    except ValueError as e:
+        return jsonify({"error": error_message(e)}), 400
+    except Exception as e:
+        logger.exception("General error in '/aggregate/circos' endpoint: %s", e)
+        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+
+
 @app.route("/get_cellchat_bubble", methods=["GET"])
 def get_cellchat_bubble():
     try:
-        # Access the DataFrame in the `.uns` slot
-        if "liana_annotated" in zarr_cache.uns:
-            df = zarr_cache.uns["liana_annotated"]
-            df["Interacting_Pair"] = df["source"] + " -> " + df["target"]
-            df["Interaction"] = df["ligand_complex"] + " - " + df["receptor_complex"]
-            df = df[df["lr_probs"] > 0]
-            # print("Bubble Plot DataFrame accessed:", df)
-
-            # Convert the DataFrame to JSON format
-            return jsonify(df.to_dict(orient="records"))
+        # Interactions with lr_probs > 0 plus the Interacting_Pair and
+        # Interaction labels, streamed when the view is large
+        entry = get_liana_view("bubble", request_dataset())
+        if entry is not None:
+            return cached_view_response(entry)
         else:
             return (
                 jsonify(
@@ -549,6 +3682,207 @@ def get_cellchat_bubble():
         return jsonify({"error": str(e)}), 500
 
 
+@app.route("/bubble", methods=["GET"])
+def get_bubble():
+    # ?source=..&target=..&ligand=..&receptor=..&pathway=.. (each repeatable),
+    # prob_column, pvalue_column, pvalue_max and top_k per Interacting_Pair
+    try:
+        dataset_id = request_dataset()
+        if get_liana_view("bubble", dataset_id) is None:
+            return jsonify({"error": "'liana_annotated' not found in the Zarr file."}), 500
+        filters = {
+            column: request.args.getlist(param)
+            for param, column in BUBBLE_FILTERS.items()
+            if param in request.args
+        }
+        top_k = int_arg(request.args, "top_k")
+        if top_k is not None and top_k < 1:
+            return jsonify({"error": "'top_k' must be a positive integer"}), 400
+        result = query_bubble(
+            dataset_id,
+            filters,
+            prob_column=request.args.get("prob_column", "lr_probs"),
+            pvalue_column=request.args.get("pvalue_column", "cellchat_pvals"),
+            pvalue_max=float_arg(request.args, "pvalue_max"),
+            top_k=top_k,
+        )
+        return Response(
+            json.dumps(result, separators=JSON_SEPARATORS), mimetype="application/json"
+        )
+    except (KeyError, ValueError) as e:
+        logger.warning("Invalid request: %s", e)
+        return jsonify({"error": error_message(e)}), 400
+    except Exception as e:
+        logger.exception("General error in '/bubble' endpoint: %s", e)
+        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+
+
+@app.route("/query", methods=["GET"])
+def query():
+    # ?where=<filter> (repeatable)&select=<columns>&offset=<n>&limit=<n> or
+    # &group_by=<columns>&agg=count|sum:<column>|mean:<column>.. (repeatable)
+    try:
+        entry = get_query_result(request_dataset(), request.args)
+        if entry is None:
+            return jsonify({"error": "'liana_annotated' not found in the Zarr file."}), 500
+        return cached_json_response(entry)
+    except (KeyError, ValueError) as e:
+        logger.debug("Invalid query in '/query' endpoint: %s", e)
+        return jsonify({"error": error_message(e)}), 400
+    except Exception as e:
+        logger.exception("General error in '/query' endpoint: %s", e)
+        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+
+
+@app.route("/search", methods=["GET"])
+def search():
+    # Prefix autocomplete over ligands, receptors, pathways and genes,
+    # ?q=<prefix>&field=<field> (repeatable)&limit=<n>
+    try:
+        prefix = request.args.get("q", "")
+        fields = request.args.getlist("field")
+        for field in fields:
+            if field not in SEARCH_FIELDS:
+                return jsonify({"error": f"Unknown field '{field}'"}), 400
+        limit = int_arg(request.args, "limit", SEARCH_DEFAULT_LIMIT)
+        if not 0 < limit <= SEARCH_MAX_LIMIT:
+            return (
+                jsonify({"error": f"'limit' must be between 1 and {SEARCH_MAX_LIMIT}"}),
+                400,
+            )
+        if not prefix:
+            return jsonify([])
+        index = get_search_index(request_dataset())
+        return jsonify(search_prefix(index, prefix, fields, limit))
+    except ValueError as e:
+        return jsonify({"error": error_message(e)}), 400
+    except Exception as e:
+        logger.exception("General error in '/search' endpoint: %s", e)
+        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+
+
+@app.route("/expression", methods=["GET"])
+def get_expression():
+    # Mean expression and fraction of expressing cells of ?gene=.. (repeatable)
+    # per Cell_Type (all of them, or ?cell_type=.. repeatable), or within a
+    # stored selection with ?selection=<name>
+    try:
+        dataset_id = request_dataset()
+        adata = get_dataset(dataset_id)
+        if adata is None:
+            return jsonify({"error": "Zarr file not found"}), 500
+        genes = request.args.getlist("gene")
+        if not genes:
+            return jsonify({"error": "No gene provided"}), 400
+        unknown = [gene for gene in genes if gene not in adata.var_names]
+        if unknown:
+            return jsonify({"error": f"Genes not found: {unknown}"}), 404
+
+        selection_name = request.args.get("selection")
+        if selection_name is not None:
+            stored_selections = load_selections(request_session_id()) or {}
+            if selection_name not in stored_selections:
+                return jsonify({"error": "Selection not found"}), 404
+            selection = stored_selections[selection_name]
+            if selection["dataset"] != dataset_id:
+                return jsonify({"error": "Selection belongs to another dataset"}), 400
+            rows = selection_rows(selection)
+            summaries = get_selection_summaries(dataset_id, rows, genes)
+            groups = [selection_name]
+            counts = [len(rows)]
+            positions = [0]
+        else:
+            entry = get_cell_type_summaries(dataset_id, genes)
+            summaries = entry["genes"]
+            groups = request.args.getlist("cell_type") or entry["cell_types"]
+            unknown = [group for group in groups if group not in entry["cell_types"]]
+            if unknown:
+                return jsonify({"error": f"Cell types not found: {unknown}"}), 404
+            positions = [entry["cell_types"].index(group) for group in groups]
+            counts = [int(entry["counts"][i]) for i in positions]
+
+        return jsonify(
+            {
+                "genes": genes,
+                "groups": groups,
+                "n_cells": counts,
+                "mean": [[float(summaries[g][0][i]) for i in positions] for g in genes],
+                "fraction": [
+                    [float(summaries[g][1][i]) for i in positions] for g in genes
+                ],
+            }
+        )
+    except Exception as e:
+        logger.exception("General error in '/expression' endpoint: %s", e)
+        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+
+
+@app.route("/spatial/cells", methods=["GET"])
+def get_spatial_cells():
+    # Xenium cells inside the viewport ?x0=&y0=&x1=&y1= (global coordinates),
+    # aggregated into grid bins when more than ?max_cells= are visible
+    try:
+        dataset_id = request_dataset()
+        try:
+            x0, y0, x1, y1 = (float(request.args[name]) for name in ("x0", "y0", "x1", "y1"))
+            max_cells = int(request.args.get("max_cells", SPATIAL_MAX_CELLS))
+            bins = int(request.args.get("bins", SPATIAL_BINS))
+        except (KeyError, ValueError):
+            return jsonify({"error": "x0, y0, x1 and y1 must be numbers"}), 400
+        if x1 < x0 or y1 < y0 or bins < 1:
+            return jsonify({"error": "Empty viewport"}), 400
+        index = get_spatial_index(dataset_id)
+        return jsonify(
+            query_spatial_cells(
+                index,
+                x0,
+                y0,
+                x1,
+                y1,
+                min(max_cells, SPATIAL_MAX_CELLS),
+                min(bins, SPATIAL_BINS),
+            )
+        )
+    except Exception as e:
+        logger.exception("General error in '/spatial/cells' endpoint: %s", e)
+        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+
+
+@app.route("/spatial/neighborhood", methods=["GET"])
+def get_spatial_neighborhood():
+    # Neighborhood enrichment z-scores of the Xenium cell type pairs, for the
+    # circos/heatmap views to overlay on the LIANA interactions. Answers 202
+    # with the job status until the enrichment has been computed.
+    try:
+        dataset_id = request_dataset()
+        radius = float_arg(request.args, "radius", NEIGHBORHOOD_RADIUS)
+        permutations = int_arg(request.args, "permutations", NEIGHBORHOOD_PERMUTATIONS)
+        if radius not in NEIGHBORHOOD_RADII:
+            raise ValueError(
+                f"'radius' must be one of {', '.join(map(str, NEIGHBORHOOD_RADII))}"
+            )
+        if permutations not in NEIGHBORHOOD_PERMUTATION_CHOICES:
+            raise ValueError(
+                "'permutations' must be one of "
+                + ", ".join(map(str, NEIGHBORHOOD_PERMUTATION_CHOICES))
+            )
+        key = request.args.get("cell_type_key", SPATIAL_CELL_TYPE_KEY)
+        entry, job = get_neighborhood_enrichment(dataset_id, key, radius, permutations)
+        if entry is not None:
+            return cached_json_response(entry)
+        if job["status"] == "failed":
+            return jsonify(job), 500
+        response = jsonify(job)
+        response.status_code = 202
+        response.headers["Retry-After"] = str(NEIGHBORHOOD_RETRY_AFTER)
+        return response
+    except ValueError as e:
+        return jsonify({"error": error_message(e)}), 400
+    except Exception as e:
+        logger.exception("General error in '/spatial/neighborhood' endpoint: %s", e)
+        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+
+
 @app.route("/filter-table", methods=["POST"])
 def filter_table():
     try:
@@ -558,32 +3892,22 @@ def filter_table():
         if not selection_name:
             return jsonify({"error": "Selection name not provided"}), 400
 
-        # Retrieve stored selections from previous /process_selections call
-        stored_selections = getattr(filter_table, "stored_selections", {})
+        # Retrieve this session's selections from its /process_selections call
+        stored_selections = load_selections(request_session_id()) or {}
 
         if selection_name not in stored_selections:
             return jsonify({"error": "Selection not found"}), 404
 
-        selected_barcodes = stored_selections[selection_name]
-        print(f"Selected Barcodes: {selected_barcodes}")
+        selection = stored_selections[selection_name]
+        selected_rows = selection_rows(selection)
+        logger.debug("Selected cells: %d", len(selected_rows))
 
         # Check if the Zarr object is loaded
-        if zarr_cache is not None and "liana_annotated" in zarr_cache.uns:
-            metadf = zarr_cache.obs["Cell_Type"]
-
-            # Ensure metadf uses row names (barcodes) correctly
-            metadf = metadf.reindex(selected_barcodes)  # Avoids KeyErrors
-            print(f"Filtered Metadata: {metadf}")
-
-            # Get unique cell types
-            celltypes = metadf.dropna().unique()  # Drop NaN values
-            print(f"Cell Types Found: {celltypes}")
-
-            df = zarr_cache.uns["liana_annotated"]
-            df = df[df["lr_probs"] > 0]
-
+        dataset_id = selection["dataset"]
+        view = get_liana_view("data-table", dataset_id)
+        if view is not None:
             # Ensure source and target columns exist
-            if "source" not in df.columns or "target" not in df.columns:
+            if "source" not in view["frame"].columns or "target" not in view["frame"].columns:
                 return (
                     jsonify(
                         {"error": "Columns 'source' or 'target' not found in dataset"}
@@ -591,24 +3915,28 @@ def filter_table():
                     500,
                 )
 
-            # Filter dataset based on selected barcodes
-            filtered_df = df[
-                df["source"].isin(celltypes) & df["target"].isin(celltypes)
-            ]
-
-            # Convert filtered DataFrame to JSON
-            filtered_data = filtered_df.to_json(orient="records")
+            # Resolve the barcodes to their cell types, then to the
+            # interactions between those cell types
+            index = get_selection_index(dataset_id)
+            if len(index["cell_codes"]) != selection["n_obs"]:
+                return jsonify({"error": "Dataset changed, selection is stale"}), 409
+            selected = selected_cell_types(index, rows=selected_rows)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "Cell types found: %s",
+                    [index["cell_types"][code] for code in np.flatnonzero(selected)],
+                )
+            filtered_data = selection_interactions_body(dataset_id, index, selected)
             return Response(filtered_data, mimetype="application/json")
 
         return jsonify({"error": "liana_res or obs not found in dataset"}), 500
 
     except Exception as e:
-        print(f"Error in /filter-table: {e}")
-        traceback.print_exc()
+        logger.exception("Error in /filter-table: %s", e)
         return jsonify({"error": str(e)}), 500
 
 
-# Store selections globally for later retrieval
+# Store selections per session for later retrieval
 @app.route("/process_selections", methods=["POST"])
 def process_selections():
     try:
@@ -618,42 +3946,218 @@ def process_selections():
         if not selections:
             return jsonify({"message": "No selections received"}), 400
 
-        print(f"Received Selections: {selections}")
+        logger.debug("Received selections: %s", list(selections))
 
-        # Store selections for later retrieval in /filter-table
-        filter_table.stored_selections = selections
+        # Store selections for later retrieval in /filter-table, as obs rows
+        dataset_id = request_dataset()
+        index = get_selection_index(dataset_id)
+        if index is None:
+            return jsonify({"error": "liana_res or obs not found in dataset"}), 500
+        n_obs = len(index["barcodes"])
+        encoded = {
+            name: encode_selection(
+                dataset_id, index["barcodes"].get_indexer(pd.Index(barcodes)), n_obs
+            )
+            for name, barcodes in selections.items()
+        }
+        session_id = request_session_id() or secrets.token_urlsafe(24)
+        store_selections(session_id, encoded)
 
-        return jsonify({"message": "Selections stored successfully"}), 200
+        response = jsonify(
+            {"message": "Selections stored successfully", "session_id": session_id}
+        )
+        response.set_cookie(
+            SESSION_COOKIE,
+            session_id,
+            max_age=int(SELECTION_TTL),
+            httponly=True,
+            samesite="Lax",
+        )
+        return response, 200
 
     except Exception as e:
-        print(f"Error in /process_selections: {e}")
-        traceback.print_exc()
+        logger.exception("Error in /process_selections: %s", e)
         return jsonify({"error": str(e)}), 500
 
 
+# Zarr chunks are served from an in-memory LRU when small, and streamed with
+# send_file (sendfile where the server supports it) when large
+CHUNK_CACHE_MAX_BYTES = 256 * 1024**2
+CHUNK_CACHE_MAX_FILE_BYTES = 1024**2
+# Chunks under /datasets/@<version>/ never change while the version is the
+# current one of their store and are cached for good. Unversioned (and stale)
+# URLs are rewritten in place by re-ingesting a study, so those chunks are
+# revalidated against their ETag (inode, size and mtime) on every use.
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+CHUNK_CACHE_CONTROL = "public, no-cache"
+METADATA_CACHE_CONTROL = "no-cache"
+ZARR_METADATA_FILES = (".zarray", ".zgroup", ".zattrs", ".zmetadata", "zarr.json")
+
+# full path -> (stat key, bytes), least recently used first
+chunk_cache = OrderedDict()
+chunk_cache_nbytes = 0
+chunk_cache_lock = threading.Lock()
+# zarr root path -> {"key", "body", "etag"}
+consolidated_cache = {}
+
+
+def file_etag(stat):
+    return f"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"
+
+
+def chunk_cache_control(full_path, version=None):
+    # Cache-Control of a chunk requested under /datasets/@<version>/ (or
+    # without a version)
+    if version is not None:
+        for dataset_id in get_dataset_registry():
+            roots = dataset_store_roots(dataset_id)
+            if any(full_path.startswith(root + os.sep) for root in roots):
+                if stores_version(roots) == version:
+                    return IMMUTABLE_CACHE_CONTROL
+    return CHUNK_CACHE_CONTROL
+
+
+def read_cached_chunk(full_path, stat):
+    # {"body", "etag", "nbytes"} of a small file, re-read when its size or
+    # mtime changed. Compressed variants are kept in the same entry.
+    global chunk_cache_nbytes
+    key = (stat.st_size, stat.st_mtime_ns)
+    with chunk_cache_lock:
+        cached = chunk_cache.get(full_path)
+        if cached is not None and cached["key"] == key:
+            chunk_cache.move_to_end(full_path)
+            count_cache("chunks", True)
+            return cached
+    count_cache("chunks", False)
+    with timed("io"), open(full_path, "rb") as f:
+        data = f.read()
+    entry = {"key": key, "body": data, "etag": file_etag(stat), "nbytes": len(data)}
+    with chunk_cache_lock:
+        previous = chunk_cache.pop(full_path, None)
+        if previous is not None:
+            chunk_cache_nbytes -= previous["nbytes"]
+        chunk_cache[full_path] = entry
+        chunk_cache_nbytes += entry["nbytes"]
+        while chunk_cache_nbytes > CHUNK_CACHE_MAX_BYTES and chunk_cache:
+            _, evicted = chunk_cache.popitem(last=False)
+            chunk_cache_nbytes -= evicted["nbytes"]
+    return entry
+
+
+def chunk_variant_added(full_path, entry):
+    # Accounts a compressed variant added to a chunk cache entry, unless the
+    # entry was evicted meanwhile (its nbytes were then already subtracted)
+    def on_grow(nbytes):
+        global chunk_cache_nbytes
+        with chunk_cache_lock:
+            if chunk_cache.get(full_path) is entry:
+                chunk_cache_nbytes += nbytes
+
+    return on_grow
+
+
+def consolidated_metadata(zarr_root):
+    # .zmetadata for a zarr v2 store written without one, so the client gets
+    # every .zarray/.zgroup/.zattrs in a single request. Rebuilt when the
+    # root of the store is modified.
+    root_stat = os.stat(zarr_root)
+    key = (root_stat.st_mtime_ns, os.stat(os.path.join(zarr_root, ".zgroup")).st_mtime_ns)
+    entry = consolidated_cache.get(zarr_root)
+    if entry is not None and entry["key"] == key:
+        return entry
+
+    metadata = {}
+    for root, dirs, files in os.walk(zarr_root):
+        dirs.sort()
+        for name in (".zarray", ".zgroup", ".zattrs"):
+            if name in files:
+                path = os.path.join(root, name)
+                with open(path, "r") as f:
+                    metadata[os.path.relpath(path, zarr_root).replace(os.sep, "/")] = json.load(f)
+        # Chunk-only directories hold no metadata below them
+        if ".zarray" in files:
+            dirs[:] = []
+    consolidated = {"zarr_consolidated_format": 1, "metadata": metadata}
+    body = json.dumps(consolidated, separators=JSON_SEPARATORS).encode("utf-8")
+    entry = {"key": key, "body": body, "etag": hashlib.sha1(body).hexdigest()}
+    consolidated_cache[zarr_root] = entry
+    return entry
+
+
 # Endpoint: Serve hierarchical Zarr files
 @app.route("/datasets/<path:filename>", methods=["GET"])
-def serve_datasets(filename):
-    try:
-        # Construct the full path to the requested file
-        full_path = os.path.join(BASE_DIR, filename)
-        if os.path.exists(full_path):
-            # Check if it's a file
-            if os.path.isfile(full_path):
-                return send_file(full_path)
-            else:
-                # Handle directory requests (e.g., for Zarr hierarchical access)
-                return (
-                    jsonify({"error": f"'{filename}' is a directory, not a file."}),
-                    400,
-                )
-        else:
+@app.route("/datasets/@<version>/<path:filename>", methods=["GET"])
+def serve_datasets(filename, version=None):
+    try:
+        # Construct the full path to the requested file, refusing paths that
+        # escape BASE_DIR
+        full_path = safe_join(BASE_DIR, filename)
+        if full_path is None:
+            abort(404)
+        is_metadata = os.path.basename(full_path) in ZARR_METADATA_FILES
+        try:
+            stat = os.stat(full_path)
+        except FileNotFoundError:
+            zarr_root = os.path.dirname(full_path)
+            if os.path.basename(full_path) == ".zmetadata" and os.path.isfile(
+                os.path.join(zarr_root, ".zgroup")
+            ):
+                entry = consolidated_metadata(zarr_root)
+                response = Response(entry["body"], mimetype="application/json")
+                response.set_etag(entry["etag"])
+                response.headers["Cache-Control"] = METADATA_CACHE_CONTROL
+                compress_cached_response(response, entry)
+                return response.make_conditional(request)
             return jsonify({"error": f"File or directory '{filename}' not found."}), 404
+
+        if stat_module.S_ISDIR(stat.st_mode):
+            # Handle directory requests (e.g., for Zarr hierarchical access)
+            return (
+                jsonify({"error": f"'{filename}' is a directory, not a file."}),
+                400,
+            )
+
+        if is_metadata:
+            cache_control, mimetype = METADATA_CACHE_CONTROL, "application/json"
+        else:
+            cache_control = chunk_cache_control(full_path, version)
+            mimetype = "application/octet-stream"
+        if stat.st_size <= CHUNK_CACHE_MAX_FILE_BYTES:
+            entry = read_cached_chunk(full_path, stat)
+            response = Response(entry["body"], mimetype=mimetype)
+            response.set_etag(entry["etag"])
+            response.last_modified = stat.st_mtime
+            response.headers["Cache-Control"] = cache_control
+            # Chunks are left as they are, zarr compressed most of them
+            # already and compressing them again only costs time
+            if is_metadata:
+                compress_cached_response(
+                    response, entry, on_grow=chunk_variant_added(full_path, entry)
+                )
+            return response.make_conditional(
+                request, accept_ranges=True, complete_length=stat.st_size
+            )
+
+        # Large files: conditional send_file handles Range and If-None-Match
+        response = send_file(
+            full_path,
+            mimetype=mimetype,
+            etag=file_etag(stat),
+            conditional=True,
+            last_modified=stat.st_mtime,
+        )
+        response.headers["Cache-Control"] = cache_control
+        return response
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Error serving dataset file: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Error serving dataset file: %s", e)
         return jsonify({"error": str(e)}), 500
 
 
 if __name__ == "__main__":
+    # The debug reloader re-executes this file in a child process, only warm
+    # up in the process that serves requests
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        create_app()
     app.run(debug=True)
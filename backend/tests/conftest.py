@@ -0,0 +1,76 @@
+import json
+import os
+import sys
+
+import anndata as ad
+import numpy as np
+import pandas as pd
+import pytest
+
+# The backend modules are scripts run from backend/, not an installed package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+DATASET_ID = "test"
+CELL_TYPES = ["B", "Endothelial", "Fibroblast", "T", "Tumor"]
+
+
+@pytest.fixture(scope="session")
+def study(tmp_path_factory):
+    # Small AnnData zarr store with a liana_annotated table, registered in
+    # its own datasets.json
+    directory = str(tmp_path_factory.mktemp("study"))
+    rng = np.random.default_rng(0)
+    n = 500
+    liana = pd.DataFrame(
+        {
+            "source": rng.choice(CELL_TYPES, n),
+            "target": rng.choice(CELL_TYPES, n),
+            "ligand_complex": rng.choice(["CXCL12", "TGFB1", "HLA-A"], n),
+            "receptor_complex": rng.choice(["CXCR4", "TGFBR1", "CD8A"], n),
+            "pathway_name": rng.choice(["CXCL", "TGFb", "MHC-I", "Unknown"], n),
+            "lr_probs": rng.random(n),
+            "cellchat_pvals": rng.choice([0.0, 0.01, 0.05, 0.5], n),
+        }
+    )
+    adata = ad.AnnData(
+        X=rng.random((50, 4)).astype(np.float32),
+        obs=pd.DataFrame(
+            {"Cell_Type": pd.Categorical(rng.choice(CELL_TYPES, 50))},
+            index=[f"cell{i}" for i in range(50)],
+        ),
+        var=pd.DataFrame(index=[f"G{i}" for i in range(4)]),
+        uns={"liana_annotated": liana},
+    )
+    adata.write_zarr(os.path.join(directory, f"{DATASET_ID}_sc.zarr"))
+    with open(os.path.join(directory, "datasets.json"), "w") as f:
+        json.dump(
+            {
+                DATASET_ID: {
+                    "merged_zarr_file": f"{DATASET_ID}_sc.zarr",
+                    "xenium_zarr_file": f"{DATASET_ID}_xenium.zarr",
+                    "name": "Test",
+                }
+            },
+            f,
+        )
+    return {"directory": directory, "liana": liana}
+
+
+@pytest.fixture
+def client(study, monkeypatch):
+    # Test client of the app pointed at the study, with empty caches
+    monkeypatch.setattr(main, "BASE_DIR", study["directory"] + os.sep)
+    monkeypatch.setattr(main, "CONFIG_DIR", study["directory"] + os.sep)
+    monkeypatch.setattr(
+        main, "DATASETS_FILE", os.path.join(study["directory"], "datasets.json")
+    )
+    monkeypatch.setattr(main, "DEFAULT_DATASET", DATASET_ID)
+    monkeypatch.setattr(main, "dataset_registry", {})
+    monkeypatch.setitem(main.warm_up_state, "status", "ready")
+    main.dataset_cache.clear()
+    main.view_cache.clear()
+    yield main.app.test_client()
+    main.dataset_cache.clear()
+    main.view_cache.clear()
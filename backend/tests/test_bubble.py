@@ -0,0 +1,35 @@
+import pandas as pd
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("param", ["prob_column", "pvalue_column"])
+def test_non_numeric_columns_are_rejected(client, param):
+    response = client.get(f"/bubble?{param}=source&pvalue_max=0.05")
+    assert response.status_code == 400
+    assert "source" in response.get_json()["error"]
+
+
+def test_numeric_columns_order_the_bubbles(client):
+    response = client.get("/bubble?prob_column=lr_probs&pvalue_max=0.05")
+    assert response.status_code == 200
+    probs = response.get_json()["points"]["prob"]
+    assert probs == sorted(probs, reverse=True)
+
+
+def test_derived_labels_are_categorical(client, study):
+    response = client.get("/get_cellchat_bubble")
+    assert response.status_code == 200
+    liana = study["liana"]
+    liana = liana[liana["lr_probs"] > 0]
+    records = response.get_json()
+    assert [r["Interacting_Pair"] for r in records] == list(
+        liana["source"] + " -> " + liana["target"]
+    )
+    assert [r["Interaction"] for r in records] == list(
+        liana["ligand_complex"] + " - " + liana["receptor_complex"]
+    )
+    frame = main.get_liana_view("bubble")["frame"]
+    for column in ("Interacting_Pair", "Interaction"):
+        assert isinstance(frame[column].dtype, pd.CategoricalDtype)
@@ -0,0 +1,40 @@
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize(
+    "expression",
+    ["lr_probs>abc", "source>=1", "source<B", "cellchat_pvals==low"],
+)
+def test_filter_values_must_match_column_type(client, expression):
+    response = client.get(f"/data-table?limit=5&filter={expression}")
+    assert response.status_code == 400
+    assert "error" in response.get_json()
+
+
+def test_categorical_filters_compare_labels(client, study):
+    response = client.get("/data-table?limit=1000&filter=source==B&filter=lr_probs>0.5")
+    assert response.status_code == 200
+    liana = study["liana"]
+    expected = liana[(liana["source"] == "B") & (liana["lr_probs"] > 0.5)]
+    body = response.get_json()
+    assert body["total"] == len(expected)
+    assert {row["source"] for row in body["rows"]} == {"B"}
+
+
+def test_unknown_column_is_rejected(client):
+    assert client.get("/data-table?limit=5&filter=nope>1").status_code == 400
+
+
+@pytest.mark.parametrize("query", ["format=xml", "format=xml&limit=5"])
+def test_unsupported_format_is_rejected_with_and_without_paging(client, query):
+    response = client.get(f"/data-table?{query}")
+    assert response.status_code == 406
+
+
+def test_paged_format_is_negotiated(client):
+    response = client.get("/data-table?format=ndjson&limit=5")
+    assert response.status_code == 200
+    assert response.mimetype == main.TABLE_FORMATS["ndjson"]
+    assert len(response.get_data().splitlines()) == 5
@@ -0,0 +1,54 @@
+import os
+
+import main
+from conftest import DATASET_ID
+
+CHUNK = f"{DATASET_ID}_sc.zarr/obs/Cell_Type/codes/0"
+
+
+def current_version():
+    return main.stores_version(main.dataset_store_roots(DATASET_ID))
+
+
+def test_unversioned_chunk_is_revalidated(client):
+    response = client.get(f"/datasets/{CHUNK}")
+    assert response.status_code == 200
+    assert response.headers["Cache-Control"] == main.CHUNK_CACHE_CONTROL
+    etag = response.headers["ETag"]
+    response = client.get(f"/datasets/{CHUNK}", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+
+def test_versioned_chunk_is_immutable(client):
+    unversioned = client.get(f"/datasets/{CHUNK}")
+    response = client.get(f"/datasets/@{current_version()}/{CHUNK}")
+    assert response.status_code == 200
+    assert response.headers["Cache-Control"] == main.IMMUTABLE_CACHE_CONTROL
+    assert response.data == unversioned.data
+
+
+def test_unknown_version_is_revalidated(client):
+    response = client.get(f"/datasets/@0123456789abcdef/{CHUNK}")
+    assert response.status_code == 200
+    assert response.headers["Cache-Control"] == main.CHUNK_CACHE_CONTROL
+
+
+def test_versioned_metadata_is_revalidated(client):
+    zattrs = f"{DATASET_ID}_sc.zarr/.zattrs"
+    response = client.get(f"/datasets/@{current_version()}/{zattrs}")
+    assert response.status_code == 200
+    assert response.headers["Cache-Control"] == main.METADATA_CACHE_CONTROL
+
+
+def test_rewritten_store_changes_version(client, study, monkeypatch):
+    version = current_version()
+    zattrs = os.path.join(study["directory"], f"{DATASET_ID}_sc.zarr", ".zattrs")
+    stat = os.stat(zattrs)
+    monkeypatch.setattr(main, "store_versions", {})
+    try:
+        os.utime(zattrs, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        assert current_version() != version
+        response = client.get(f"/datasets/@{version}/{CHUNK}")
+        assert response.headers["Cache-Control"] == main.CHUNK_CACHE_CONTROL
+    finally:
+        os.utime(zattrs, ns=(stat.st_atime_ns, stat.st_mtime_ns))
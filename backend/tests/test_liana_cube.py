@@ -0,0 +1,123 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import main
+
+CELL_TYPES = ["B", "Endothelial", "Fibroblast", "T", "Tumor"]
+PATHWAYS = ["CXCL", "MHC-I", "TGFb", main.UNKNOWN_PATHWAY]
+PROB_MINS = [0, 0.1, 0.35, 0.9]
+PVALUE_MAXS = [None, 0.01, 0.05, 0.2, 0.5]
+
+
+@pytest.fixture(scope="module")
+def liana():
+    rng = np.random.default_rng(0)
+    n = 2000
+    df = pd.DataFrame(
+        {
+            "source": rng.choice(CELL_TYPES, n),
+            "target": rng.choice(CELL_TYPES[:-1], n),
+            "pathway_name": rng.choice(PATHWAYS + [None], n),
+            # Rounded so that thresholds fall on repeated values
+            "lr_probs": rng.random(n).round(2),
+            "cellchat_pvals": rng.choice([0.0, 0.01, 0.03, 0.05, 0.2, 0.5, 1.0], n),
+        }
+    )
+    df.loc[rng.random(n) < 0.05, "lr_probs"] = np.nan
+    df.loc[rng.random(n) < 0.05, "cellchat_pvals"] = np.nan
+    return main.normalize_liana(df)
+
+
+@pytest.fixture
+def cube(liana):
+    cube = main.build_liana_cube(liana)
+    cube["pinned"] = {
+        main.cube_level_key(cube, pvalue_max) for pvalue_max in main.CUBE_PVALUE_LEVELS
+    }
+    return cube
+
+
+def filtered(df, prob_min, pvalue_max):
+    df = df[df["lr_probs"] > prob_min]
+    if pvalue_max is not None:
+        df = df[df["cellchat_pvals"] <= pvalue_max]
+    return df
+
+
+def expected_heatmap(df, value):
+    if value == "count":
+        matrix = pd.crosstab(df["source"].astype(str), df["target"].astype(str))
+    else:
+        matrix = df.pivot_table(
+            index=df["source"].astype(str),
+            columns=df["target"].astype(str),
+            values="lr_probs",
+            aggfunc="sum",
+            fill_value=0,
+        )
+    return main.heatmap_payload(matrix)
+
+
+def cube_level(cube, pvalue_max):
+    level_key = main.cube_level_key(cube, pvalue_max)
+    return main.build_cube_level(cube["rows"], level_key)
+
+
+@pytest.mark.parametrize("pvalue_max", PVALUE_MAXS)
+@pytest.mark.parametrize("prob_min", PROB_MINS)
+def test_heatmap_matches_pandas_filter(liana, cube, prob_min, pvalue_max):
+    level = cube_level(cube, pvalue_max)
+    prob_rank = main.cube_prob_rank(cube, prob_min)
+    df = filtered(liana, prob_min, pvalue_max)
+
+    counts = main.cube_heatmap(cube, level, prob_rank, value="count")
+    assert counts == expected_heatmap(df, "count")
+
+    sums = main.cube_heatmap(cube, level, prob_rank, value="sum")
+    expected = expected_heatmap(df, "sum")
+    assert sums["labels"] == expected["labels"]
+    np.testing.assert_allclose(sums["matrix"], expected["matrix"])
+    np.testing.assert_allclose(sums["totals"], expected["totals"])
+
+
+@pytest.mark.parametrize("group_by", ["source", "target"])
+@pytest.mark.parametrize("pvalue_max", PVALUE_MAXS[1:])
+@pytest.mark.parametrize("prob_min", PROB_MINS)
+def test_pathway_proportion_matches_pandas_filter(
+    liana, cube, prob_min, pvalue_max, group_by
+):
+    level = cube_level(cube, pvalue_max)
+    prob_rank = main.cube_prob_rank(cube, prob_min)
+    df = filtered(liana, prob_min, pvalue_max)
+    # Interactions without a pathway are not a pathway of their own
+    df = df[df["pathway_name"].notna() & (df["pathway_name"] != main.UNKNOWN_PATHWAY)]
+
+    for top_n in (1, 3, 10):
+        payload = main.cube_pathway_proportion(cube, level, prob_rank, group_by, top_n)
+        expected = main.aggregate_pathway_proportion(df, group_by, "pathway_name", top_n)
+        assert payload == expected
+
+
+def test_uns_round_trip_keeps_levels(liana, cube):
+    stored = main.cube_from_uns(main.cube_to_uns(cube))
+    assert list(stored["levels"]) == list(cube["levels"])
+    prob_rank = main.cube_prob_rank(cube, 0.35)
+    for level_key, level in cube["levels"].items():
+        assert main.cube_heatmap(stored, stored["levels"][level_key], prob_rank) == (
+            main.cube_heatmap(cube, level, prob_rank)
+        )
+
+
+def test_levels_beyond_limit_evict_least_recently_used(cube, monkeypatch):
+    monkeypatch.setattr(main, "CUBE_MAX_LEVELS", len(cube["levels"]) + 1)
+    pinned = set(cube["levels"])
+    first = main.cube_level_key(cube, 0.2)
+    main.get_cube_level("test", cube, first)
+    second = main.cube_level_key(cube, 0.5)
+    main.get_cube_level("test", cube, second)
+
+    assert second in cube["levels"]
+    assert first not in cube["levels"]
+    assert pinned <= set(cube["levels"])
+    assert cube["nbytes"] == main.cube_nbytes(cube)